@@ -1,22 +1,38 @@
 import asyncio
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import concurrent.futures
 import datetime
-import json
+import functools
 import logging
 import os
 import re
-import requests
+import signal
 import ssl
 import sys
 import threading
-import traceback
+import time
 
 import redis
+import redis.asyncio
 import slack
 import zulip
 
+import bridge_logging
+import debounce
+import file_bridge
+import groupme_ingress
+import groupme_sender
+import leader
+import metrics
+import msg_id_store
+import outbound
+import outbox
+import routing
 import slack_reformat
+import zulip_events
+import ttl_cache
 
+import local_secrets
 from local_secrets import (ZULIP_BOT_NAME, ZULIP_BOT_EMAIL,
                            ZULIP_API_KEY, ZULIP_URL,
                            SLACK_BOT_ID, SLACK_TOKEN,
@@ -29,10 +45,27 @@ from local_secrets import (ZULIP_BOT_NAME, ZULIP_BOT_EMAIL,
                            ZULIP_LOG_ENABLE,
                            ZULIP_LOG_PUBLIC_STREAM, ZULIP_LOG_PRIVATE_STREAM)
 
+# Which slack channels, zulip topics (in PUBLIC_TWO_WAY_STREAM) and groupme bots
+# are bridged to which; see local_secrets.example.py.  Without BRIDGES, each
+# channel in PUBLIC_TWO_WAY is bridged to the topic of the same name, and each
+# in GROUPME_TWO_WAY to its bot.
+GROUPME_BOTS = GROUPME_TWO_WAY if GROUPME_ENABLE else {}
+BRIDGES = getattr(local_secrets, 'BRIDGES', None)
+if BRIDGES is None:
+    BRIDGES = routing.legacy_bridges(PUBLIC_TWO_WAY, GROUPME_BOTS)
+
 REDIS_USERS = REDIS_PREFIX + ':users:'
 REDIS_BOTS = REDIS_PREFIX + ':bots:'
 REDIS_CHANNELS = REDIS_PREFIX + ':channels:'
 REDIS_CHANNELS_BY_NAME = REDIS_PREFIX + ':channels.by.name:'
+REDIS_FILE_MIRROR = REDIS_PREFIX + ':file.mirror:'
+REDIS_OUTBOX = REDIS_PREFIX + ':outbox:'
+REDIS_MSG_IDS = REDIS_PREFIX + ':msg.ids:'
+REDIS_MSG_IDS_FROM_ZULIP = REDIS_PREFIX + ':msg.ids.from.zulip:'
+REDIS_ZULIP_EVENT_QUEUE = REDIS_PREFIX + ':zulip.event.queue'
+REDIS_LEADER = REDIS_PREFIX + ':leader'
+# Where the message id mappings used to be kept, a key per message per stream.
+# Still read for messages sent before the move to REDIS_MSG_IDS.
 REDIS_MSG_SLACK_TO_ZULIP = {
     PUBLIC_TWO_WAY_STREAM:    REDIS_PREFIX + ':msg.slack.to.zulip.pub:',
     ZULIP_LOG_PUBLIC_STREAM:  REDIS_PREFIX + ':msg.slack.to.zulip:',
@@ -46,142 +79,455 @@ GROUP_UPDATES = ['channel_archive', 'channel_join', 'channel_leave',
                  'group_purpose', 'group_topic', 'group_unarchive',
                  'pinned_item', 'unpinned_item']
 
+# Outbound zulip sends run on a pool of worker threads so that a slow zulip
+# server does not stall the slack event loop.  Sends to the same stream/topic
+# are always handled by the same worker, so they stay in order.
+ZULIP_SEND_WORKERS = 4
+ZULIP_SEND_MAX_PENDING = 1000
+
+# Every outbound send is recorded in a redis stream until it has succeeded.
+# Failed sends are retried every OUTBOX_RETRY_INTERVAL seconds, up to
+# OUTBOX_MAX_ATTEMPTS times, and sends cut short by a restart are replayed on
+# startup.  Sends are identified by the message they relay, and one that
+# succeeded is not made again for OUTBOX_DONE_TTL seconds.
+OUTBOX_RETRY_INTERVAL = 30
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_DONE_TTL = 24*60*60
+
+# Messages to groupme are posted from the slack loop over a pool of keep-alive
+# connections, with a queue per bot.  Rate limited and failed posts are retried
+# up to GROUPME_SEND_MAX_RETRIES times with backoff.
+GROUPME_SEND_MAX_PENDING = 1000
+GROUPME_SEND_MAX_CONNECTIONS = 8
+GROUPME_SEND_TIMEOUT = 10
+GROUPME_SEND_MAX_RETRIES = 5
+
+# Callbacks from all groupme bots are received by one server on the slack loop,
+# on GROUPME_INGRESS_PORT (at a path ending in the channel name or bot id), as
+# well as on each bot's BOT_PORT if it has one.  They are handled on a pool of
+# GROUPME_INGRESS_WORKERS threads.
+GROUPME_INGRESS_PORT = int(os.environ.get('GROUPME_INGRESS_PORT', '0'))
+GROUPME_INGRESS_WORKERS = 4
+GROUPME_INGRESS_MAX_PENDING = 100
+
+# The slack -> zulip (and zulip -> slack) message id mappings, kept for
+# SLACK_EDIT_UPDATE_ZULIP_TTL seconds so that edits and deletes can be applied
+# to the messages relayed, are stored in MSG_ID_WINDOWS hashes covering that
+# time (and expire a whole hash at a time).
+# More windows keep less past the TTL but make each lookup check more of them.
+MSG_ID_WINDOWS = 24
+
+# Size of the connection pool used by the asyncio redis client on the slack
+# loop.
+REDIS_ASYNC_MAX_CONNECTIONS = 16
+
+# How long a redis command (or connecting) may take before it fails, so that
+# a dead connection is noticed rather than waited on forever.
+REDIS_SOCKET_TIMEOUT = 5
+
+# In-process caches in front of the redis user/bot/channel lookups, so that
+# relaying messages for known users and channels does not touch redis at all.
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 60*60
+
+# On startup, every slack user and channel is fetched with the paginated list
+# methods (IDENTITY_WARMUP_PAGE_SIZE at a time) to fill redis and the identity
+# caches, so that the first messages after a cold start or a redis flush do not
+# each wait on a users.info or conversations.info call.
+IDENTITY_WARMUP_PAGE_SIZE = 200
+IDENTITY_WARMUP_CONVERSATION_TYPES = 'public_channel,private_channel,mpim,im'
+
+# Slack files are mirrored to zulip on a pool of worker threads, streaming in
+# chunks.  Files over the size limit are not mirrored (but are still mentioned
+# in the bridged message).
+FILE_BRIDGE_MAX_SIZE = 250 * 1024 * 1024
+FILE_BRIDGE_WORKERS = 4
+# How long to remember the zulip upload for a mirrored slack file, so that it
+# can be reused when the file is shared again or its message is edited.
+FILE_MIRROR_CACHE_TTL = 7*24*60*60
+
+# Errors reported to SLACK_ERR_CHANNEL are batched, with identical messages
+# coalesced, and posted at most every SLACK_ERR_FLUSH_INTERVAL seconds (or once
+# SLACK_ERR_MAX_BATCH distinct messages are waiting).
+SLACK_ERR_FLUSH_INTERVAL = 5
+SLACK_ERR_MAX_BATCH = 20
+
+# Slack sends a burst of message_changed events as links are unfurled or a typo
+# is fixed.  The edits (and deletes) of a message are held for
+# SLACK_EDIT_DEBOUNCE seconds after the last one, but no more than
+# SLACK_EDIT_MAX_DEBOUNCE after the first, and only the last is relayed.
+SLACK_EDIT_DEBOUNCE = 1
+SLACK_EDIT_MAX_DEBOUNCE = 5
+
+# The zulip listener's event queue only gets messages sent to the two-way
+# stream (zulip cannot narrow to several topics at once, so the topics are
+# still checked here).  The queue is resumed across restarts, so events sent
+# while the bridge is briefly down are not lost.
+ZULIP_EVENT_TYPES = ['message', 'update_message', 'delete_message']
+ZULIP_EVENT_NARROW = [['stream', PUBLIC_TWO_WAY_STREAM]]
+
+# To run a standby copy of the bridge (e.g. on another host, sharing redis),
+# set the LEADER_ELECTION environment variable on every copy.  Only the copy
+# holding the leader lease relays; it renews the lease every
+# LEADER_RENEW_INTERVAL seconds, and the others try for it as often, taking
+# over once it has not been renewed for LEADER_LEASE_TTL seconds (or straight
+# away if the leader stopped cleanly).  Standbys refresh their identity caches
+# every STANDBY_REWARM_INTERVAL seconds.
+LEADER_ELECTION = os.environ.get('LEADER_ELECTION', '') not in ('', '0')
+LEADER_LEASE_TTL = 10
+LEADER_RENEW_INTERVAL = 2
+STANDBY_REWARM_INTERVAL = 30*60
+
+# How long the zulip listener waits for a message it relays to slack to be
+# posted before moving on to the next one.
+SLACK_POST_TIMEOUT = 10
+
+# Where the slack and groupme APIs are.  (loadtest.py points these at local
+# stand-ins.)
+SLACK_API_URL = slack.WebClient.BASE_URL
+GROUPME_API_URL = 'https://api.groupme.com/v3/bots/post'
+
+# Port to serve Prometheus-style metrics on (on localhost only), or 0 to not
+# serve them.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+
+METRICS = metrics.Registry()
+MESSAGES_RECEIVED = METRICS.counter(
+    'bridge_messages_received_total',
+    'Messages received, by source service.', ['source'])
+EDITS_SUPERSEDED = METRICS.counter(
+    'bridge_edits_superseded_total',
+    'Slack edits not relayed because a later edit or delete of the message replaced them.')
+STAGE_SECONDS = METRICS.histogram(
+    'bridge_stage_seconds',
+    'Time spent in each stage of relaying a message.', ['stage'])
+SEND_SECONDS = METRICS.histogram(
+    'bridge_send_seconds',
+    'Time spent in the API call sending a message to each destination service.',
+    ['destination'])
+RELAY_SECONDS = METRICS.histogram(
+    'bridge_relay_seconds',
+    'Time from receiving a message to it having been sent to a destination service.',
+    ['source', 'destination'])
+REDIS_LOOKUPS = METRICS.counter(
+    'bridge_redis_lookups_total',
+    'Redis lookups of slack users, bots and channels, by whether they were found.',
+    ['kind', 'result'])
+
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
-logging.basicConfig(level=LOGLEVEL)
+# 'text', or 'json' for one json object per line (e.g. for a log pipeline).
+LOGFORMAT = os.environ.get('LOGFORMAT', 'text').lower()
+bridge_logging.configure(LOGLEVEL, LOGFORMAT)
 
 _LOGGER = logging.getLogger(__name__)
 
-if GROUPME_ENABLE:
-    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    context.load_cert_chain(SSL_CERT_CHAIN_PATH, SSL_CERT_KEY_PATH)
-
-class SlackHandler(logging.StreamHandler):
-    def __init__(self, web_client, event_loop, channel_id):
-        super().__init__(self)
-        self.web_client = web_client
-        self.event_loop = event_loop
-        self.channel_id = channel_id
-
-    def emit(self, record):
-        try:
-            msg = self.format(record)
-            asyncio.ensure_future(self.web_client.chat_postMessage(
-                channel=self.channel_id,
-                text="Oopsie! " + msg,
-                mrkdwn=False
-            ), loop=self.event_loop)
-        except Exception as e:
-            print('could not post err to slack %s', repr(e))
-
-# https://stackoverflow.com/a/21631948
-def make_groupme_handler(channel, conf, send):
-    class CustomGroupMeHandler(BaseHTTPRequestHandler):
-        def _set_headers(self):
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-
-        def do_POST(self):
-            try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = json.loads(self.rfile.read(content_length))
-                send(channel, conf, post_data)
-                self._set_headers()
-            except:
-                e = sys.exc_info()
-                exc_type, exc_value, exc_traceback = e
-                _LOGGER.error('Error do post groupme message: %s',
-                              repr(traceback.format_exception(exc_type,
-                                                              exc_value,
-                                                              exc_traceback)))
-    return CustomGroupMeHandler
-
 class SlackBridge():
     def __init__(self):
         _LOGGER.debug('new SlackBridge instance')
 
         _LOGGER.debug('connecting to redis')
+        # The synchronous client is only for use on the zulip and groupme
+        # threads (and the zulip dispatcher workers).  Coroutines on the slack
+        # loop must use redis_async so they never block the loop.
         self.redis = redis.Redis(
             host=REDIS_HOSTNAME,
             port=REDIS_PORT,
             password=REDIS_PASSWORD,
-            charset="utf-8",
-            decode_responses=True)
+            encoding="utf-8",
+            decode_responses=True,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT)
+        self.redis_async = redis.asyncio.Redis(
+            connection_pool=redis.asyncio.ConnectionPool(
+                host=REDIS_HOSTNAME,
+                port=REDIS_PORT,
+                password=REDIS_PASSWORD,
+                encoding="utf-8",
+                decode_responses=True,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+                max_connections=REDIS_ASYNC_MAX_CONNECTIONS))
+
+        self.routes = routing.RoutingTable(BRIDGES, GROUPME_BOTS)
+
+        self.leader = leader.RedisLease(self.redis_async, REDIS_LEADER,
+                                        ttl=LEADER_LEASE_TTL,
+                                        renew_interval=LEADER_RENEW_INTERVAL)
+
+        # With a standby ready to take over, a send that cannot be recorded
+        # might be made by both, so it is not made at all.
+        self.outbox = outbox.Outbox(self.redis, self.redis_async, REDIS_OUTBOX,
+                                    done_ttl=OUTBOX_DONE_TTL,
+                                    max_attempts=OUTBOX_MAX_ATTEMPTS,
+                                    send_unrecorded=not LEADER_ELECTION)
+
+        # slack message id -> 'zulip stream/topic' -> zulip message id
+        self.msg_ids = msg_id_store.MessageIdStore(
+            self.redis, REDIS_MSG_IDS, SLACK_EDIT_UPDATE_ZULIP_TTL,
+            windows=MSG_ID_WINDOWS)
+        # zulip message id -> 'slack:<channel id>' -> slack message
+        self.zulip_msg_ids = msg_id_store.MessageIdStore(
+            self.redis, REDIS_MSG_IDS_FROM_ZULIP, SLACK_EDIT_UPDATE_ZULIP_TTL,
+            windows=MSG_ID_WINDOWS)
+
+        self.user_cache = ttl_cache.TTLCache(IDENTITY_CACHE_SIZE,
+                                             IDENTITY_CACHE_TTL)
+        self.bot_cache = ttl_cache.TTLCache(IDENTITY_CACHE_SIZE,
+                                            IDENTITY_CACHE_TTL)
+        self.channel_cache = ttl_cache.TTLCache(IDENTITY_CACHE_SIZE,
+                                                IDENTITY_CACHE_TTL)
+        self.channel_by_name_cache = ttl_cache.TTLCache(IDENTITY_CACHE_SIZE,
+                                                        IDENTITY_CACHE_TTL)
+        # (zulip stream, topic, slack message id) -> zulip message id, for the
+        # messages we sent recently.  Edits and deletes of them are looked up
+        # here first, as the id may not have reached redis yet.
+        self.zulip_id_cache = ttl_cache.TTLCache(
+            IDENTITY_CACHE_SIZE, min(IDENTITY_CACHE_TTL, SLACK_EDIT_UPDATE_ZULIP_TTL))
+        # Likewise, zulip message id -> 'slack:<channel id>' -> slack message,
+        # for the messages from zulip we posted to slack recently.
+        self.slack_post_cache = ttl_cache.TTLCache(
+            IDENTITY_CACHE_SIZE, min(IDENTITY_CACHE_TTL, SLACK_EDIT_UPDATE_ZULIP_TTL))
+        METRICS.callback(
+            'bridge_cache_lookups_total',
+            'In-process cache lookups of slack users, bots and channels, by result.',
+            self._cache_metrics, ['cache', 'result'], metric_type='counter')
+        METRICS.callback(
+            'bridge_leader',
+            'Whether this copy of the bridge is relaying (always 1 without LEADER_ELECTION).',
+            lambda: {(): int(self.leader.is_leader or not LEADER_ELECTION)})
+        if METRICS_PORT:
+            self.metrics_server = metrics.start_metrics_server(METRICS, METRICS_PORT)
 
         _LOGGER.debug('connecting to zulip')
         self.zulip_client = zulip.Client(email=ZULIP_BOT_EMAIL,
                                          api_key=ZULIP_API_KEY,
                                          site=ZULIP_URL)
-        self.zulip_thread = threading.Thread(target=self.run_zulip_listener)
-        self.zulip_thread.setDaemon(True)
-        self.zulip_thread.start()
-#        self.zulip_ev_thread = threading.Thread(target=self.run_zulip_ev)
-#        self.zulip_ev_thread.setDaemon(True)
-#        self.zulip_ev_thread.start()
+
+        # The slack loop (and the zulip dispatcher on it) need to exist before
+        # any of the listener threads can hand work to them.
+        self.slack_loop = asyncio.new_event_loop()
+        self.zulip_dispatcher = outbound.KeyedDispatcher(
+            self.slack_loop, workers=ZULIP_SEND_WORKERS,
+            max_pending=ZULIP_SEND_MAX_PENDING, name='zulip-send')
+        self.slack_loop.run_until_complete(self.zulip_dispatcher.start())
+
+        _LOGGER.debug('connecting to slack')
+        self.slack_rtm_client = slack.RTMClient(token=SLACK_TOKEN,
+                                                run_async=True,
+                                                base_url=SLACK_API_URL,
+                                                loop=self.slack_loop)
+        self.slack_web_client = slack.WebClient(token=SLACK_TOKEN,
+                                                run_async=True,
+                                                base_url=SLACK_API_URL,
+                                                loop=self.slack_loop)
+
+        self.groupme_sender = groupme_sender.GroupMeSender(
+            self.slack_loop, api_url=GROUPME_API_URL,
+            max_pending=GROUPME_SEND_MAX_PENDING,
+            max_connections=GROUPME_SEND_MAX_CONNECTIONS,
+            timeout=GROUPME_SEND_TIMEOUT,
+            max_retries=GROUPME_SEND_MAX_RETRIES,
+            observe_post=lambda seconds: SEND_SECONDS.observe(seconds,
+                                                              destination='groupme'))
+        self.slack_loop.run_until_complete(self.groupme_sender.start())
+
+        self.slack_edits = debounce.Debouncer(
+            self.slack_loop, delay=SLACK_EDIT_DEBOUNCE,
+            max_delay=SLACK_EDIT_MAX_DEBOUNCE,
+            on_superseded=lambda key: EDITS_SUPERSEDED.inc())
+
+        self.file_bridge = file_bridge.SlackFileBridge(
+            SLACK_TOKEN, self.zulip_client,
+            max_file_size=FILE_BRIDGE_MAX_SIZE,
+            max_workers=FILE_BRIDGE_WORKERS,
+            redis_client=self.redis,
+            cache_key_prefix=REDIS_FILE_MIRROR,
+            cache_ttl=FILE_MIRROR_CACHE_TTL)
 
         self.user_formatter = slack_reformat.SlackUserFormatter(
             lambda user_id: self.get_slack_user(user_id, web_client=self.slack_web_client))
 
+        slack.RTMClient.run_on(event='message')(self.receive_slack_msg)
+
+        self.slack_log_formatter = logging.Formatter(bridge_logging.SLACK_FORMAT)
+        self.slack_logger = bridge_logging.SlackHandler(
+            self.slack_web_client,
+            self.slack_loop,
+            SLACK_ERR_CHANNEL,
+            flush_interval=SLACK_ERR_FLUSH_INTERVAL,
+            max_batch=SLACK_ERR_MAX_BATCH)
+        self.slack_logger.setLevel(logging.INFO)
+        self.slack_logger.setFormatter(self.slack_log_formatter)
+
+    def run(self):
+        '''Starts the zulip and groupme listeners, and runs the slack loop until
+           the RTM connection ends.
+
+           With LEADER_ELECTION, first stands by until elected leader, and exits
+           if the lease is lost.'''
+        logging.getLogger('').addHandler(self.slack_logger)
+        self.slack_loop.create_task(self.slack_logger.run())
+        if not LEADER_ELECTION:
+            self.start_listeners()
+            self.slack_loop.run_until_complete(self.warm_identity_caches())
+            self.start_relaying()
+            self.slack_loop.run_until_complete(self.slack_rtm_client.start())
+            self.slack_loop.run_until_complete(self.slack_edits.flush())
+            return
+
+        # Exit cleanly on SIGTERM (e.g. from systemctl stop), so that the lease
+        # is released below and a standby takes over straight away.
+        if threading.current_thread() is threading.main_thread():
+            self.slack_loop.add_signal_handler(signal.SIGTERM, sys.exit)
+        lost = None
+        try:
+            self.slack_loop.run_until_complete(self.stand_by())
+            lost = self.slack_loop.create_task(self.leader.hold())
+            self.start_listeners()
+            self.start_relaying()
+            relaying = asyncio.ensure_future(self.slack_rtm_client.start(),
+                                             loop=self.slack_loop)
+            self.slack_loop.run_until_complete(asyncio.wait(
+                [relaying, lost], return_when=asyncio.FIRST_COMPLETED))
+            if lost.done():
+                # Another copy may be relaying already.  Stop before anything is
+                # sent twice; systemd restarts us as a standby.
+                raise SystemExit('lost the leader lease')
+            relaying.result()
+        finally:
+            if lost is not None and not lost.done():
+                # Relay the slack edits and deletes still being debounced, as
+                # they are not in the outbox for the next leader to send.
+                self.slack_loop.run_until_complete(self.slack_edits.flush())
+            self.slack_loop.run_until_complete(self.leader.release())
+
+    async def stand_by(self):
+        '''Waits until elected leader, keeping the identity caches (and the
+           connections behind them) warm meanwhile.'''
+        _LOGGER.info('standing by as %s', self.leader.holder)
+
+        async def keep_warm():
+            known_only = False
+            while True:
+                await self.warm_identity_caches(known_only=known_only)
+                # Later warm-ups must not mark users who joined meanwhile as
+                # known, or they would never be welcomed.
+                known_only = True
+                await asyncio.sleep(STANDBY_REWARM_INTERVAL)
+
+        warming = self.slack_loop.create_task(keep_warm())
+        try:
+            await self.leader.wait_until_elected()
+        finally:
+            warming.cancel()
+
+    def start_relaying(self):
+        '''Resends whatever is left in the outbox (e.g. by a previous leader),
+           and starts retrying failed sends.'''
+        self.slack_loop.run_until_complete(self.replay_outbox())
+        self.slack_loop.create_task(self.run_outbox_retries())
+
+    def start_listeners(self):
+        '''Starts receiving from zulip and groupme.'''
+        self.zulip_thread = threading.Thread(target=self.run_zulip_listener)
+        self.zulip_thread.setDaemon(True)
+        self.zulip_thread.start()
+
         if GROUPME_ENABLE:
             _LOGGER.debug('connecting to groupmes')
-            self.groupme_threads = {}
-            for channel, conf in GROUPME_TWO_WAY.items():
-                self.groupme_threads[channel] = threading.Thread(
-                    target=self.run_groupme_listener, args=(channel, conf))
-                self.groupme_threads[channel].setDaemon(True)
-                self.groupme_threads[channel].start()
-
-        @slack.RTMClient.run_on(event='message')
-        async def receive_slack_msg(**payload):
+            self.groupme_ssl_context = None
+            if SSL_CERT_CHAIN_PATH:
+                self.groupme_ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                self.groupme_ssl_context.load_cert_chain(SSL_CERT_CHAIN_PATH,
+                                                         SSL_CERT_KEY_PATH)
+            self.groupme_ingress = groupme_ingress.GroupMeIngress(
+                self.slack_loop, GROUPME_TWO_WAY, self.send_from_groupme,
+                ssl_context=self.groupme_ssl_context,
+                workers=GROUPME_INGRESS_WORKERS,
+                max_pending=GROUPME_INGRESS_MAX_PENDING)
+            self.slack_loop.run_until_complete(
+                self.groupme_ingress.start(GROUPME_INGRESS_PORT or None))
+
+    async def receive_slack_msg(self, **payload):
+        data = payload['data']
+        # Identifies this event (rather than the message it is about), so
+        # the sends relaying it are never made twice, and tags the logs about it.
+        message_key = 'slack:%s:%s' % (data.get('channel'), data.get('ts'))
+        correlation = bridge_logging.correlation_id.set(message_key)
+        try:
             _LOGGER.debug('caught slack message')
-            _LOGGER.debug('JSON: %s' % json.dumps(payload['data']))
-            try:
-                data = payload['data']
-                web_client = payload['web_client']
-                rtm_client = payload['rtm_client']
-                bot = False
-                edit = False
-                delete = False
-                me = False
-                attachments = []
-                files = []
-
-                if ('subtype' in data and
-                      data['subtype'] == 'message_changed'):
-                    data.update(data['message'])
-                    edit = True
-                elif ('subtype' in data and
-                      data['subtype'] == 'message_deleted'):
-                    data.update(data['previous_message'])
-                    delete = True
-
-                if ('subtype' in data and
-                        data['subtype'] == 'message_replied'):
-                    return
+            _LOGGER.debug('JSON: %s', bridge_logging.LazyJson(data))
+            MESSAGES_RECEIVED.inc(source='slack')
+            received = time.monotonic()
+            relay = functools.partial(self.relay_slack_msg, payload,
+                                      message_key, received)
+            subtype = data.get('subtype')
+            if subtype == 'message_changed':
+                self.slack_edits.submit(
+                    (data.get('channel'), data['message'].get('ts')), relay)
+            elif subtype == 'message_deleted':
+                # Replaces any edit still waiting, which would be wasted.
+                self.slack_edits.submit(
+                    (data.get('channel'), data.get('deleted_ts')), relay,
+                    final=True)
+            else:
+                await relay()
+        finally:
+            bridge_logging.correlation_id.reset(correlation)
+
+    async def relay_slack_msg(self, payload, message_key, received):
+        '''Relays a slack message event (received at time.monotonic() received)
+           to zulip and groupme.'''
+        data = payload['data']
+        started = time.monotonic()
+        try:
+            web_client = payload['web_client']
+            rtm_client = payload['rtm_client']
+            bot = False
+            edit = False
+            delete = False
+            me = False
+            attachments = []
+            files = []
+
+            if ('subtype' in data and
+                  data['subtype'] == 'message_changed'):
+                data.update(data['message'])
+                edit = True
+            elif ('subtype' in data and
+                  data['subtype'] == 'message_deleted'):
+                data.update(data['previous_message'])
+                delete = True
+
+            if ('subtype' in data and
+                    data['subtype'] == 'message_replied'):
+                return
 
-                # This needs to be below the handling of message_changed and
-                # message_deleted as the message might be replaced with a
-                # bot_message.
-                if (('subtype' in data and data['subtype'] == 'bot_message') or
-                        ('bot_id' in data and 'user' not in data)):
-                    bot_id = data['bot_id']
+            # This needs to be below the handling of message_changed and
+            # message_deleted as the message might be replaced with a
+            # bot_message.
+            if (('subtype' in data and data['subtype'] == 'bot_message') or
+                    ('bot_id' in data and 'user' not in data)):
+                bot_id = data['bot_id']
+                with STAGE_SECONDS.time(stage='slack_lookup'):
                     user_id = await self.get_slack_bot(bot_id,
                                                        web_client=web_client)
 
-                    if not user_id:
-                        _LOGGER.debug("no bot found")
-                        return
-                    if user_id == SLACK_BOT_ID:
-                        _LOGGER.debug("oops that's my message!")
-                        return
-                    bot = True
+                if not user_id:
+                    _LOGGER.debug("no bot found")
+                    return
+                if user_id == SLACK_BOT_ID:
+                    _LOGGER.debug("oops that's my message!")
+                    return
+                bot = True
 
-                if not bot:
-                    user_id = data['user']
+            if not bot:
+                user_id = data['user']
 
-                channel_id = data['channel']
-                thread_ts = data['ts']
+            channel_id = data['channel']
+            thread_ts = data['ts']
 
+            with STAGE_SECONDS.time(stage='slack_lookup'):
                 user = await self.get_slack_user(user_id,
                                                  web_client=web_client)
                 if not user:
@@ -191,173 +537,286 @@ class SlackBridge():
                 if not channel:
                     return
 
-                # Clean up formatting of message before we forward it.
-                # This does not deal with attachments,
-                # which are dealt with in a per-service way.
+            # Clean up formatting of message before we forward it.
+            # This does not deal with attachments,
+            # which are dealt with in a per-service way.
+            with STAGE_SECONDS.time(stage='reformat'):
                 data['text'] = \
                     await slack_reformat.reformat_slack_text(self.user_formatter,
                                                              data['text'])
 
-                if (channel['type'] == 'channel' or
-                        channel['type'] == 'private-channel'):
-                    msg = data['text']
-                    channel_name = channel['name']
-                    private = (channel['type'] == 'private-channel')
-                    if ('subtype' in data and
-                            data['subtype'] in GROUP_UPDATES):
-                        msg_id = None
-                        user = None
-                    elif ('subtype' in data and
-                          data['subtype'] == 'me_message'):
-                        msg_id = None
-                        me = True
-                        if 'edited' in data:
-                            edit = True
-                    elif 'client_msg_id' in data:
-                        msg_id = data['client_msg_id']
-                    elif 'bot_id' in data:
-                        msg_id = None
-                    else:
-                        msg_id = None
-                        _LOGGER.warning("no msg id for user %s: %s", user,
-                                        data)
-
-                    if 'attachments' in data:
-                        attachments = data['attachments']
-
-                    if 'files' in data:
-                        files = data['files']
-
-                    # TODO: When real support for 'files' is implemented,
-                    # it should probably be in the format_attachments_for_zulip
-                    # call.
-
-            #        if 'files' in data:
-            #            for file in data['files']:
-            #                web_client.files_sharedPublicURL(id=file['id'])
-            #                if msg == '':
-            #                    msg = file['permalink_public']
-            #                else:
-            #                    msg += '\n' + file['permalink_public']
-
+            if (channel['type'] == 'channel' or
+                    channel['type'] == 'private-channel'):
+                msg = data['text']
+                channel_name = channel['name']
+                private = (channel['type'] == 'private-channel')
+                if ('subtype' in data and
+                        data['subtype'] in GROUP_UPDATES):
+                    msg_id = None
+                    user = None
+                elif ('subtype' in data and
+                      data['subtype'] == 'me_message'):
+                    msg_id = None
+                    me = True
+                    if 'edited' in data:
+                        edit = True
+                elif 'client_msg_id' in data:
+                    msg_id = data['client_msg_id']
+                elif 'bot_id' in data:
+                    msg_id = None
+                else:
+                    msg_id = None
+                    _LOGGER.warning("no msg id for user %s: %s", user,
+                                    data)
+
+                if 'attachments' in data:
+                    attachments = data['attachments']
+
+                if 'files' in data:
+                    files = data['files']
+
+                # TODO: When real support for 'files' is implemented,
+                # it should probably be in the format_attachments_for_zulip
+                # call.
+
+        #        if 'files' in data:
+        #            for file in data['files']:
+        #                web_client.files_sharedPublicURL(id=file['id'])
+        #                if msg == '':
+        #                    msg = file['permalink_public']
+        #                else:
+        #                    msg += '\n' + file['permalink_public']
+
+                with STAGE_SECONDS.time(stage='attachments'):
                     formatted_attachments = \
                         await slack_reformat.format_attachments_from_slack(
                             msg, attachments,
                             edit or delete, self.user_formatter)
 
-                    # Assumes that both markdown and plaintext need a newline together.
-                    needs_leading_newline = \
-                        (len(msg) > 0 or len(formatted_attachments['markdown']) > 0)
-                    formatted_files = slack_reformat.format_files_from_slack(
-                        files, needs_leading_newline, SLACK_TOKEN, self.zulip_client)
-
-                    zulip_message_text = \
-                        msg + formatted_attachments['markdown'] + formatted_files['markdown']
-
-                    if channel_name in PUBLIC_TWO_WAY:
-                        self.send_to_zulip(
-                            channel_name, zulip_message_text, user=user,
-                            send_public=True, slack_id=msg_id,
-                            edit=edit, delete=delete, me=me)
-
-                    # If we are not sending publicly, then we are sending for
-                    # logging purposes, which might be disabled.
-                    if ZULIP_LOG_ENABLE:
-                        self.send_to_zulip(
-                            channel_name, zulip_message_text, user=user,
-                            slack_id=msg_id, edit=edit,
-                            delete=delete, me=me, private=private)
-
-                    # If groupme is enabled, then send there.  Note that this
-                    # will also filter to only the GROUPME_TWO_WAY channels
-                    # within the send_to_groupme call.
-                    if GROUPME_ENABLE:
-                        groupme_message_text = \
-                            msg + formatted_attachments['plaintext'] + formatted_files['plaintext']
-
-                        self.send_to_groupme(
-                            channel_name, groupme_message_text, user=user,
-                            edit=edit, delete=delete, me=me)
-
-                elif channel['type'] == 'im':
-                    _LOGGER.debug('updating user display name')
-                    user = await self.get_slack_user(user_id,
-                                                     web_client=web_client,
-                                                     force_update=True)
-                    await self.slack_web_client.chat_postMessage(
-                        channel=channel_id,
-                        text="OK, I have updated your display name for Slack \
+                # Assumes that both markdown and plaintext need a newline together.
+                needs_leading_newline = \
+                    (len(msg) > 0 or len(formatted_attachments['markdown']) > 0)
+                with STAGE_SECONDS.time(stage='file_transfer'):
+                    mirrored_uris = await self.file_bridge.mirror_files(files)
+                formatted_files = slack_reformat.format_files_from_slack(
+                    files, needs_leading_newline,
+                    mirrored_uris=mirrored_uris)
+
+                zulip_message_text = \
+                    msg + formatted_attachments['markdown'] + formatted_files['markdown']
+
+                routes = self.routes.routes('slack', channel_id)
+                sends = []
+                for topic in routes['zulip']:
+                    sends.append(self.zulip_send(
+                        topic, zulip_message_text, user=user,
+                        send_public=True, slack_id=msg_id,
+                        edit=edit, delete=delete, me=me, key=message_key))
+
+                # If we are not sending publicly, then we are sending for
+                # logging purposes, which might be disabled.
+                if ZULIP_LOG_ENABLE:
+                    sends.append(self.zulip_send(
+                        channel_name, zulip_message_text, user=user,
+                        slack_id=msg_id, edit=edit,
+                        delete=delete, me=me, private=private,
+                        key=message_key))
+
+                # Send to the groupme bots bridged with the channel, if any.
+                if routes['groupme']:
+                    groupme_message_text = \
+                        msg + formatted_attachments['plaintext'] + formatted_files['plaintext']
+
+                for bot in routes['groupme']:
+                    sends.append(self.groupme_send(
+                        bot, groupme_message_text, user=user,
+                        edit=edit, delete=delete, me=me, key=message_key))
+
+                await self.queue_sends(sends, received=received)
+
+            elif channel['type'] == 'im':
+                _LOGGER.debug('updating user display name')
+                user = await self.get_slack_user(user_id,
+                                                 web_client=web_client,
+                                                 force_update=True)
+                await self.slack_web_client.chat_postMessage(
+                    channel=channel_id,
+                    text="OK, I have updated your display name for Slack \
 messgaes on Zulip. Your name is now seen as: *" + user + "*.",
-                        mrkdwn=True
-                    )
-                elif channel['type'] == 'group':
-                    await self.slack_web_client.chat_postMessage(
-                        channel=channel_id,
-                        text="I'm not sure what I'm doing here, so I'll just \
+                    mrkdwn=True
+                )
+            elif channel['type'] == 'group':
+                await self.slack_web_client.chat_postMessage(
+                    channel=channel_id,
+                    text="I'm not sure what I'm doing here, so I'll just \
 be annoying.",
-                        mrkdwn=True
-                    )
-            except:
-                e = sys.exc_info()
-                exc_type, exc_value, exc_traceback = e
-                _LOGGER.error('Error receive slack message: %s, %s',
-                              repr(traceback.format_exception(exc_type,
-                                                              exc_value,
-                                                              exc_traceback)),
-                              data)
-
-
-        _LOGGER.debug('connecting to slack')
-        self.slack_loop = asyncio.new_event_loop()
-        self.slack_rtm_client = slack.RTMClient(token=SLACK_TOKEN,
-                                                run_async=True,
-                                                loop=self.slack_loop)
-        self.slack_web_client = slack.WebClient(token=SLACK_TOKEN,
-                                                run_async=True,
-                                                loop=self.slack_loop)
-        self.slack_log_format = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
-        self.slack_log_formatter = logging.Formatter(self.slack_log_format)
-        self.slack_logger = SlackHandler(self.slack_web_client,
-                                         self.slack_loop,
-                                         SLACK_ERR_CHANNEL)
-        self.slack_logger.setLevel(logging.INFO)
-        self.slack_logger.setFormatter(self.slack_log_formatter)
-        logging.getLogger('').addHandler(self.slack_logger)
-        self.slack_loop.run_until_complete(self.slack_rtm_client.start())
+                    mrkdwn=True
+                )
+        except:
+            _LOGGER.error('Error receive slack message: %s',
+                          bridge_logging.LazyJson(data), exc_info=True)
+        finally:
+            STAGE_SECONDS.observe(time.monotonic() - started,
+                                  stage='receive')
+
+    def run_on_slack_loop(self, coro, description):
+        '''Runs coro on the slack loop from any other thread, waking the loop up
+           immediately.  Failures are logged using description.
+
+           Returns a concurrent.futures.Future for the result of coro.'''
+        future = asyncio.run_coroutine_threadsafe(coro, self.slack_loop)
+
+        def log_failure(f):
+            if not f.cancelled() and f.exception() is not None:
+                _LOGGER.error('Error %s: %s', description, repr(f.exception()))
+        future.add_done_callback(log_failure)
+        return future
+
+    def wait_for_slack_loop(self, future, description, timeout=SLACK_POST_TIMEOUT):
+        '''Waits up to timeout seconds for a future from run_on_slack_loop.
+
+           Returns its result, or None if it failed (which run_on_slack_loop will
+           already have logged) or timed out.'''
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            _LOGGER.error('Timed out %s', description)
+        except Exception:
+            pass
+        return None
+
+    async def post_to_slack(self, method='chat_postMessage', **kwargs):
+        '''A slack web API call (chat_postMessage by default), awaited on the
+           slack loop and timed for the metrics.  Pass this, not the web client
+           call itself, to run_on_slack_loop: with run_async the client schedules
+           the call on the loop as soon as it is made, from whichever thread made
+           it, and returns a future rather than a coroutine.'''
+        with SEND_SECONDS.time(destination='slack'):
+            return await getattr(self.slack_web_client, method)(**kwargs)
 
     def send_from_zulip(self, msg):
         _LOGGER.debug('caught zulip message')
-        _LOGGER.debug('JSON: %s' % json.dumps(msg))
+        _LOGGER.debug('JSON: %s', bridge_logging.LazyJson(msg))
+        MESSAGES_RECEIVED.inc(source='zulip')
+        received = time.monotonic()
         try:
-            if (msg['subject'] in PUBLIC_TWO_WAY and
+            routes = self.routes.routes('zulip', msg['subject'])
+            if (any(routes.values()) and
                     msg['sender_email'] != ZULIP_BOT_EMAIL):
                 _LOGGER.debug('good to send zulip message to slack')
-                asyncio.ensure_future(
-                    self.slack_web_client.chat_postMessage(
-                        channel=msg['subject'],
-                        text=('*' + msg['sender_full_name'] + "*: " +
-                              msg['content']),
-                        mrkdwn=True
-                        # thread_ts=thread_ts
-                    ), loop=self.slack_loop)
-                if GROUPME_ENABLE:
-                    self.send_to_groupme(msg['subject'], msg['content'],
-                                         user=msg['sender_full_name'])
+                message_key = 'zulip:%s' % msg['id']
+                sends = [self.slack_send(
+                            channel=channel,
+                            text=('*' + msg['sender_full_name'] + "*: " +
+                                  msg['content']),
+                            mrkdwn=True,
+                            # thread_ts=thread_ts,
+                            key=message_key,
+                            zulip_id=msg['id'],
+                            sender=msg['sender_full_name'])
+                         for channel in routes['slack']]
+                sends += [self.groupme_send(bot, msg['content'],
+                                            user=msg['sender_full_name'],
+                                            key=message_key)
+                          for bot in routes['groupme']]
+                futures = self.queue_sends_threadsafe(sends, source='zulip',
+                                                      received=received)
+                # Wait for the posts so that messages in a topic reach slack
+                # in the order they were sent on zulip.
+                for slack_future in futures[:len(routes['slack'])]:
+                    self.wait_for_slack_loop(slack_future,
+                                             'send zulip message to slack')
         except:
-            e = sys.exc_info()
-            exc_type, exc_value, exc_traceback = e
-            _LOGGER.error('Error send slack message: %s',
-                          repr(traceback.format_exception(exc_type,
-                                                          exc_value,
-                                                          exc_traceback)))
+            _LOGGER.error('Error send slack message', exc_info=True)
+
+    def get_slack_posts(self, zulip_id):
+        '''Returns the slack messages (dicts of channel, ts and sender) that the
+           zulip message zulip_id was sent as, one per channel.'''
+        posts = self.slack_post_cache.get(zulip_id)
+        if posts is None:
+            # Keyed by 'slack:<channel id>'.
+            posts = self.zulip_msg_ids.get(str(zulip_id))
+        return list(posts.values())
+
+    def update_from_zulip(self, event):
+        MESSAGES_RECEIVED.inc(source='zulip')
+        received = time.monotonic()
+        try:
+            if 'content' not in event:
+                # Only the topic (or the rendering) changed.
+                return
+            posts = self.get_slack_posts(event['message_id'])
+            if not posts:
+                _LOGGER.debug('zulip message %s was not sent to slack',
+                              event['message_id'])
+                return
+            _LOGGER.debug('good to send zulip edit to slack')
+            message_key = 'zulip:%s:edit:%s' % (event['message_id'],
+                                                event.get('edit_timestamp'))
+            futures = self.queue_sends_threadsafe([
+                self.slack_send(
+                    method='chat_update',
+                    channel=posted['channel'],
+                    ts=posted['ts'],
+                    text='*' + posted['sender'] + "*: " + event['content'],
+                    key=message_key)
+                for posted in posts], source='zulip', received=received)
+            for future in futures:
+                self.wait_for_slack_loop(future, 'send zulip edit to slack')
+        except:
+            _LOGGER.error('Error send slack edit', exc_info=True)
 
-    def run_zulip_listener(self):
-        self.zulip_client.call_on_each_message(self.send_from_zulip)
+    def delete_from_zulip(self, event):
+        MESSAGES_RECEIVED.inc(source='zulip')
+        received = time.monotonic()
+        try:
+            # Newer servers send deletes in bulk.
+            sends = []
+            for zulip_id in event.get('message_ids', [event.get('message_id')]):
+                for posted in self.get_slack_posts(zulip_id):
+                    sends.append(self.slack_send(
+                        method='chat_delete',
+                        channel=posted['channel'],
+                        ts=posted['ts'],
+                        key='zulip:%s:delete' % zulip_id))
+            if sends:
+                _LOGGER.debug('good to send zulip delete to slack')
+                self.queue_sends_threadsafe(sends, source='zulip',
+                                            received=received)
+        except:
+            _LOGGER.error('Error send slack delete', exc_info=True)
+
+    def receive_zulip_event(self, event):
+        if event['type'] == 'message':
+            message_id = event['message']['id']
+        else:
+            message_id = event.get('message_id')
+        with bridge_logging.correlation(
+                'zulip:%s' % message_id if message_id else None):
+            if event['type'] == 'message':
+                self.send_from_zulip(event['message'])
+            elif event['type'] == 'update_message':
+                self.update_from_zulip(event)
+            elif event['type'] == 'delete_message':
+                self.delete_from_zulip(event)
 
-#    def run_zulip_ev(self):
-#        self.zulip_client.call_on_each_event(lambda event: sys.stdout.write(str(event) + "\n"))
+    def run_zulip_listener(self):
+        self.zulip_events = zulip_events.ZulipEventQueue(
+            self.zulip_client, self.redis, REDIS_ZULIP_EVENT_QUEUE,
+            ZULIP_EVENT_TYPES, ZULIP_EVENT_NARROW)
+        self.zulip_events.run(self.receive_zulip_event)
 
     def send_from_groupme(self, channel, conf, post_data):
+        # GroupMe's id for the message, if it sent one.
+        message_key = None
+        if post_data.get('id'):
+            message_key = 'groupme:%s' % post_data['id']
+        with bridge_logging.correlation(message_key):
+            self._send_from_groupme(channel, conf, post_data, message_key)
+
+    def _send_from_groupme(self, channel, conf, post_data, message_key):
+        MESSAGES_RECEIVED.inc(source='groupme')
+        received = time.monotonic()
         if post_data['name'] != conf['BOT_NAME']:
             _LOGGER.debug('good to send groupme message to slack')
             message_text = post_data['text']
@@ -371,34 +830,28 @@ be annoying.",
                                                    attachment['url'])
                     break
 
+            routes = self.routes.routes('groupme', channel)
             slack_text = f"*{user}*: {message_text}"
-            asyncio.ensure_future(
-                self.slack_web_client.chat_postMessage(
-                    channel=channel,
-                    text=slack_text,
-                    mrkdwn=True
-                    # thread_ts=thread_ts
-                ), loop=self.slack_loop)
-            if channel in PUBLIC_TWO_WAY:
-                self.send_to_zulip(channel, message_text, user=user,
-                                   send_public=True)
-            channel_id = self.get_slack_channel_by_name(channel)
-            if channel_id is not None:
-                channel_obj = self.get_slack_channel_sync(channel_id)
-                if channel_obj:
-                    channel_type = channel_obj['type']
-                    private = (channel_type == 'private-channel')
-                    self.send_to_zulip(channel, message_text, user=user,
-                                       private=private)
-
-    def run_groupme_listener(self, channel, conf):
-        server_address = ('', conf['BOT_PORT'])
-        HandlerClass = make_groupme_handler(channel, conf,
-                                            self.send_from_groupme)
-        httpd = ThreadingHTTPServer(server_address, HandlerClass)
-        _LOGGER.debug('listening http for groupme bot: %s', channel)
-        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
-        httpd.serve_forever()
+            sends = [self.slack_send(channel=slack_channel,
+                                     text=slack_text,
+                                     mrkdwn=True,
+                                     # thread_ts=thread_ts,
+                                     key=message_key)
+                     for slack_channel in routes['slack']]
+            for topic in routes['zulip']:
+                sends.append(self.zulip_send(topic, message_text,
+                                             user=user, send_public=True,
+                                             key=message_key))
+            # Logged as if sent in each slack channel it is relayed to.
+            for slack_channel in routes['slack']:
+                channel_obj = self.get_bridged_slack_channel(slack_channel)
+                if channel_obj is not None:
+                    sends.append(self.zulip_send(channel_obj['name'], message_text,
+                                                 user=user,
+                                                 private=channel_obj['private'],
+                                                 key=message_key))
+            self.queue_sends_threadsafe(sends, source='groupme',
+                                        received=received)
 
     async def new_slack_user(self, user_id, user, web_client=None):
         if web_client is None:
@@ -422,9 +875,31 @@ my records to use your new name when I forward messages to Zulip for you.",
             mrkdwn=True
         )
 
+    def _cache_metrics(self):
+        values = {}
+        for cache, stats in self.cache_stats().items():
+            values[(cache, 'hit')] = stats['hits']
+            values[(cache, 'miss')] = stats['misses']
+        return values
+
+    def cache_stats(self):
+        '''Returns the hit/miss counters of the in-process identity caches.'''
+        return {'users': self.user_cache.stats(),
+                'bots': self.bot_cache.stats(),
+                'channels': self.channel_cache.stats(),
+                'channels_by_name': self.channel_by_name_cache.stats()}
+
     async def get_slack_bot(self, bot_id, web_client=None, force_update=False):
+        if force_update:
+            self.bot_cache.invalidate(bot_id)
+        else:
+            ret_bot = self.bot_cache.get(bot_id)
+            if ret_bot is not None:
+                return ret_bot
         redis_key = REDIS_BOTS + bot_id
-        ret_bot = self.redis.get(redis_key)
+        ret_bot = await self.redis_async.get(redis_key)
+        REDIS_LOOKUPS.inc(kind='bot',
+                          result='miss' if ret_bot is None else 'hit')
         if ret_bot is None or force_update:
             _LOGGER.debug('fetching slack bot')
             if web_client is None:
@@ -435,13 +910,22 @@ my records to use your new name when I forward messages to Zulip for you.",
                 return False
             bot = res['bot']
             ret_bot = bot['user_id']
-            self.redis.set(redis_key, ret_bot)
+            await self.redis_async.set(redis_key, ret_bot)
+        self.bot_cache.set(bot_id, ret_bot)
         return ret_bot
 
     async def get_slack_user(self, user_id, web_client=None,
                              force_update=False):
+        if force_update:
+            self.user_cache.invalidate(user_id)
+        else:
+            ret_user = self.user_cache.get(user_id)
+            if ret_user is not None:
+                return ret_user
         redis_key = REDIS_USERS + user_id
-        ret_user = self.redis.get(redis_key)
+        ret_user = await self.redis_async.get(redis_key)
+        REDIS_LOOKUPS.inc(kind='user',
+                          result='miss' if ret_user is None else 'hit')
         if ret_user is None or force_update:
             _LOGGER.debug('fetching slack user')
             if web_client is None:
@@ -451,21 +935,138 @@ my records to use your new name when I forward messages to Zulip for you.",
                 _LOGGER.error('could not fetch user %s, %s', user_id,
                               repr(res))
                 return False
-            user = res['user']
-            if user['profile']['display_name'] == '':
-                ret_user = user['name']
-            else:
-                ret_user = user['profile']['display_name']
-            self.redis.set(redis_key, ret_user)
+            ret_user = self._slack_user_name(res['user'])
+            await self.redis_async.set(redis_key, ret_user)
             if not force_update:
                 await self.new_slack_user(user_id, ret_user,
                                           web_client=web_client)
+        self.user_cache.set(user_id, ret_user)
         return ret_user
 
+    @staticmethod
+    def _slack_user_name(user):
+        '''The name we show on zulip for a slack user object.'''
+        if user['profile']['display_name'] == '':
+            return user['name']
+        return user['profile']['display_name']
+
+    @staticmethod
+    def _slack_channel_record(channel):
+        '''What we store about a slack conversation object, or None if it is not
+           a channel, im or group.'''
+        if 'is_channel' in channel and channel['is_channel']:
+            return {
+                'type': 'channel',
+                'name': channel['name']
+            }
+        elif 'is_im' in channel and channel['is_im']:
+            return {
+                'type': 'im',
+                'user_id': channel['user']
+            }
+        elif ('is_group' in channel and channel['is_group'] and
+              'is_mpim' in channel and not channel['is_mpim']):
+            return {
+                'type': 'private-channel',
+                'name': channel['name']
+            }
+        elif 'is_group' in channel and channel['is_group']:
+            return {
+                'type': 'group',
+                'name': channel['name']
+            }
+        return None
+
+    async def _slack_list_pages(self, web_client, method, field, **kwargs):
+        '''Yields each page of field from the paginated slack list method,
+           waiting out rate limits.'''
+        cursor = None
+        while True:
+            if cursor:
+                kwargs['cursor'] = cursor
+            try:
+                res = await getattr(web_client, method)(
+                    limit=IDENTITY_WARMUP_PAGE_SIZE, **kwargs)
+            except slack.errors.SlackApiError as e:
+                if e.response.status_code != 429:
+                    raise
+                delay = int(e.response.headers.get('Retry-After', 1))
+                _LOGGER.debug('%s rate limited, waiting %d seconds', method, delay)
+                await asyncio.sleep(delay)
+                continue
+            yield res[field]
+            cursor = res.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+
+    async def warm_identity_caches(self, web_client=None, known_only=False):
+        '''Fetches every slack user and channel in bulk, and stores them in redis
+           and the identity caches as get_slack_user, get_slack_bot and
+           get_slack_channel would.  Users found this way count as already known,
+           so they are not sent the welcome message.
+
+           With known_only, only users already in redis are stored, so that
+           users who joined since the last warm-up are still welcomed when they
+           are first seen.'''
+        if web_client is None:
+            web_client = self.slack_web_client
+        users = channels = 0
+        try:
+            async for page in self._slack_list_pages(web_client, 'users_list',
+                                                     'members'):
+                pipe = self.redis_async.pipeline(transaction=False)
+                names = [(user['id'], self._slack_user_name(user))
+                         for user in page]
+                for user_id, name in names:
+                    pipe.set(REDIS_USERS + user_id, name, xx=known_only)
+                for user in page:
+                    bot_id = user['profile'].get('bot_id')
+                    if bot_id:
+                        pipe.set(REDIS_BOTS + bot_id, user['id'])
+                        self.bot_cache.set(bot_id, user['id'])
+                # The replies to the user sets come first.
+                stored = await pipe.execute()
+                for (user_id, name), was_stored in zip(names, stored):
+                    if was_stored:
+                        self.user_cache.set(user_id, name)
+                        users += 1
+
+            async for page in self._slack_list_pages(
+                    web_client, 'conversations_list', 'channels',
+                    types=IDENTITY_WARMUP_CONVERSATION_TYPES):
+                pipe = self.redis_async.pipeline(transaction=False)
+                for channel in page:
+                    record = self._slack_channel_record(channel)
+                    if record is None:
+                        continue
+                    pipe.hset(REDIS_CHANNELS + channel['id'], mapping=record)
+                    self.channel_cache.set(channel['id'], record)
+                    self.routes.learn_slack_channel(channel['id'], record)
+                    if record['type'] in ('channel', 'private-channel'):
+                        pipe.set(REDIS_CHANNELS_BY_NAME + record['name'],
+                                 channel['id'])
+                        self.channel_by_name_cache.set(record['name'],
+                                                       channel['id'])
+                await pipe.execute()
+                channels += len(page)
+        except Exception as e:
+            # Whatever was not fetched is looked up as it is needed instead.
+            _LOGGER.error('could not warm up the slack user and channel caches: %s',
+                          repr(e))
+        _LOGGER.info('warmed up %d slack users and %d channels', users, channels)
+
     async def get_slack_channel(self, channel_id, web_client=None,
                                 force_update=False):
+        if force_update:
+            self.channel_cache.invalidate(channel_id)
+        else:
+            ret_channel = self.channel_cache.get(channel_id)
+            if ret_channel is not None:
+                return ret_channel
         redis_key = REDIS_CHANNELS + channel_id
-        ret_channel = self.redis.hgetall(redis_key)
+        ret_channel = await self.redis_async.hgetall(redis_key)
+        REDIS_LOOKUPS.inc(kind='channel',
+                          result='hit' if ret_channel else 'miss')
         if ret_channel is None or not ret_channel or force_update:
             _LOGGER.debug('fetching slack channel')
             if web_client is None:
@@ -476,60 +1077,284 @@ my records to use your new name when I forward messages to Zulip for you.",
                               repr(res))
                 return False
             channel = res['channel']
-            if 'is_channel' in channel and channel['is_channel']:
-                _LOGGER.debug('found channel %s', channel_id)
-                ret_channel = {
-                    'type': 'channel',
-                    'name': channel['name']
-                }
-            elif 'is_im' in channel and channel['is_im']:
-                ret_channel = {
-                    'type': 'im',
-                    'user_id': channel['user']
-                }
-            elif ('is_group' in channel and channel['is_group'] and
-                  'is_mpim' in channel and not channel['is_mpim']):
-                ret_channel = {
-                    'type': 'private-channel',
-                    'name': channel['name']
-                }
-            elif 'is_group' in channel and channel['is_group']:
-                ret_channel = {
-                    'type': 'group',
-                    'name': channel['name']
-                }
-            else:
+            ret_channel = self._slack_channel_record(channel)
+            if ret_channel is None:
                 _LOGGER.warning('not a channel, im, or group for %s',
                                 channel_id)
                 return False
-            self.redis.hmset(redis_key, ret_channel)
+            pipe = self.redis_async.pipeline()
+            pipe.hset(redis_key, mapping=ret_channel)
             if (ret_channel['type'] == 'channel' or
                     ret_channel['type'] == 'private-channel'):
                 redis_key_by_name = REDIS_CHANNELS_BY_NAME + channel['name']
-                self.redis.set(redis_key_by_name, channel_id)
+                pipe.set(redis_key_by_name, channel_id)
+                self.channel_by_name_cache.set(channel['name'], channel_id)
+            await pipe.execute()
+        self.channel_cache.set(channel_id, ret_channel)
+        self.routes.learn_slack_channel(channel_id, ret_channel)
         return ret_channel
 
     def get_slack_channel_sync(self, channel_id):
+        ret_channel = self.channel_cache.get(channel_id)
+        if ret_channel is not None:
+            return ret_channel
         redis_key = REDIS_CHANNELS + channel_id
         ret_channel = self.redis.hgetall(redis_key)
         if ret_channel is None or not ret_channel:
             _LOGGER.warning('cannot fetch slack channel')
             return False
+        self.channel_cache.set(channel_id, ret_channel)
+        self.routes.learn_slack_channel(channel_id, ret_channel)
         return ret_channel
 
+    def get_bridged_slack_channel(self, channel):
+        '''Returns the id, name and privacy ('private') of the slack channel with
+           the given name or id, as learned by the routing table, or looked up
+           in redis if it has not been yet; or None.'''
+        channel_obj = self.routes.slack_channel(channel)
+        if channel_obj is None:
+            channel_id = self.get_slack_channel_by_name(channel) or channel
+            # Teaches the routing table about it.
+            self.get_slack_channel_sync(channel_id)
+            channel_obj = self.routes.slack_channel(channel)
+        return channel_obj
+
     def get_slack_channel_by_name(self, channel_name):
+        ret_channel_id = self.channel_by_name_cache.get(channel_name)
+        if ret_channel_id is not None:
+            return ret_channel_id
         redis_key = REDIS_CHANNELS_BY_NAME + channel_name
         ret_channel_id = self.redis.get(redis_key)
         if ret_channel_id is None:
             _LOGGER.warning('cannot get slack channel by name yet: %s',
                             channel_name)
+        else:
+            self.channel_by_name_cache.set(channel_name, ret_channel_id)
         return ret_channel_id
 
+    @staticmethod
+    def zulip_stream_for(send_public=False, private=False):
+        if send_public:
+            return PUBLIC_TWO_WAY_STREAM
+        elif private:
+            return ZULIP_LOG_PRIVATE_STREAM
+        return ZULIP_LOG_PUBLIC_STREAM
+
+    @staticmethod
+    def _observe_relay(future, source, received, destination):
+        if received is not None:
+            future.add_done_callback(
+                lambda f: RELAY_SECONDS.observe(time.monotonic() - received,
+                                                source=source,
+                                                destination=destination))
+        return future
+
+    @staticmethod
+    def _send_key(message_key, *destination):
+        '''The outbox key for relaying the message with message_key (if it has
+           one) to destination.'''
+        if message_key is None:
+            return None
+        return ':'.join((message_key,) + destination)
+
+    def zulip_send(self, subject, msg, key=None, **kwargs):
+        '''A send for queue_sends of send_to_zulip(subject, msg, **kwargs).  key
+           identifies the message being relayed.'''
+        to = self.zulip_stream_for(kwargs.get('send_public', False),
+                                   kwargs.get('private', False))
+        return ('zulip', dict(kwargs, subject=subject, msg=msg),
+                self._send_key(key, 'zulip', to, subject))
+
+    def slack_send(self, method='chat_postMessage', key=None, zulip_id=None,
+                   sender=None, **kwargs):
+        '''A send for queue_sends of a slack web API call, method(**kwargs).
+
+           For a message from zulip, zulip_id and sender are its id and sender's
+           name there, to remember it by for applying zulip edits and deletes.'''
+        payload = {'method': method, 'args': kwargs}
+        if zulip_id is not None:
+            payload['zulip_id'] = zulip_id
+            payload['sender'] = sender
+        return ('slack', payload, self._send_key(key, 'slack', kwargs['channel']))
+
+    def _send_zulip_entry(self, entry):
+        payload = dict(entry['payload'])
+        with SEND_SECONDS.time(destination='zulip'):
+            return self.send_to_zulip(payload.pop('subject'), payload.pop('msg'),
+                                      **payload)
+
+    async def _post_slack_entry(self, payload):
+        '''Makes the call for a slack send.  Returns whether it was made: for a
+           message from zulip, as the slack message it was posted as.'''
+        try:
+            res = await self.post_to_slack(payload['method'], **payload['args'])
+        except slack.errors.SlackApiError as e:
+            if e.response.get('error') == 'message_not_found':
+                # Edited or deleted on slack already; there is nothing to do.
+                _LOGGER.warning('slack message to %s is gone', payload['method'])
+                return True
+            _LOGGER.error('Error send slack message: %s', repr(e))
+            return False
+        except Exception as e:
+            _LOGGER.error('Error send slack message: %s', repr(e))
+            return False
+        if 'zulip_id' not in payload:
+            return True
+        posted = {'channel': res['channel'], 'ts': res['ts'],
+                  'sender': payload['sender']}
+        # Remembered here for edits and deletes that follow closely; it is
+        # stored in redis along with the outcome of the send.
+        posts = dict(self.slack_post_cache.get(payload['zulip_id']) or {})
+        posts['slack:' + res['channel']] = posted
+        self.slack_post_cache.set(payload['zulip_id'], posts)
+        return posted
+
+    async def _dispatch(self, entry):
+        '''Hands an outbox entry to the sender for its kind.  Must be awaited on
+           the slack loop.  Returns once it is queued, with an asyncio future
+           resolving to the sender's result.'''
+        payload = entry['payload']
+        if entry['kind'] == 'zulip':
+            to = self.zulip_stream_for(payload.get('send_public', False),
+                                       payload.get('private', False))
+            return await self.zulip_dispatcher.submit((to, payload['subject']),
+                                                      self._send_zulip_entry, entry)
+        if entry['kind'] == 'groupme':
+            return self.groupme_sender.enqueue(payload['bot_id'], payload['text'])
+        return asyncio.ensure_future(self._post_slack_entry(payload))
+
+    async def _finish_when_sent(self, dispatched):
+        '''Waits for every dispatched (entry, future) to be done, then records
+           the outcomes, and the ids of the messages sent to zulip and slack (for
+           edits and deletes), in one redis round trip.'''
+        results = await asyncio.gather(*[future for _, future in dispatched],
+                                       return_exceptions=True)
+        outcomes = []
+        # slack id -> 'zulip stream/topic' -> zulip id
+        zulip_ids = collections.defaultdict(dict)
+        # zulip id -> 'slack:<channel id>' -> slack message
+        slack_posts = collections.defaultdict(dict)
+        for (entry, _), result in zip(dispatched, results):
+            if isinstance(result, Exception):
+                _LOGGER.error('Error send %s message: %s', entry['kind'], repr(result))
+                result = False
+            outcomes.append((entry, bool(result)))
+            payload = entry['payload']
+            if (entry['kind'] == 'zulip' and not isinstance(result, bool) and
+                    payload.get('slack_id') is not None and not payload.get('delete')):
+                to = self.zulip_stream_for(payload.get('send_public', False),
+                                           payload.get('private', False))
+                zulip_ids[payload['slack_id']]['%s/%s' % (to, payload['subject'])] = \
+                    str(result)
+            elif entry['kind'] == 'slack' and isinstance(result, dict):
+                slack_posts[str(payload['zulip_id'])]['slack:' + result['channel']] = result
+        pipe = self.redis_async.pipeline()
+        for slack_id, ids in zulip_ids.items():
+            self.msg_ids.set(pipe, slack_id, ids)
+        for zulip_id, posts in slack_posts.items():
+            self.zulip_msg_ids.set(pipe, zulip_id, posts)
+        await self.outbox.finish_many(outcomes, pipe)
+
+    async def _dispatch_all(self, entries, source=None, received=None):
+        futures = []
+        dispatched = []
+        for entry in entries:
+            if entry is None:
+                # Already sent.
+                future = self.slack_loop.create_future()
+                future.set_result(True)
+            else:
+                future = await self._dispatch(entry)
+                dispatched.append((entry, future))
+                self._observe_relay(future, source, received, entry['kind'])
+            futures.append(future)
+        if dispatched:
+            asyncio.ensure_future(self._finish_when_sent(dispatched))
+        return futures
+
+    async def queue_sends(self, sends, source='slack', received=None):
+        '''Records the sends relaying one message in the outbox and queues them.
+           Must be awaited on the slack loop.  Returns once they are queued, with
+           an asyncio future for each send resolving to whether it was sent.
+
+           sends are made by zulip_send, groupme_send and slack_send; any that are
+           None are skipped.  They are recorded in the outbox together, and
+           finished together once they are all done, so that relaying a message
+           costs two redis round trips however many places it goes.
+
+           received is the time.monotonic() at which the message arrived from
+           source, for the relay latency metrics.'''
+        sends = [send for send in sends if send is not None]
+        entries = await self.outbox.append_many(sends)
+        return await self._dispatch_all(entries, source, received)
+
+    def queue_sends_threadsafe(self, sends, source='slack', received=None):
+        '''As queue_sends, but for use from threads other than the slack loop.
+           Returns a concurrent.futures.Future for each send.'''
+        sends = [send for send in sends if send is not None]
+        entries = self.outbox.append_many_sync(sends)
+        results = [concurrent.futures.Future() for _ in entries]
+
+        def copy_result(future, result):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        async def dispatch():
+            try:
+                futures = await self._dispatch_all(entries, source, received)
+            except Exception as e:
+                for result in results:
+                    result.set_exception(e)
+                raise
+            for future, result in zip(futures, results):
+                future.add_done_callback(lambda f, result=result: copy_result(f, result))
+        self.run_on_slack_loop(dispatch(), 'queue %d sends' % len(entries))
+        return results
+
+    async def replay_outbox(self):
+        '''Queues every send in the outbox that is not already being made: ones
+           that failed, and ones left over from before a restart.'''
+        try:
+            entries = await self.outbox.pending()
+        except redis.RedisError as e:
+            _LOGGER.error('could not read the outbox: %s', repr(e))
+            return
+        if entries:
+            _LOGGER.info('retrying %d sends from the outbox', len(entries))
+        for entry in entries:
+            try:
+                await self._dispatch_all([entry])
+            except Exception as e:
+                _LOGGER.error('Error retry %s message: %s', entry['kind'], repr(e))
+                await self.outbox.finish(entry, False)
+
+    async def run_outbox_retries(self):
+        while True:
+            await asyncio.sleep(OUTBOX_RETRY_INTERVAL)
+            await self.replay_outbox()
+
+    def get_zulip_id(self, to, subject, slack_id):
+        '''Returns the id of the zulip message in stream to and topic subject that
+           the slack message slack_id was sent as, or None.'''
+        zulip_id = self.zulip_id_cache.get((to, subject, slack_id))
+        if zulip_id is None:
+            zulip_id = self.msg_ids.get(slack_id).get('%s/%s' % (to, subject))
+        if zulip_id is None:
+            zulip_id = self.redis.get(REDIS_MSG_SLACK_TO_ZULIP[to] + slack_id)
+        return zulip_id
+
     # originally from https://github.com/ABTech/zulip_groupme_integration/blob/7674a3595282ce154cd24b1903a44873d729e0cc/server.py
+    # This blocks on the zulip API, so it should be run via queue_sends
+    # rather than directly on the slack loop.  Returns whether the message was
+    # sent (or there was nothing to send), so failures can be retried: for a
+    # slack message with an id, this is the id of the zulip message, which
+    # queue_sends stores for later edits and deletes.
     def send_to_zulip(self, subject, msg, user=None, slack_id=None,
                       send_public=False, edit=False, delete=False, me=False,
                       private=False):
-        _LOGGER.debug('sending to zulip, public: %s', str(send_public))
+        _LOGGER.debug('sending to zulip, public: %s', send_public)
         try:
             sent = dict()
             zulip_id = None
@@ -540,14 +1365,9 @@ my records to use your new name when I forward messages to Zulip for you.",
             elif user is not None and me:
                 user_prefix = '**' + user + '** '
 
-            to = ZULIP_LOG_PUBLIC_STREAM
-            if send_public:
-                to = PUBLIC_TWO_WAY_STREAM
-            elif private:
-                to = ZULIP_LOG_PRIVATE_STREAM
+            to = self.zulip_stream_for(send_public, private)
             if edit and slack_id:
-                redis_key = REDIS_MSG_SLACK_TO_ZULIP[to] + slack_id
-                zulip_id = self.redis.get(redis_key)
+                zulip_id = self.get_zulip_id(to, subject, slack_id)
                 if zulip_id is not None:
                     sent = self.zulip_client.update_message({
                         'message_id': int(zulip_id),
@@ -571,8 +1391,7 @@ my records to use your new name when I forward messages to Zulip for you.",
                     "content": f"{user_prefix}{msg} *(edited)*"
                 })
             elif delete and slack_id:
-                redis_key = REDIS_MSG_SLACK_TO_ZULIP[to] + slack_id
-                zulip_id = self.redis.get(redis_key)
+                zulip_id = self.get_zulip_id(to, subject, slack_id)
                 if zulip_id is not None and send_public:
                     sent = self.zulip_client.delete_message(int(zulip_id))
                 elif zulip_id is not None and not send_public:
@@ -595,66 +1414,52 @@ my records to use your new name when I forward messages to Zulip for you.",
                     "content": user_prefix + msg
 
                 })
+            if not sent:
+                # There was nothing to send.
+                return True
             if 'result' not in sent or sent['result'] != 'success':
                 _LOGGER.error('Could not send zulip message %s', sent)
-                return
+                return False
             if slack_id is not None and not delete:
                 if edit and zulip_id is not None:
                     sent['id'] = zulip_id
                 elif edit:
-                    return
-                redis_key = REDIS_MSG_SLACK_TO_ZULIP[to] + slack_id
-                self.redis.set(redis_key, sent['id'],
-                               ex=SLACK_EDIT_UPDATE_ZULIP_TTL)
+                    return True
+                self.zulip_id_cache.set((to, subject, slack_id), sent['id'])
+                return sent['id']
+            return True
         except:
-            e = sys.exc_info()
-            exc_type, exc_value, exc_traceback = e
-            _LOGGER.error('Error send zulip message: %s',
-                          repr(traceback.format_exception(exc_type,
-                                                          exc_value,
-                                                          exc_traceback)))
-
-    def send_to_groupme(self, subject, msg, user=None, edit=False,
-                        delete=False, me=False):
-        try:
-            # Check for reasons to not send to groupme.
-            if not GROUPME_ENABLE:
-                _LOGGER.debug('attempting to send to groupme but groupme is disabled')
-                return
-            elif subject not in GROUPME_TWO_WAY:
-                _LOGGER.debug('aborting send to groupme outside of GROUPME_TWO_WAY')
-                return
-            elif edit or delete:
-                _LOGGER.debug('aborting send due to edit or delete in send_to_groupme')
-                return
-
-            _LOGGER.debug('sending to groupme')
-
-            sent = dict()
-            user_prefix = ''
-            if user is not None and not me:
-                user_prefix = user + ': '
-            elif user is not None and me:
-                user_prefix = user + ' '
-
-            to = GROUPME_TWO_WAY[subject]
-            send_data = {
-                'bot_id': to['BOT_ID'],
-                'text': user_prefix + msg
-            }
-
-            requests.post("https://api.groupme.com/v3/bots/post",
-                          data=send_data)
+            _LOGGER.error('Error send zulip message', exc_info=True)
+            return False
 
-            # if 'result' not in sent or sent['result'] != 'success':
-            #     _LOGGER.error('Could not send zulip message %s', sent)
-            #     return
-        except:
-            e = sys.exc_info()
-            exc_type, exc_value, exc_traceback = e
-            _LOGGER.error('Error send groupme message: %s',
-                          repr(traceback.format_exception(exc_type,
-                                                          exc_value,
-                                                          exc_traceback)))
-
-slack_bridge = SlackBridge()
+    def groupme_send(self, bot, msg, user=None, edit=False, delete=False,
+                     me=False, key=None):
+        '''A send for queue_sends of the message to the groupme bot bot (a key of
+           GROUPME_TWO_WAY), or None if it should not be sent there.'''
+        # Check for reasons to not send to groupme.
+        if not GROUPME_ENABLE:
+            _LOGGER.debug('attempting to send to groupme but groupme is disabled')
+            return None
+        elif bot not in GROUPME_TWO_WAY:
+            _LOGGER.debug('aborting send to groupme outside of GROUPME_TWO_WAY')
+            return None
+        elif edit or delete:
+            _LOGGER.debug('aborting send due to edit or delete in groupme_send')
+            return None
+
+        _LOGGER.debug('sending to groupme')
+
+        user_prefix = ''
+        if user is not None and not me:
+            user_prefix = user + ': '
+        elif user is not None and me:
+            user_prefix = user + ' '
+
+        return ('groupme',
+                {'bot_id': GROUPME_TWO_WAY[bot]['BOT_ID'],
+                 'text': user_prefix + msg},
+                self._send_key(key, 'groupme', bot))
+
+if __name__ == '__main__':
+    slack_bridge = SlackBridge()
+    slack_bridge.run()
@@ -0,0 +1,251 @@
+# Module for the bridge's own logging plumbing, such as reporting errors to a
+# slack channel, and tagging log records with the message being handled.
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import copy
+import json
+import logging
+import sys
+import threading
+
+# The id of the message being relayed (e.g. slack:<channel>:<ts>, zulip:<id> or
+# groupme:<id>), if any.  Being a context variable, it follows the message into
+# the tasks it starts and (see outbound) the work it hands to other threads.
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+TEXT_FORMAT = '%(levelname)s:%(name)s:%(correlation_id)s:%(message)s'
+
+# The format of each line reported to slack by SlackHandler.
+SLACK_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+
+_DEFAULT_FORMATTER = logging.Formatter()
+
+
+@contextlib.contextmanager
+def correlation(message_id):
+    '''Tags everything logged within, on this thread or task, with message_id.'''
+    token = correlation_id.set(message_id)
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
+
+
+class LazyJson:
+    '''Log argument that serializes obj as json only if the record is emitted.'''
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, default=repr)
+
+
+class CorrelationFilter(logging.Filter):
+    '''Handler filter that adds the correlation_id of the message being handled
+       (or '-') to each record.'''
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get() or '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats each record as a json object on one line, with the correlation id
+       (if CorrelationFilter is in use) and any exception as fields of their own.'''
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'correlation_id', '-') != '-':
+            entry['correlation_id'] = record.correlation_id
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=repr)
+
+
+def configure(level, log_format='text'):
+    '''Sets up logging to stderr at level, as text or (if log_format is 'json')
+       as json lines, with correlation ids either way.'''
+    handler = logging.StreamHandler()
+    handler.addFilter(CorrelationFilter())
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    logging.basicConfig(level=level, handlers=[handler])
+
+
+class SlackHandler(logging.Handler):
+    '''Logging handler that reports log records to a slack channel.
+
+       Records are buffered rather than posted one at a time.  Records with the same
+       message, level, logger and exception are coalesced into one line with a count,
+       formatted (with the time of the first of them) when the buffer is posted.  The
+       buffer is posted at most once every flush_interval seconds (sooner if max_batch
+       distinct messages are waiting).
+       If slack rate limits us, we wait as long as it asks before trying again; if
+       posting fails otherwise (e.g. slack is down), we wait error_backoff seconds.
+       Either way, whatever was not posted is kept for the next try.
+
+       emit() may be called from any thread.  run() must be started as a task on
+       event_loop for anything to actually be posted.'''
+
+    def __init__(self, web_client, event_loop, channel_id, flush_interval=5,
+                 max_batch=20, max_pending=1000, max_post_length=3500,
+                 error_backoff=30):
+        super().__init__()
+        self.web_client = web_client
+        self.event_loop = event_loop
+        self.channel_id = channel_id
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_pending = max_pending
+        self.max_post_length = max_post_length
+        self.error_backoff = error_backoff
+        self.dropped = 0
+        # (level, logger, message, exception text) -> [first record, number of times
+        # it has been seen since the last flush]
+        self._pending = collections.OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._wakeup = None
+
+    def emit(self, record):
+        try:
+            msg = record.getMessage()
+            exc_text = record.exc_text
+            if record.exc_info and not exc_text:
+                exc_text = (self.formatter or _DEFAULT_FORMATTER).formatException(
+                    record.exc_info)
+            key = (record.levelname, record.name, msg, exc_text)
+            with self._pending_lock:
+                entry = self._pending.get(key)
+                if entry is not None:
+                    entry[1] += 1
+                elif len(self._pending) < self.max_pending:
+                    self._pending[key] = [self._keep(record, msg, exc_text), 1]
+                else:
+                    self.dropped += 1
+                batch_full = len(self._pending) >= self.max_batch
+            if batch_full and self._wakeup is not None:
+                self.event_loop.call_soon_threadsafe(self._wakeup.set)
+        except Exception as e:
+            print('could not queue err for slack %s' % repr(e), file=sys.stderr)
+
+    @staticmethod
+    def _keep(record, msg, exc_text):
+        '''A copy of record to format later, which does not hold on to its arguments
+           or traceback.'''
+        record = copy.copy(record)
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+    def _take_pending(self):
+        with self._pending_lock:
+            pending = self._pending
+            dropped = self.dropped
+            self._pending = collections.OrderedDict()
+            self.dropped = 0
+        return pending, dropped
+
+    def _requeue(self, pending, dropped):
+        '''Puts messages that we failed to post back at the front of the buffer.'''
+        with self._pending_lock:
+            for key, entry in self._pending.items():
+                if key in pending:
+                    pending[key][1] += entry[1]
+                else:
+                    pending[key] = entry
+            while len(pending) > self.max_pending:
+                pending.popitem()
+                dropped += 1
+            self._pending = pending
+            self.dropped += dropped
+
+    @staticmethod
+    def _format_line(msg, count):
+        if count > 1:
+            return "Oopsie! (x%d) %s" % (count, msg)
+        return "Oopsie! " + msg
+
+    def batch_posts(self, pending):
+        '''Splits the pending messages into posts of at most max_post_length characters.
+
+           Returns a list of (text, pending messages in that post) pairs.'''
+        posts = []
+        text = ''
+        items = collections.OrderedDict()
+        for key, (record, count) in pending.items():
+            line = self._format_line(self.format(record), count)[:self.max_post_length]
+            if text and len(text) + 1 + len(line) > self.max_post_length:
+                posts.append((text, items))
+                text = ''
+                items = collections.OrderedDict()
+            text = text + '\n' + line if text else line
+            items[key] = [record, count]
+        if text:
+            posts.append((text, items))
+        return posts
+
+    async def flush_pending(self):
+        '''Posts everything in the buffer.  Returns the number of seconds to back off
+           for before trying again (as slack asked, if it rate limited us), or 0.'''
+        pending, dropped = self._take_pending()
+        posts = self.batch_posts(pending)
+        if dropped:
+            posts.append(("Oopsie! %d more errors were dropped." % dropped,
+                          collections.OrderedDict()))
+        for i, (text, items) in enumerate(posts):
+            try:
+                await self.web_client.chat_postMessage(
+                    channel=self.channel_id,
+                    text=text,
+                    mrkdwn=False
+                )
+            except Exception as e:
+                # Put back whatever we haven't managed to post yet.
+                unsent = collections.OrderedDict()
+                for _, unsent_items in posts[i:]:
+                    unsent.update(unsent_items)
+                # The dropped count is always the last post, so it is unsent too.
+                self._requeue(unsent, dropped)
+                response = getattr(e, 'response', None)
+                if response is not None and getattr(response, 'status_code', None) == 429:
+                    try:
+                        backoff = max(1, int(response.headers.get('Retry-After', 1)))
+                    except (TypeError, ValueError):
+                        backoff = 1
+                    print('slack rate limited error reports, waiting %d seconds' % backoff,
+                          file=sys.stderr)
+                    return backoff
+                print('could not post err to slack %s, waiting %d seconds' %
+                      (repr(e), self.error_backoff), file=sys.stderr)
+                return self.error_backoff
+        return 0
+
+    async def run(self):
+        '''Flushes the buffer periodically, forever.  Run this as a task on event_loop.'''
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            backoff = await self.flush_pending()
+            if backoff:
+                await asyncio.sleep(backoff)
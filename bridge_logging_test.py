@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import unittest
+from unittest import mock
+
+import bridge_logging
+
+# Shorthand for doing an await in a unittest.
+do_await = asyncio.get_event_loop().run_until_complete
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class FakeSlackApiError(Exception):
+    def __init__(self, response):
+        super().__init__('rate limited')
+        self.response = response
+
+
+class FakeWebClient:
+    '''Records posts; fails with a 429 for the first rate_limited_posts calls, and
+       with a 503 for any after the first fail_after.'''
+    def __init__(self, rate_limited_posts=0, fail_after=None):
+        self.posts = []
+        self.rate_limited_posts = rate_limited_posts
+        self.fail_after = fail_after
+
+    async def chat_postMessage(self, channel, text, mrkdwn):
+        if self.rate_limited_posts:
+            self.rate_limited_posts -= 1
+            raise FakeSlackApiError(FakeResponse(429, {'Retry-After': '30'}))
+        if self.fail_after is not None and len(self.posts) >= self.fail_after:
+            raise FakeSlackApiError(FakeResponse(503, {}))
+        self.posts.append(text)
+
+
+def make_record(msg):
+    return logging.LogRecord('test', logging.ERROR, __file__, 1, msg, None, None)
+
+
+class TestSlackHandler(unittest.TestCase):
+    def test_coalescing(self):
+        web_client = FakeWebClient()
+        handler = bridge_logging.SlackHandler(web_client, None, 'C1')
+        for i in range(1000):
+            handler.emit(make_record('redis is down'))
+        handler.emit(make_record('zulip is down'))
+
+        self.assertEqual(do_await(handler.flush_pending()), 0)
+        self.assertEqual(web_client.posts,
+                         ['Oopsie! (x1000) redis is down\nOopsie! zulip is down'])
+
+        # Nothing left to post.
+        do_await(handler.flush_pending())
+        self.assertEqual(len(web_client.posts), 1)
+
+    def test_batch_limits(self):
+        web_client = FakeWebClient()
+        handler = bridge_logging.SlackHandler(web_client, None, 'C1',
+                                              max_pending=3, max_post_length=50)
+        for i in range(5):
+            handler.emit(make_record('error number %d' % i))
+
+        do_await(handler.flush_pending())
+        self.assertEqual(web_client.posts,
+                         ['Oopsie! error number 0\nOopsie! error number 1',
+                          'Oopsie! error number 2',
+                          'Oopsie! 2 more errors were dropped.'])
+
+    def test_rate_limited(self):
+        web_client = FakeWebClient(rate_limited_posts=1)
+        handler = bridge_logging.SlackHandler(web_client, None, 'C1')
+        handler.emit(make_record('redis is down'))
+
+        # We are asked to back off, and the message is kept for next time.
+        self.assertEqual(do_await(handler.flush_pending()), 30)
+        handler.emit(make_record('redis is down'))
+        self.assertEqual(do_await(handler.flush_pending()), 0)
+        self.assertEqual(web_client.posts, ['Oopsie! (x2) redis is down'])
+
+    def test_slack_down(self):
+        web_client = FakeWebClient(fail_after=1)
+        handler = bridge_logging.SlackHandler(web_client, None, 'C1', max_pending=3,
+                                              max_post_length=50, error_backoff=5)
+        for i in range(5):
+            handler.emit(make_record('error number %d' % i))
+
+        # The first post gets through; the rest are kept, as is the dropped count.
+        self.assertEqual(do_await(handler.flush_pending()), 5)
+        self.assertEqual(do_await(handler.flush_pending()), 5)
+        web_client.fail_after = None
+        handler.emit(make_record('error number 2'))
+        self.assertEqual(do_await(handler.flush_pending()), 0)
+        self.assertEqual(web_client.posts,
+                         ['Oopsie! error number 0\nOopsie! error number 1',
+                          'Oopsie! (x2) error number 2',
+                          'Oopsie! 2 more errors were dropped.'])
+
+    def test_coalescing_formatted(self):
+        # With the formatter the bridge uses, every record has its own time, but
+        # they are still coalesced, with the time of the first.
+        web_client = FakeWebClient()
+        handler = bridge_logging.SlackHandler(web_client, None, 'C1')
+        handler.setFormatter(logging.Formatter(bridge_logging.SLACK_FORMAT))
+        logger = logging.getLogger('test.slack')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        records = []
+        keep = lambda record: records.append(record) or True
+        logger.addFilter(keep)
+        self.addCleanup(logger.removeFilter, keep)
+        for i in range(5):
+            with mock.patch('time.time', return_value=1558647312 + i * 0.005):
+                logger.error('%s is down', 'redis')
+        for i in range(2):
+            try:
+                raise ConnectionError('refused')
+            except ConnectionError:
+                logger.error('redis is down', exc_info=True)
+
+        do_await(handler.flush_pending())
+        self.assertEqual(len(web_client.posts), 1)
+        lines = web_client.posts[0].split('\n', 1)
+        self.assertEqual(lines[0], 'Oopsie! (x5) ' + handler.format(records[0]))
+        self.assertRegex(lines[0], r'^Oopsie! \(x5\) \d{4}-\d\d-\d\d [\d:,]+ '
+                                   r'test.slack   ERROR    redis is down$')
+        self.assertTrue(lines[1].startswith('Oopsie! (x2) '))
+        self.assertTrue(lines[1].endswith('ConnectionError: refused'))
+        self.assertEqual(lines[1].count('Traceback'), 1)
+
+
+class Unserializable:
+    def __init__(self):
+        self.serialized = 0
+
+    def __repr__(self):
+        self.serialized += 1
+        return 'unserializable'
+
+
+class TestStructuredLogging(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('bridge_logging_test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.records = []
+        handler = logging.Handler()
+        handler.addFilter(bridge_logging.CorrelationFilter())
+        handler.emit = self.records.append
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+
+    def test_lazy_json(self):
+        obj = Unserializable()
+        self.logger.debug('JSON: %s', bridge_logging.LazyJson({'obj': obj}))
+        self.assertEqual(obj.serialized, 0)
+
+        self.logger.info('JSON: %s', bridge_logging.LazyJson({'obj': obj}))
+        self.assertEqual(self.records[0].getMessage(), 'JSON: {"obj": "unserializable"}')
+
+    def test_correlation_id(self):
+        self.logger.info('outside')
+        with bridge_logging.correlation('slack:C1:1'):
+            self.logger.info('inside')
+
+            # Tasks started within carry the id along.
+            async def in_task():
+                self.logger.info('in a task')
+            asyncio.run(in_task())
+        self.assertEqual([record.correlation_id for record in self.records],
+                         ['-', 'slack:C1:1', 'slack:C1:1'])
+
+    def test_json_formatter(self):
+        formatter = bridge_logging.JsonFormatter()
+        with bridge_logging.correlation('zulip:5'):
+            try:
+                raise NameError('oops')
+            except NameError:
+                self.logger.error('failed %s', 'here', exc_info=True)
+        self.logger.info('no id')
+
+        entry = json.loads(formatter.format(self.records[0]))
+        self.assertEqual(entry['message'], 'failed here')
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertEqual(entry['logger'], 'bridge_logging_test')
+        self.assertEqual(entry['correlation_id'], 'zulip:5')
+        self.assertIn('NameError: oops', entry['exc_info'])
+        self.assertNotIn('correlation_id', json.loads(formatter.format(self.records[1])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# Module for collapsing bursts of updates to the same thing (e.g. the edits
+# slack sends as a message is unfurled or fixed up) into one, on an asyncio
+# event loop.
+
+import asyncio
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Debouncer:
+    '''Runs only the last of a burst of calls submitted for the same key.
+
+       A call submitted for a key waits delay seconds before it is run; another
+       call for the key within that time replaces it and the wait starts again,
+       but never past max_delay seconds after the first call of the burst, so a
+       steady stream of calls still gets through.  A final call (e.g. for a
+       delete) replaces whatever is waiting and runs straight away.
+
+       Calls for a key run one at a time, in the order submitted: a call that
+       comes due while the previous one for its key is still running waits for
+       it.  Calls are coroutine functions taking no arguments, and run in the
+       context they were submitted from.  Everything must be used on loop.'''
+
+    def __init__(self, loop, delay=1, max_delay=5, on_superseded=None):
+        self._loop = loop
+        self.delay = delay
+        self.max_delay = max_delay
+        # Called with each key whose waiting call was replaced by a later one.
+        self._on_superseded = on_superseded
+        # key -> (func, timer handle, time the burst started)
+        self._waiting = {}
+        # key -> the task running the last call for key
+        self._running = {}
+
+    def submit(self, key, func, final=False):
+        '''Queues func() to be run for key, in place of any call still waiting.'''
+        now = self._loop.time()
+        started = now
+        if key in self._waiting:
+            _, handle, started = self._waiting.pop(key)
+            handle.cancel()
+            if self._on_superseded is not None:
+                self._on_superseded(key)
+        if final or self.delay <= 0:
+            self._run(key, func)
+            return
+        when = min(now + self.delay, started + self.max_delay)
+        handle = self._loop.call_at(when, self._due, key)
+        self._waiting[key] = (func, handle, started)
+
+    def _due(self, key):
+        func, _, _ = self._waiting.pop(key)
+        self._run(key, func)
+
+    def _run(self, key, func):
+        previous = self._running.get(key)
+        task = self._loop.create_task(self._call(previous, func))
+        self._running[key] = task
+
+        def done(task):
+            if self._running.get(key) is task:
+                del self._running[key]
+            if not task.cancelled() and task.exception() is not None:
+                _LOGGER.error('debounced call for %s failed: %s', key,
+                              repr(task.exception()))
+        task.add_done_callback(done)
+
+    @staticmethod
+    async def _call(previous, func):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await func()
+
+    def pending(self):
+        '''The number of calls waiting to be run.'''
+        return len(self._waiting)
+
+    async def flush(self):
+        '''Runs every waiting call now, and waits for all calls to finish.'''
+        for key in list(self._waiting):
+            handle = self._waiting[key][1]
+            handle.cancel()
+            self._due(key)
+        if self._running:
+            await asyncio.wait(list(self._running.values()))
@@ -0,0 +1,88 @@
+import asyncio
+import unittest
+
+import debounce
+
+
+class TestDebouncer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.superseded = []
+        self.debouncer = debounce.Debouncer(self.loop, delay=0.05, max_delay=0.2,
+                                            on_superseded=self.superseded.append)
+        self.calls = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def call(self, name, duration=0):
+        async def func():
+            self.calls.append(('start', name))
+            await asyncio.sleep(duration)
+            self.calls.append(('end', name))
+        return func
+
+    def do_await(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def names(self):
+        return [name for event, name in self.calls if event == 'start']
+
+    def test_burst_is_collapsed(self):
+        async def burst():
+            for i in range(5):
+                self.debouncer.submit('a', self.call('a%d' % i))
+                self.debouncer.submit('b', self.call('b%d' % i))
+                await asyncio.sleep(0.01)
+            self.assertEqual(self.calls, [])
+            await asyncio.sleep(0.1)
+
+        self.do_await(burst())
+        self.assertEqual(sorted(self.names()), ['a4', 'b4'])
+        self.assertEqual(len(self.superseded), 8)
+        self.assertEqual(self.debouncer.pending(), 0)
+
+    def test_max_delay(self):
+        async def steady():
+            for i in range(30):
+                self.debouncer.submit('a', self.call(i))
+                await asyncio.sleep(0.02)
+
+        self.do_await(steady())
+        # Roughly one call per max_delay gets through despite the steady stream.
+        self.assertGreaterEqual(len(self.names()), 2)
+        self.assertLess(len(self.names()), 30)
+
+    def test_final_replaces_waiting(self):
+        async def edit_then_delete():
+            self.debouncer.submit('a', self.call('edit'))
+            self.debouncer.submit('a', self.call('delete'), final=True)
+            await asyncio.sleep(0)
+            self.assertEqual(self.names(), ['delete'])
+            await asyncio.sleep(0.1)
+
+        self.do_await(edit_then_delete())
+        self.assertEqual(self.names(), ['delete'])
+        self.assertEqual(self.superseded, ['a'])
+
+    def test_calls_for_a_key_do_not_overlap(self):
+        async def overlapping():
+            self.debouncer.submit('a', self.call('slow', duration=0.1), final=True)
+            self.debouncer.submit('a', self.call('next'), final=True)
+            await self.debouncer.flush()
+
+        self.do_await(overlapping())
+        self.assertEqual(self.calls, [('start', 'slow'), ('end', 'slow'),
+                                      ('start', 'next'), ('end', 'next')])
+
+    def test_flush(self):
+        async def flush():
+            self.debouncer.submit('a', self.call('a'))
+            await self.debouncer.flush()
+
+        self.do_await(flush())
+        self.assertEqual(self.names(), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
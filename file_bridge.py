@@ -0,0 +1,243 @@
+# Module to mirror files shared on slack over to zulip's upload storage without
+# holding up (or holding in memory) the rest of the relay.
+
+import asyncio
+import concurrent.futures
+import contextvars
+import hashlib
+import io
+import logging
+import tempfile
+import threading
+import urllib.parse
+import uuid
+
+import requests
+
+import ttl_cache
+
+_LOGGER = logging.getLogger(__name__)
+
+# Files up to this size are buffered in memory, larger ones are spooled to a
+# temporary file on disk.
+SPOOL_MAX_MEMORY = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# (connect, read) timeouts for both the slack download and the zulip upload.
+HTTP_TIMEOUT = (10, 60)
+
+# Size and lifetime of the in-process layer of the mirror cache.
+MIRROR_CACHE_SIZE = 1000
+MIRROR_CACHE_LOCAL_TTL = 60*60
+
+
+def is_mirrorable(file):
+    '''Returns true if file (from the slack API) is something we can mirror to zulip.'''
+    return bool(file.get('id') and file.get('name') and file.get('url_private'))
+
+
+class _MultipartUpload:
+    '''A read-only file-like multipart/form-data body with a single file part.
+
+       The file part is read from the underlying file object as the body is sent,
+       so the file never needs to be held in memory all at once.'''
+
+    def __init__(self, fileobj, filename, length):
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        quoted_filename = filename.replace('\\', '\\\\').replace('"', '\\"')
+        head = (f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="file"; filename="{quoted_filename}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self._parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        # requests uses this to set Content-Length rather than chunking the body.
+        self.len = len(head) + length + len(tail)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b''.join(part.read() for part in self._parts)
+        chunks = []
+        while size > 0 and self._parts:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+
+class SlackFileBridge:
+    '''Downloads files from slack and uploads them to zulip.
+
+       Transfers are streamed in chunks (spooling to disk past SPOOL_MAX_MEMORY),
+       capped at max_file_size bytes, and run on a thread pool so that they can be
+       awaited from the slack loop without blocking it.  Each worker thread keeps its
+       own pooled HTTP session.
+
+       If a (synchronous) redis client is given, mirrored files are remembered for
+       cache_ttl seconds, both by slack file id and by the sha256 of their content, so
+       that a file that is shared again (or whose message is edited) reuses the existing
+       zulip upload instead of being transferred again.'''
+
+    def __init__(self, slack_bearer_token, zulip_client, max_file_size=250 * 1024 * 1024,
+                 max_workers=4, redis_client=None, cache_key_prefix='', cache_ttl=7*24*60*60):
+        self._slack_bearer_token = slack_bearer_token
+        self._zulip_client = zulip_client
+        self.max_file_size = max_file_size
+        self._max_workers = max_workers
+        self._executor = None
+        self._local = threading.local()
+        self._redis = redis_client
+        self._cache_key_by_id = cache_key_prefix + 'by.id:'
+        self._cache_key_by_hash = cache_key_prefix + 'by.hash:'
+        self._cache_ttl = cache_ttl
+        self._local_cache = ttl_cache.TTLCache(MIRROR_CACHE_SIZE,
+                                               min(cache_ttl, MIRROR_CACHE_LOCAL_TTL))
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _upload_to_zulip(self, fileobj, filename, length):
+        '''Uploads fileobj to zulip, returning the uri of the upload or None on failure.'''
+        body = _MultipartUpload(fileobj, filename, length)
+        r = self._session().post(
+            urllib.parse.urljoin(self._zulip_client.base_url, 'v1/user_uploads'),
+            data=body,
+            headers={'Content-Type': body.content_type},
+            auth=(self._zulip_client.email, self._zulip_client.api_key),
+            verify=self._zulip_client.tls_verification,
+            timeout=HTTP_TIMEOUT)
+        try:
+            response = r.json()
+        except ValueError:
+            response = {'status_code': r.status_code}
+        if 'uri' in response and response['uri']:
+            return response['uri']
+        _LOGGER.info('Got bad response when uploading to zulip: {}'.format(response))
+        return None
+
+    @staticmethod
+    def _file_cache_id(file):
+        # Slack doesn't give us a content hash up front, but a file id with the same
+        # size is as good as we can do without downloading it.
+        return f"{file['id']}:{file.get('size', '')}"
+
+    def _cache_get(self, key):
+        uri = self._local_cache.get(key)
+        if uri is None and self._redis is not None:
+            try:
+                uri = self._redis.get(key)
+            except Exception as e:
+                _LOGGER.warning('Could not read file mirror cache: %s', repr(e))
+            if uri is not None:
+                self._local_cache.set(key, uri)
+        return uri
+
+    def _cache_set(self, items):
+        for key, uri in items.items():
+            self._local_cache.set(key, uri)
+        if self._redis is not None:
+            try:
+                pipe = self._redis.pipeline(transaction=False)
+                for key, uri in items.items():
+                    pipe.set(key, uri, ex=self._cache_ttl)
+                pipe.execute()
+            except Exception as e:
+                _LOGGER.warning('Could not write file mirror cache: %s', repr(e))
+
+    def mirror_file(self, file):
+        '''Mirrors a single file (from the slack API) to zulip.  Blocks until done.
+
+           Returns the zulip uri of the upload, or None if the file was not mirrored.'''
+        by_id_key = self._cache_key_by_id + self._file_cache_id(file)
+        uri = self._cache_get(by_id_key)
+        if uri is not None:
+            _LOGGER.debug('reusing mirrored file %s', file['id'])
+            return uri
+
+        file_private_url = file['url_private']
+        if file.get('size') and file['size'] > self.max_file_size:
+            _LOGGER.info(f"Skipping bridging {file_private_url}, its size {file['size']} is "
+                         f"over the limit of {self.max_file_size}.")
+            return None
+
+        with self._session().get(file_private_url,
+                                 headers={"Authorization": f"Bearer {self._slack_bearer_token}"},
+                                 stream=True, timeout=HTTP_TIMEOUT) as r:
+            if r.status_code != 200:
+                _LOGGER.info(f"Got code {r.status_code} when fetching {file_private_url} from slack.")
+                return None
+            if file_private_url != r.url:
+                # we were redirected!
+                _LOGGER.info(
+                    f'Apparent slack redirect from {file_private_url} to {r.url} when bridging file.  Skipping.')
+                return None
+
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY) as spool:
+                length = 0
+                content_hash = hashlib.sha256()
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    length += len(chunk)
+                    if length > self.max_file_size:
+                        _LOGGER.info(f"Stopped bridging {file_private_url}, it is over the "
+                                     f"limit of {self.max_file_size} bytes.")
+                        return None
+                    content_hash.update(chunk)
+                    spool.write(chunk)
+
+                by_hash_key = self._cache_key_by_hash + content_hash.hexdigest()
+                uri = self._cache_get(by_hash_key)
+                if uri is not None:
+                    _LOGGER.debug('reusing mirrored content for file %s', file['id'])
+                else:
+                    spool.seek(0)
+                    uri = self._upload_to_zulip(spool, file['name'], length)
+                    if uri is None:
+                        return None
+
+                self._cache_set({by_id_key: uri, by_hash_key: uri})
+                return uri
+
+    def _mirror_file_logged(self, file):
+        try:
+            return self.mirror_file(file)
+        except:
+            _LOGGER.warning('Error bridging file %s', file.get('id'), exc_info=True)
+            return None
+
+    async def mirror_files(self, files):
+        '''Mirrors all of the mirrorable files concurrently, off of the event loop.
+
+           Returns a dict of slack file id to zulip uri for the files that were mirrored.'''
+        if files is None:
+            return {}
+        # The same file can appear more than once in a message; only mirror it once.
+        to_mirror = list({file['id']: file for file in files if is_mirrorable(file)}.values())
+        if not to_mirror:
+            return {}
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_workers, thread_name_prefix='file-bridge')
+        loop = asyncio.get_event_loop()
+        uris = await asyncio.gather(*[
+            loop.run_in_executor(self._executor, contextvars.copy_context().run,
+                                 self._mirror_file_logged, file)
+            for file in to_mirror])
+        return {file['id']: uri for file, uri in zip(to_mirror, uris) if uri}
+
+    def mirror_files_sync(self, files):
+        '''As mirror_files, but one at a time on the calling thread.'''
+        if files is None:
+            return {}
+        uris = {}
+        for file in files:
+            if is_mirrorable(file):
+                uri = self._mirror_file_logged(file)
+                if uri:
+                    uris[file['id']] = uri
+        return uris
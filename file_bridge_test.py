@@ -0,0 +1,159 @@
+import asyncio
+import io
+import unittest
+
+import file_bridge
+
+# Shorthand for doing an await in a unittest.
+do_await = asyncio.get_event_loop().run_until_complete
+
+_FILE_URL = 'https://files.slack.com/files-pri/T0000000-F0000000/filename.jpg'
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, url=_FILE_URL, chunks=(), json_body=None):
+        self.status_code = status_code
+        self.url = url
+        self._chunks = chunks
+        self._json_body = json_body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        return iter(self._chunks)
+
+    def json(self):
+        return self._json_body
+
+
+class FakeSession:
+    '''Stands in for requests.Session, recording uploads.'''
+    def __init__(self, download):
+        self.download = download
+        self.downloads = 0
+        self.uploads = []
+
+    def get(self, url, **kwargs):
+        self.downloads += 1
+        return self.download
+
+    def post(self, url, data=None, **kwargs):
+        self.uploads.append((url, data.len, data.read()))
+        return FakeResponse(json_body={'result': 'success', 'uri': '/user_uploads/1/ab/filename.jpg'})
+
+
+class FakeRedis:
+    '''Just enough of redis.Redis for the mirror cache.'''
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+
+class FakeZulipClient:
+    base_url = 'https://zulip.example.com/api/'
+    email = 'bot@example.com'
+    api_key = 'key'
+    tls_verification = True
+
+
+def make_bridge(download, max_file_size=100, redis_client=None):
+    bridge = file_bridge.SlackFileBridge('token', FakeZulipClient(),
+                                         max_file_size=max_file_size,
+                                         redis_client=redis_client,
+                                         cache_key_prefix='test:file.mirror:')
+    session = FakeSession(download)
+    bridge._session = lambda: session
+    return bridge, session
+
+
+class TestFileBridge(unittest.TestCase):
+    def test_multipart_upload(self):
+        upload = file_bridge._MultipartUpload(io.BytesIO(b'0123456789'), 'a "b".txt', 10)
+        body = b''
+        chunk = upload.read(7)
+        while chunk:
+            body += chunk
+            chunk = upload.read(7)
+        self.assertEqual(len(body), upload.len)
+        self.assertIn(b'filename="a \\"b\\".txt"', body)
+        self.assertIn(b'\r\n\r\n0123456789\r\n--', body)
+
+    def test_mirror_file(self):
+        bridge, session = make_bridge(FakeResponse(chunks=[b'abc', b'def']))
+        file = {'id': 'F1', 'name': 'filename.jpg', 'url_private': _FILE_URL}
+        self.assertEqual(bridge.mirror_file(file), '/user_uploads/1/ab/filename.jpg')
+        url, length, body = session.uploads[0]
+        self.assertEqual(url, 'https://zulip.example.com/api/v1/user_uploads')
+        self.assertEqual(length, len(body))
+        self.assertIn(b'\r\n\r\nabcdef\r\n', body)
+
+    def test_mirror_file_failures(self):
+        file = {'id': 'F1', 'name': 'filename.jpg', 'url_private': _FILE_URL}
+
+        # Bad status
+        bridge, session = make_bridge(FakeResponse(status_code=404))
+        self.assertIsNone(bridge.mirror_file(file))
+
+        # Redirected
+        bridge, session = make_bridge(FakeResponse(url='https://slack.com/signin'))
+        self.assertIsNone(bridge.mirror_file(file))
+
+        # Over the size limit while streaming
+        bridge, session = make_bridge(FakeResponse(chunks=[b'x' * 60, b'x' * 60]))
+        self.assertIsNone(bridge.mirror_file(file))
+
+        # Over the size limit according to slack
+        bridge, session = make_bridge(FakeResponse(chunks=[b'x']))
+        self.assertIsNone(bridge.mirror_file(dict(file, size=1000)))
+        self.assertEqual(session.uploads, [])
+
+    def test_mirror_files(self):
+        bridge, session = make_bridge(FakeResponse(chunks=[b'abc']))
+        files = [
+            {'id': 'F1', 'name': 'one.jpg', 'url_private': _FILE_URL},
+            {'id': 'F2', 'mode': 'tombstone'},
+            {'id': 'F3', 'name': 'three.jpg', 'url_private': _FILE_URL},
+        ]
+        self.assertEqual(do_await(bridge.mirror_files(files)),
+                         {'F1': '/user_uploads/1/ab/filename.jpg',
+                          'F3': '/user_uploads/1/ab/filename.jpg'})
+        self.assertEqual(do_await(bridge.mirror_files(None)), {})
+
+    def test_mirror_cache(self):
+        redis_client = FakeRedis()
+        bridge, session = make_bridge(FakeResponse(chunks=[b'abc']), redis_client=redis_client)
+        file = {'id': 'F1', 'name': 'one.jpg', 'url_private': _FILE_URL, 'size': 3}
+        uri = bridge.mirror_file(file)
+        self.assertEqual(len(redis_client.data), 2)
+
+        # Same file again: no download, no upload.
+        self.assertEqual(bridge.mirror_file(file), uri)
+        self.assertEqual((session.downloads, len(session.uploads)), (1, 1))
+
+        # Same content under another id: downloaded, but not uploaded again.
+        self.assertEqual(bridge.mirror_file(dict(file, id='F2')), uri)
+        self.assertEqual((session.downloads, len(session.uploads)), (2, 1))
+
+        # A fresh process (empty local cache) still finds it in redis.
+        bridge, session = make_bridge(FakeResponse(chunks=[b'abc']), redis_client=redis_client)
+        self.assertEqual(bridge.mirror_file(file), uri)
+        self.assertEqual((session.downloads, len(session.uploads)), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
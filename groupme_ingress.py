@@ -0,0 +1,99 @@
+# Module for receiving groupme bot callbacks on one asyncio http(s) server.
+
+import concurrent.futures
+import json
+import logging
+
+from aiohttp import web
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class GroupMeIngress:
+    '''Receives the callbacks of all groupme bots on one asyncio server.
+
+       bots is a dict of channel name -> bot conf (as in GROUPME_TWO_WAY).  A
+       callback is routed to a channel by the last part of its path, which may be
+       the channel name or the bot's BOT_ID (e.g. https://host:port/groupme/social).
+       Failing that, it is routed by the port it arrived on: besides the shared
+       port, the server also listens on the BOT_PORT of every bot that has one, so
+       callback URLs registered with groupme before there was a shared port keep
+       working.
+
+       handler(channel, conf, post_data) is called for each callback on a pool of
+       at most workers threads, so it may block.  At most max_pending callbacks are
+       accepted at once; beyond that we answer 503 rather than queue without bound.
+
+       Connections are kept alive between callbacks.'''
+
+    def __init__(self, loop, bots, handler, ssl_context=None, workers=4,
+                 max_pending=100):
+        self._loop = loop
+        self._bots = bots
+        self._handler = handler
+        self._ssl_context = ssl_context
+        self._max_pending = max_pending
+        self._pending = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='groupme-ingress')
+        self._by_path = {}
+        self._by_port = {}
+        for channel, conf in bots.items():
+            self._by_path[channel] = channel
+            self._by_path[conf['BOT_ID']] = channel
+            if conf.get('BOT_PORT'):
+                self._by_port[conf['BOT_PORT']] = channel
+        self._runner = None
+
+    def route(self, path, port):
+        '''Returns the channel a callback to path on port is for, or None.'''
+        segments = [segment for segment in path.split('/') if segment]
+        if segments and segments[-1] in self._by_path:
+            return self._by_path[segments[-1]]
+        return self._by_port.get(port)
+
+    async def start(self, port=None, host=''):
+        '''Starts listening on port (if given) and on each bot's BOT_PORT.  Must be
+           run on the ingress's loop.
+
+           Returns the ports listened on.'''
+        app = web.Application()
+        app.router.add_post('/{tail:.*}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        ports = ([port] if port is not None else []) + sorted(self._by_port)
+        for listen_port in ports:
+            site = web.TCPSite(self._runner, host or None, listen_port,
+                               ssl_context=self._ssl_context)
+            await site.start()
+        _LOGGER.debug('listening http for groupme bots on ports %s', ports)
+        return [address[1] for address in self._runner.addresses]
+
+    async def _handle(self, request):
+        sockname = request.transport.get_extra_info('sockname') if request.transport else None
+        channel = self.route(request.path, sockname[1] if sockname else None)
+        if channel is None:
+            _LOGGER.warning('groupme callback for unknown bot: %s', request.path)
+            return web.Response(status=404)
+        if self._pending >= self._max_pending:
+            _LOGGER.error('too many groupme callbacks pending, rejecting one for %s',
+                          channel)
+            return web.Response(status=503)
+
+        self._pending += 1
+        try:
+            post_data = json.loads(await request.read())
+            await self._loop.run_in_executor(
+                self._executor, self._handler, channel, self._bots[channel], post_data)
+        except Exception:
+            _LOGGER.error('Error do post groupme message', exc_info=True)
+            return web.Response(status=500)
+        finally:
+            self._pending -= 1
+        return web.Response(content_type='text/html')
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        self._executor.shutdown(wait=False)
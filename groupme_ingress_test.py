@@ -0,0 +1,55 @@
+import asyncio
+import unittest
+
+import aiohttp
+
+import groupme_ingress
+
+BOTS = {
+    'social': {'BOT_ID': '1111', 'BOT_NAME': 'bridge'},
+    'crew': {'BOT_ID': '2222', 'BOT_NAME': 'bridge', 'BOT_PORT': 8443},
+}
+
+
+class TestGroupMeIngress(unittest.TestCase):
+    def test_route(self):
+        ingress = groupme_ingress.GroupMeIngress(None, BOTS, None)
+        self.assertEqual(ingress.route('/groupme/social', 8000), 'social')
+        self.assertEqual(ingress.route('/groupme/2222/', 8000), 'crew')
+        self.assertEqual(ingress.route('/', 8443), 'crew')
+        self.assertIsNone(ingress.route('/groupme/other', 8000))
+        self.assertIsNone(ingress.route('/', 8000))
+
+    def test_callbacks(self):
+        loop = asyncio.new_event_loop()
+        received = []
+
+        def handler(channel, conf, post_data):
+            if post_data.get('fail'):
+                raise ValueError('bad callback')
+            received.append((channel, conf['BOT_ID'], post_data['text']))
+
+        bots = {'social': BOTS['social']}
+        ingress = groupme_ingress.GroupMeIngress(loop, bots, handler)
+
+        async def run():
+            port = (await ingress.start(0, host='127.0.0.1'))[0]
+            url = 'http://127.0.0.1:%d/groupme/' % port
+            async with aiohttp.ClientSession() as session:
+                statuses = []
+                for path, body in (('social', {'text': 'hello'}),
+                                   ('1111', {'text': 'again'}),
+                                   ('nobody', {'text': 'lost'}),
+                                   ('social', {'fail': True})):
+                    async with session.post(url + path, json=body) as response:
+                        statuses.append(response.status)
+            await ingress.stop()
+            return statuses
+
+        self.assertEqual(loop.run_until_complete(run()), [200, 200, 404, 500])
+        loop.close()
+        self.assertEqual(received, [('social', '1111', 'hello'), ('social', '1111', 'again')])
+
+
+if __name__ == '__main__':
+    unittest.main()
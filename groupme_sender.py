@@ -0,0 +1,197 @@
+# Module for posting messages to groupme as bots, from an asyncio event loop.
+
+import asyncio
+import contextvars
+import logging
+import time
+
+import aiohttp
+
+_LOGGER = logging.getLogger(__name__)
+
+GROUPME_API_URL = 'https://api.groupme.com/v3/bots/post'
+
+# GroupMe rejects bot posts longer than this.
+MAX_MESSAGE_LENGTH = 1000
+
+
+def split_message(text, max_length=MAX_MESSAGE_LENGTH):
+    '''Splits text into pieces of at most max_length characters, preferring to
+       split at line breaks, then at spaces.'''
+    pieces = []
+    while len(text) > max_length:
+        cut = text.rfind('\n', 0, max_length + 1)
+        if cut <= 0:
+            cut = text.rfind(' ', 0, max_length + 1)
+        if cut <= 0:
+            pieces.append(text[:max_length])
+            text = text[max_length:]
+        else:
+            pieces.append(text[:cut])
+            text = text[cut + 1:]
+    if text or not pieces:
+        pieces.append(text)
+    return pieces
+
+
+class GroupMeSender:
+    '''Posts messages to groupme bots over a pool of keep-alive connections.
+
+       Each bot has its own queue and worker, so messages to a bot are posted in
+       order, and a bot that is being rate limited does not hold up the others.
+       Messages that are too long are split.  If messages back up behind a slow
+       or rate limited post, they are combined into as few posts as will fit.
+
+       Rate limited (429), server error and network failures are retried with
+       exponential backoff (or as long as a Retry-After header asks); other
+       failures are logged and the message dropped.  A full queue drops new
+       messages rather than waiting, so groupme trouble never holds up the
+       caller.
+
+       start() must be run on loop before sending.'''
+
+    def __init__(self, loop, api_url=GROUPME_API_URL, max_pending=1000,
+                 max_connections=8, timeout=10, max_retries=5, backoff_base=1,
+                 max_backoff=60, max_message_length=MAX_MESSAGE_LENGTH,
+                 observe_post=None):
+        self._loop = loop
+        self.api_url = api_url
+        self.max_pending = max_pending
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.max_message_length = max_message_length
+        # Called with the duration in seconds of each post attempt.
+        self._observe_post = observe_post
+        self._session = None
+        # bot id -> (queue, worker task)
+        self._bots = {}
+
+    async def start(self):
+        '''Creates the http session.  Must be run on the sender's loop.'''
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def enqueue(self, bot_id, text):
+        '''Queues text to be posted as bot_id.  Must be called on the sender's loop.
+
+           Returns an asyncio future resolving to whether it was posted.'''
+        if bot_id not in self._bots:
+            queue = asyncio.Queue(maxsize=self.max_pending)
+            # The worker posts for every message to come, so it should not run
+            # in the context (e.g. the logging correlation id) of this one.
+            worker = contextvars.Context().run(self._loop.create_task,
+                                               self._worker(bot_id, queue))
+            self._bots[bot_id] = (queue, worker)
+        queue = self._bots[bot_id][0]
+
+        pieces = split_message(text, self.max_message_length)
+        futures = [self._loop.create_future() for _ in pieces]
+        if queue.maxsize and queue.qsize() + len(pieces) > queue.maxsize:
+            _LOGGER.error('groupme queue for bot %s is full, dropping message', bot_id)
+            for future in futures:
+                future.set_result(False)
+        else:
+            for piece, future in zip(pieces, futures):
+                queue.put_nowait((piece, future))
+
+        result = self._loop.create_future()
+
+        def all_posted(_):
+            if not result.done():
+                result.set_result(all(f.result() for f in futures))
+        asyncio.gather(*futures).add_done_callback(all_posted)
+        return result
+
+    async def send(self, bot_id, text):
+        '''Posts text as bot_id.  Returns whether it was posted.'''
+        return await self.enqueue(bot_id, text)
+
+    def send_threadsafe(self, bot_id, text):
+        '''Like send, but may be called from any thread (including the loop's own).
+           Returns a concurrent.futures.Future resolving to whether it was posted.'''
+        return asyncio.run_coroutine_threadsafe(self.send(bot_id, text), self._loop)
+
+    async def _worker(self, bot_id, queue):
+        # A message taken from the queue that did not fit in the previous post.
+        carried = None
+        while True:
+            text, future = carried if carried is not None else await queue.get()
+            carried = None
+            futures = [future]
+            # Combine whatever else is already waiting, up to the length limit.
+            while not queue.empty():
+                next_text, next_future = queue.get_nowait()
+                if len(text) + 1 + len(next_text) > self.max_message_length:
+                    carried = (next_text, next_future)
+                    break
+                text += '\n' + next_text
+                futures.append(next_future)
+
+            try:
+                posted = await self._post(bot_id, text)
+            except Exception as e:
+                _LOGGER.error('Error send groupme message: %s', repr(e))
+                posted = False
+            for future in futures:
+                if not future.done():
+                    future.set_result(posted)
+                queue.task_done()
+
+    def _retry_delay(self, attempt, response=None):
+        if response is not None:
+            try:
+                return min(self.max_backoff,
+                           max(0, float(response.headers['Retry-After'])))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return min(self.max_backoff, self.backoff_base * 2 ** attempt)
+
+    async def _post(self, bot_id, text):
+        '''Posts text as bot_id, retrying transient failures.  Returns whether it
+           was posted.'''
+        for attempt in range(self.max_retries + 1):
+            retry_response = None
+            start = time.monotonic()
+            try:
+                async with self._session.post(self.api_url,
+                                              data={'bot_id': bot_id, 'text': text}) as response:
+                    await response.read()
+                    if response.status < 300:
+                        return True
+                    if response.status != 429 and response.status < 500:
+                        _LOGGER.error('Could not send groupme message for bot %s: %d %s',
+                                      bot_id, response.status, response.reason)
+                        return False
+                    _LOGGER.warning('groupme returned %d for bot %s, retrying',
+                                    response.status, bot_id)
+                    retry_response = response
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                _LOGGER.warning('could not reach groupme for bot %s: %s', bot_id, repr(e))
+            finally:
+                if self._observe_post is not None:
+                    self._observe_post(time.monotonic() - start)
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._retry_delay(attempt, retry_response))
+        _LOGGER.error('Giving up sending groupme message for bot %s after %d attempts',
+                      bot_id, self.max_retries + 1)
+        return False
+
+    async def join(self):
+        '''Waits until everything currently queued has been posted (or dropped).'''
+        for queue, _ in list(self._bots.values()):
+            await queue.join()
+
+    async def stop(self):
+        '''Cancels the workers, abandoning anything queued, and closes the session.'''
+        tasks = [task for _, task in self._bots.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._bots = {}
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
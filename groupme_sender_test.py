@@ -0,0 +1,112 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+
+import groupme_sender
+
+
+class FakeGroupMe:
+    '''Records posts; answers the first len(statuses) posts with those statuses.'''
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.posts = []
+
+    async def handle(self, request):
+        data = await request.post()
+        if self.statuses:
+            status = self.statuses.pop(0)
+            if status != 202:
+                return web.Response(status=status, headers={'Retry-After': '0'})
+        self.posts.append((data['bot_id'], data['text']))
+        return web.Response(status=202)
+
+
+class TestSplitMessage(unittest.TestCase):
+    def test_split_message(self):
+        self.assertEqual(groupme_sender.split_message('short', 10), ['short'])
+        self.assertEqual(groupme_sender.split_message('', 10), [''])
+        self.assertEqual(groupme_sender.split_message('one two three four', 10),
+                         ['one two', 'three four'])
+        self.assertEqual(groupme_sender.split_message('line one\nline two', 12),
+                         ['line one', 'line two'])
+        self.assertEqual(groupme_sender.split_message('x' * 25, 10),
+                         ['x' * 10, 'x' * 10, 'x' * 5])
+
+
+class TestGroupMeSender(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.senders = []
+        self.runner = None
+
+    def tearDown(self):
+        for sender in self.senders:
+            self.loop.run_until_complete(sender.stop())
+        if self.runner is not None:
+            self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def make_sender(self, fake, **kwargs):
+        async def start():
+            app = web.Application()
+            app.router.add_post('/v3/bots/post', fake.handle)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, '127.0.0.1', 0)
+            await site.start()
+            host, port = self.runner.addresses[0][:2]
+            sender = groupme_sender.GroupMeSender(
+                self.loop, api_url='http://%s:%d/v3/bots/post' % (host, port),
+                backoff_base=0, **kwargs)
+            await sender.start()
+            self.senders.append(sender)
+            return sender
+        return self.loop.run_until_complete(start())
+
+    def test_send_in_order(self):
+        fake = FakeGroupMe()
+        sender = self.make_sender(fake, max_message_length=20)
+
+        async def run():
+            results = [sender.enqueue('bot1', 'message %d' % i) for i in range(4)]
+            results.append(sender.enqueue('bot2', 'other bot'))
+            return await asyncio.gather(*results)
+
+        self.assertEqual(self.loop.run_until_complete(run()), [True] * 5)
+        # They were all waiting by the time the worker ran, so they are combined
+        # as far as the length limit allows.
+        self.assertEqual([text for bot, text in fake.posts if bot == 'bot1'],
+                         ['message 0\nmessage 1', 'message 2\nmessage 3'])
+        self.assertIn(('bot2', 'other bot'), fake.posts)
+
+    def test_retries(self):
+        fake = FakeGroupMe(statuses=[429, 503])
+        sender = self.make_sender(fake)
+        self.assertTrue(self.loop.run_until_complete(sender.send('bot1', 'hello')))
+        self.assertEqual(fake.posts, [('bot1', 'hello')])
+
+        # Not worth retrying.
+        fake = FakeGroupMe(statuses=[400])
+        sender = self.make_sender(fake)
+        self.assertFalse(self.loop.run_until_complete(sender.send('bot1', 'hello')))
+
+        # Retried, but never succeeds.
+        fake = FakeGroupMe(statuses=[500] * 3)
+        sender = self.make_sender(fake, max_retries=2)
+        self.assertFalse(self.loop.run_until_complete(sender.send('bot1', 'hello')))
+        self.assertEqual(fake.posts, [])
+
+    def test_full_queue(self):
+        fake = FakeGroupMe()
+        sender = self.make_sender(fake, max_pending=2)
+
+        async def run():
+            results = [sender.enqueue('bot1', 'message %d' % i) for i in range(3)]
+            return await asyncio.gather(*results)
+
+        self.assertEqual(self.loop.run_until_complete(run()), [True, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# Module for choosing which of several copies of the bridge relays messages,
+# using a lease kept in redis, so that a standby copy can take over quickly.
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+
+import redis
+
+_LOGGER = logging.getLogger(__name__)
+
+# Extends the lease at KEYS[1] to ARGV[2] milliseconds if ARGV[1] holds it.
+_RENEW_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+# Gives up the lease at KEYS[1] if ARGV[1] holds it.
+_RELEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+def default_holder():
+    '''An id for this process, unique among the copies of the bridge.'''
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class RedisLease:
+    '''A lease on being the leader, which at most one process holds at a time.
+
+       The lease is the redis key key, holding the holder's id and expiring ttl
+       seconds after it was last renewed.  The holder renews it every
+       renew_interval seconds (see hold()); everyone else tries to take it as
+       often (see wait_until_elected()), so a holder that dies is replaced
+       within about ttl seconds, or straight away if it released the lease on
+       the way out.
+
+       A holder that cannot reach redis counts the lease as lost once it is
+       within renew_interval of expiring, since by then another process may be
+       about to take it: a renewal that fails, or has not been answered by then,
+       loses the lease.  Everything must be used on the event loop of
+       redis_async.'''
+
+    def __init__(self, redis_async, key, ttl=10, renew_interval=2, holder=None,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        if renew_interval * 2 > ttl:
+            raise ValueError('the lease must outlast two renewals')
+        self.redis = redis_async
+        self.key = key
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.holder = holder or default_holder()
+        self._clock = clock
+        self._sleep = sleep
+        self.is_leader = False
+        # When the lease was last taken or renewed, by the clock.
+        self._renewed = None
+
+    @property
+    def _ttl_ms(self):
+        return int(self.ttl * 1000)
+
+    async def try_acquire(self):
+        '''Takes the lease if nobody holds it.  Returns whether we hold it.'''
+        if self.is_leader:
+            return await self.renew()
+        started = self._clock()
+        try:
+            acquired = await self.redis.set(self.key, self.holder, nx=True,
+                                            px=self._ttl_ms)
+        except redis.RedisError as e:
+            _LOGGER.warning('could not try for the leader lease: %s', repr(e))
+            return False
+        if acquired:
+            self.is_leader = True
+            self._renewed = started
+        return self.is_leader
+
+    async def renew(self):
+        '''Extends the lease.  Returns whether we still hold it.'''
+        if not self.is_leader:
+            return False
+        started = self._clock()
+        # After this, someone else may take the lease before we hear back.
+        deadline = self._renewed + self.ttl - self.renew_interval
+        try:
+            renewed = await asyncio.wait_for(
+                self.redis.eval(_RENEW_SCRIPT, 1, self.key, self.holder,
+                                self._ttl_ms),
+                max(0, deadline - started))
+        except asyncio.TimeoutError:
+            _LOGGER.warning('timed out renewing the leader lease')
+            renewed = False
+        except redis.RedisError as e:
+            _LOGGER.warning('could not renew the leader lease: %s', repr(e))
+            renewed = self._clock() < deadline
+        else:
+            if renewed:
+                self._renewed = started
+        if not renewed:
+            self.is_leader = False
+        return self.is_leader
+
+    async def release(self):
+        '''Gives up the lease, if we hold it, so another process can take it
+           without waiting for it to expire.'''
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        try:
+            await self.redis.eval(_RELEASE_SCRIPT, 1, self.key, self.holder)
+        except redis.RedisError as e:
+            _LOGGER.warning('could not release the leader lease: %s', repr(e))
+
+    async def wait_until_elected(self):
+        '''Returns once we hold the lease.'''
+        while not await self.try_acquire():
+            await self._sleep(self.renew_interval)
+        _LOGGER.info('%s holds the leader lease', self.holder)
+
+    async def hold(self):
+        '''Keeps renewing the lease, and returns once it has been lost.'''
+        while await self.renew():
+            await self._sleep(self.renew_interval)
+        _LOGGER.error('%s lost the leader lease', self.holder)
@@ -0,0 +1,144 @@
+import asyncio
+import unittest
+
+import redis
+
+import leader
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeRedis:
+    '''Just enough of an asyncio redis client for the lease, with keys expiring
+       by clock.'''
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.values = {}
+        self.fail = False
+        self.hang = False
+
+    def _get(self, key):
+        value, expires = self.values.get(key, (None, None))
+        if value is not None and expires <= self.clock():
+            del self.values[key]
+            return None
+        return value
+
+    async def set(self, key, value, nx=False, px=None):
+        if self.fail:
+            raise redis.ConnectionError('redis is down')
+        if nx and self._get(key) is not None:
+            return None
+        self.values[key] = (value, self.clock() + px / 1000)
+        return True
+
+    async def eval(self, script, numkeys, key, holder, *args):
+        if self.hang:
+            # e.g. a half-open connection.
+            await asyncio.get_running_loop().create_future()
+        if self.fail:
+            raise redis.ConnectionError('redis is down')
+        if self._get(key) != holder:
+            return 0
+        if script == leader._RENEW_SCRIPT:
+            self.values[key] = (holder, self.clock() + int(args[0]) / 1000)
+        elif script == leader._RELEASE_SCRIPT:
+            del self.values[key]
+        return 1
+
+
+class TestRedisLease(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.redis = FakeRedis(self.clock)
+
+    def lease(self, holder):
+        return leader.RedisLease(self.redis, 'test:leader', ttl=10, renew_interval=2,
+                                 holder=holder, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_one_leader(self):
+        a, b = self.lease('a'), self.lease('b')
+        self.assertTrue(asyncio.run(a.try_acquire()))
+        self.assertFalse(asyncio.run(b.try_acquire()))
+        self.assertTrue(a.is_leader)
+        self.assertFalse(b.is_leader)
+
+        # Renewing keeps the lease past its ttl.
+        for _ in range(10):
+            self.clock.now += 2
+            self.assertTrue(asyncio.run(a.renew()))
+            self.assertFalse(asyncio.run(b.try_acquire()))
+
+    def test_takeover_when_leader_dies(self):
+        a, b = self.lease('a'), self.lease('b')
+        asyncio.run(a.try_acquire())
+        # a stops renewing; b takes over once the lease expires.
+        asyncio.run(b.wait_until_elected())
+        self.assertEqual(self.clock.now, 10)
+        self.assertTrue(b.is_leader)
+
+        # a notices, and holding returns.
+        asyncio.run(a.hold())
+        self.assertFalse(a.is_leader)
+        self.assertTrue(asyncio.run(b.renew()))
+
+    def test_release(self):
+        a, b = self.lease('a'), self.lease('b')
+        asyncio.run(a.try_acquire())
+        asyncio.run(a.release())
+        self.assertFalse(a.is_leader)
+        self.assertTrue(asyncio.run(b.try_acquire()))
+        # Releasing a lease we do not hold leaves it alone.
+        asyncio.run(a.release())
+        self.assertTrue(asyncio.run(b.renew()))
+
+    def test_redis_down(self):
+        a = self.lease('a')
+        asyncio.run(a.try_acquire())
+        self.redis.fail = True
+        # Held while it surely has not expired, then given up in time for
+        # anyone else to take it.
+        asyncio.run(a.hold())
+        self.assertFalse(a.is_leader)
+        self.assertLess(self.clock.now, 10)
+
+        b = self.lease('b')
+        self.assertFalse(asyncio.run(b.try_acquire()))
+        self.redis.fail = False
+        self.clock.now = 10
+        self.assertTrue(asyncio.run(b.try_acquire()))
+
+    def test_redis_hangs(self):
+        a = self.lease('a')
+        asyncio.run(a.try_acquire())
+        self.redis.hang = True
+        # The renewal goes unanswered; the lease is given up once it could be
+        # taken by anyone else, which here is straight away.
+        self.clock.now = 8
+        asyncio.run(asyncio.wait_for(a.hold(), 5))
+        self.assertFalse(a.is_leader)
+
+        # With a little time left, the renewal waits for as long as that.
+        self.clock.now = 10
+        self.assertTrue(asyncio.run(a.try_acquire()))
+        self.clock.now = 17.95
+        asyncio.run(asyncio.wait_for(a.hold(), 5))
+        self.assertFalse(a.is_leader)
+
+    def test_bad_intervals(self):
+        with self.assertRaises(ValueError):
+            leader.RedisLease(self.redis, 'test:leader', ttl=3, renew_interval=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,773 @@
+# End-to-end load generator for the bridge.
+#
+# Runs the real SlackBridge (RTM handler, zulip listener, groupme listeners and
+# all) against in-process stand-ins for slack (web API and RTM websocket),
+# zulip and groupme, replays a configurable mix of messages through it, and
+# reports throughput and latency percentiles for each relay path.  Only redis is
+# real: point --redis-* at a scratch instance, as keys under --redis-prefix are
+# deleted when the run starts.
+#
+#   python loadtest.py --messages 2000 --rate 100
+#   python loadtest.py --mix plain=50,edit=20,delete=10,file=20 --channels 10
+#   python loadtest.py --rate 0 --json results.json     # as fast as it will go
+#
+# Every operation carries a unique token in its text, which the stand-ins look
+# for in what the bridge sends them; latency is measured from the driver handing
+# an operation to a stand-in to the bridge delivering it to each destination.
+
+import argparse
+import asyncio
+import collections
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import types
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from aiohttp import web
+import redis
+import requests
+
+import slack_reformat_bench
+
+_LOGGER = logging.getLogger(__name__)
+
+_BRIDGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__init__.py')
+
+SLACK_BOT_ID = 'UBRIDGE00'
+SLACK_ERR_CHANNEL = 'DERRORS00'
+BOT_USER_ID = 'UBOT00000'
+ZULIP_BOT_EMAIL = 'bridge-bot@zulip.example.com'
+PUBLIC_STREAM = 'loadtest'
+LOG_PUBLIC_STREAM = 'loadtest-log'
+LOG_PRIVATE_STREAM = 'loadtest-log-private'
+
+MESSAGE_KINDS = ('plain', 'edit', 'edit_burst', 'delete', 'bot', 'file', 'zulip',
+                 'zulip_edit', 'zulip_delete', 'groupme')
+DEFAULT_MIX = ('plain=50,edit=10,delete=5,bot=10,file=5,zulip=10,zulip_edit=3,'
+               'zulip_delete=2,groupme=10')
+
+_TOKEN_MATCH = re.compile(r'\blt(\d{8})\b')
+
+
+def _token(n):
+    return 'lt%08d' % n
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    '''Nearest-rank percentile of an already sorted, non-empty list.'''
+    index = max(0, min(len(sorted_values) - 1,
+                       int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    '''Matches what the stand-ins receive against what the driver sent.
+
+       Safe to use from any thread.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # token -> (kind, time sent)
+        self._sent = {}
+        # token of a deleted message -> token of the delete operation
+        self._deletes = {}
+        self._seen = set()
+        self.latencies = collections.defaultdict(list)
+        self.sent_by_kind = collections.Counter()
+        self.first_sent = None
+        self.last_arrival = None
+
+    def reset(self):
+        with self._lock:
+            self._sent.clear()
+            self._deletes.clear()
+            self._seen.clear()
+            self.latencies.clear()
+            self.sent_by_kind.clear()
+            self.first_sent = None
+            self.last_arrival = None
+
+    def sent(self, token, kind, deletes=None):
+        now = time.monotonic()
+        with self._lock:
+            self._sent[token] = (kind, now)
+            self.sent_by_kind[kind] += 1
+            if self.first_sent is None:
+                self.first_sent = now
+            if deletes is not None:
+                self._deletes[deletes] = token
+
+    def _arrived(self, token, destination, now):
+        sent = self._sent.get(token)
+        if sent is None or (token, destination) in self._seen:
+            return
+        self._seen.add((token, destination))
+        kind, sent_at = sent
+        self.latencies[(kind, destination)].append(now - sent_at)
+        self.last_arrival = now
+
+    def arrived(self, text, destination):
+        '''Records the arrival at destination of every token in text.  (Several
+           messages may arrive in one post.)'''
+        now = time.monotonic()
+        with self._lock:
+            for match in _TOKEN_MATCH.finditer(text or ''):
+                self._arrived(match.group(0), destination, now)
+
+    def deleted(self, token, destination):
+        '''Records the arrival at destination of the delete of the message with token.'''
+        now = time.monotonic()
+        with self._lock:
+            delete_token = self._deletes.get(token)
+            if delete_token is not None:
+                self._arrived(delete_token, destination, now)
+
+    def wait_idle(self, idle, timeout):
+        '''Waits until nothing has arrived for idle seconds, or for timeout seconds.'''
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                last = self.last_arrival or self.first_sent or time.monotonic()
+            if time.monotonic() - last >= idle:
+                return True
+            time.sleep(0.1)
+        return False
+
+    def results(self):
+        '''Returns a dict of relay path -> summary of its latencies (in seconds).'''
+        with self._lock:
+            elapsed = ((self.last_arrival or 0) - (self.first_sent or 0)) or None
+            results = {}
+            for (kind, destination), values in sorted(self.latencies.items()):
+                values = sorted(values)
+                results['%s -> %s' % (kind, destination)] = {
+                    'sent': self.sent_by_kind[kind],
+                    'delivered': len(values),
+                    'per_sec': len(values) / elapsed if elapsed else 0,
+                    'p50': percentile(values, 0.5),
+                    'p90': percentile(values, 0.9),
+                    'p99': percentile(values, 0.99),
+                    'max': values[-1],
+                }
+            return results
+
+
+class FakeSlack:
+    '''Slack's web API and RTM websocket, on an event loop of its own.'''
+
+    def __init__(self, recorder, channels, users, file_size):
+        self.recorder = recorder
+        # channel id -> (name, is_private)
+        self.channels = channels
+        self.users = users
+        self.file_data = b'x' * file_size
+        self.error_posts = 0
+        self.connected = threading.Event()
+        self.url = None
+        self._loop = asyncio.new_event_loop()
+        self._outgoing = None
+        self._ts = 0
+        # ts -> token of the messages posted
+        self._tokens = {}
+
+    def start(self):
+        ready = threading.Event()
+        thread = threading.Thread(target=self._run, args=(ready,), name='fake-slack')
+        thread.daemon = True
+        thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_route('*', '/api/{method}', self._api)
+        app.router.add_get('/rtm', self._rtm)
+        app.router.add_get('/files/{file_id}/{name}', self._file)
+        runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        self._loop.run_until_complete(site.start())
+        host, port = runner.addresses[0][:2]
+        self.url = 'http://%s:%d/' % (host, port)
+        self._outgoing = asyncio.Queue()
+        ready.set()
+        self._loop.run_forever()
+
+    def push(self, event):
+        '''Delivers an event over the RTM websocket.  May be called from any thread.'''
+        self._loop.call_soon_threadsafe(self._outgoing.put_nowait, event)
+
+    def _next_ts(self):
+        self._ts += 1
+        return '%d.%06d' % (time.time(), self._ts % 1000000)
+
+    async def _rtm(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({'type': 'hello'})
+        self.connected.set()
+        sender = asyncio.ensure_future(self._send_events(ws))
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            sender.cancel()
+        return ws
+
+    async def _send_events(self, ws):
+        while True:
+            await ws.send_json(await self._outgoing.get())
+
+    async def _file(self, request):
+        return web.Response(body=self.file_data, content_type='application/octet-stream')
+
+    async def _api(self, request):
+        args = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == 'application/json':
+                args.update(await request.json())
+            else:
+                args.update(await request.post())
+        method = request.match_info['method']
+        handler = getattr(self, '_api_' + method.replace('.', '_'), None)
+        if handler is None:
+            return web.json_response({'ok': False, 'error': 'unknown_method'})
+        return web.json_response(handler(args))
+
+    def _api_rtm_connect(self, args):
+        return {'ok': True, 'url': self.url.replace('http', 'ws', 1) + 'rtm',
+                'self': {'id': SLACK_BOT_ID, 'name': 'bridge'},
+                'team': {'id': 'T00000000', 'domain': 'loadtest'}}
+
+    def _api_users_info(self, args):
+        user_id = args['user']
+        return {'ok': True, 'user': {'id': user_id, 'name': user_id.lower(),
+                                     'profile': {'display_name': self.users.get(user_id, '')}}}
+
+    @staticmethod
+    def _page(items, args, field):
+        start = int(args.get('cursor') or 0)
+        end = start + int(args.get('limit') or 100)
+        return {'ok': True, field: items[start:end],
+                'response_metadata': {'next_cursor': str(end) if end < len(items) else ''}}
+
+    def _api_users_list(self, args):
+        return self._page([self._api_users_info({'user': user_id})['user']
+                           for user_id in self.users], args, 'members')
+
+    def _api_conversations_list(self, args):
+        return self._page([self._api_conversations_info({'channel': channel_id})['channel']
+                           for channel_id in self.channels], args, 'channels')
+
+    def _api_bots_info(self, args):
+        return {'ok': True, 'bot': {'id': args['bot'], 'user_id': BOT_USER_ID}}
+
+    def _api_conversations_info(self, args):
+        channel_id = args['channel']
+        if channel_id.startswith('D'):
+            return {'ok': True, 'channel': {'id': channel_id, 'is_im': True,
+                                            'user': 'U00000000'}}
+        name, is_private = self.channels[channel_id]
+        return {'ok': True, 'channel': {'id': channel_id, 'name': name,
+                                        'is_channel': not is_private,
+                                        'is_group': is_private, 'is_mpim': False}}
+
+    def _api_im_open(self, args):
+        return {'ok': True, 'channel': {'id': 'D' + args['user'][1:]}}
+
+    def _api_chat_postMessage(self, args):
+        channel = args['channel']
+        ts = self._next_ts()
+        if channel == SLACK_ERR_CHANNEL:
+            self.error_posts += 1
+        elif not channel.startswith('D'):
+            self.recorder.arrived(args.get('text'), 'slack')
+            match = _TOKEN_MATCH.search(args.get('text') or '')
+            if match:
+                self._tokens[ts] = match.group(0)
+        return {'ok': True, 'channel': channel, 'ts': ts,
+                'message': {'text': args.get('text')}}
+
+    def _api_chat_update(self, args):
+        self.recorder.arrived(args.get('text'), 'slack/update')
+        return {'ok': True, 'channel': args['channel'], 'ts': args['ts']}
+
+    def _api_chat_delete(self, args):
+        token = self._tokens.get(args['ts'])
+        if token is not None:
+            self.recorder.deleted(token, 'slack/delete')
+        return {'ok': True, 'channel': args['channel'], 'ts': args['ts']}
+
+
+class _FakeHTTPHandler(BaseHTTPRequestHandler):
+    '''Request handler for the http.server based stand-ins, which dispatches to
+       methods of self.server.service.'''
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        url = urllib.parse.urlsplit(self.path)
+        args = dict(urllib.parse.parse_qsl(url.query))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            args.update(urllib.parse.parse_qsl(body.decode('utf-8')))
+        status, response = self.server.service.handle(self.command, url.path, args)
+        data = json.dumps(response).encode('utf-8') if response is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FakeHTTPService:
+    def start(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), _FakeHTTPHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = self
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  name=type(self).__name__)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def handle(self, method, path, args):
+        raise NotImplementedError
+
+
+class FakeZulip(_FakeHTTPService):
+    '''Zulip's REST API, including an event queue for the bridge to long-poll.'''
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self._lock = threading.Condition()
+        self._next_id = 1
+        # zulip message id -> token of the message as first sent
+        self._tokens = {}
+        self._events = []
+        # queue id -> the stream its message events are narrowed to, or None
+        self._queues = {}
+
+    def push_event(self, event):
+        '''Queues an event for the bridge to receive.'''
+        with self._lock:
+            self._events.append(dict(event, id=len(self._events)))
+            self._lock.notify_all()
+
+    def push_message(self, message):
+        self.push_event({'type': 'message', 'message': message})
+
+    def _register(self, args):
+        stream = None
+        for operator, operand in json.loads(args.get('narrow', '[]')):
+            if operator == 'stream':
+                stream = operand
+        with self._lock:
+            queue_id = 'loadtest-%d' % len(self._queues)
+            self._queues[queue_id] = stream
+            return queue_id, len(self._events) - 1
+
+    def _get_events(self, queue_id, last_event_id):
+        stream = self._queues[queue_id]
+        with self._lock:
+            self._lock.wait_for(lambda: len(self._events) > last_event_id + 1, timeout=1)
+            return [event for event in self._events[last_event_id + 1:]
+                    if stream is None or event['type'] != 'message' or
+                    event['message'].get('display_recipient') == stream]
+
+    def handle(self, method, path, args):
+        path = path[len('/api/v1/'):] if path.startswith('/api/v1/') else path
+        if path == 'server_settings':
+            return 200, {'result': 'success', 'zulip_version': '4.0',
+                         'zulip_feature_level': 0}
+        if path == 'register':
+            queue_id, last_event_id = self._register(args)
+            return 200, {'result': 'success', 'queue_id': queue_id,
+                         'last_event_id': last_event_id}
+        if path == 'events':
+            queue_id = args.get('queue_id')
+            if queue_id not in self._queues:
+                return 400, {'result': 'error', 'code': 'BAD_EVENT_QUEUE_ID',
+                             'msg': 'Bad event queue id: %s' % queue_id}
+            return 200, {'result': 'success',
+                         'events': self._get_events(queue_id,
+                                                    int(args.get('last_event_id', -1)))}
+        if path == 'user_uploads':
+            return 200, {'result': 'success', 'uri': '/user_uploads/1/lt/file'}
+        if path == 'messages' and method == 'POST':
+            destination = 'zulip/' + args.get('to', '')
+            with self._lock:
+                message_id = self._next_id
+                self._next_id += 1
+                match = _TOKEN_MATCH.search(args.get('content', ''))
+                if match:
+                    self._tokens[message_id] = match.group(0)
+            self.recorder.arrived(args.get('content'), destination)
+            return 200, {'result': 'success', 'id': message_id}
+        if path.startswith('messages/'):
+            message_id = int(path.split('/')[1])
+            if method == 'PATCH':
+                self.recorder.arrived(args.get('content'), 'zulip/update')
+            elif method == 'DELETE':
+                token = self._tokens.get(message_id)
+                if token is not None:
+                    self.recorder.deleted(token, 'zulip/delete')
+            return 200, {'result': 'success'}
+        return 404, {'result': 'error', 'msg': 'unknown endpoint ' + path}
+
+
+class FakeGroupMe(_FakeHTTPService):
+    '''GroupMe's bot post API.'''
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def handle(self, method, path, args):
+        if path == '/v3/bots/post':
+            self.recorder.arrived(args.get('text'), 'groupme')
+            return 202, None
+        return 404, None
+
+
+def make_local_secrets(zulip_url, channel_names, redis_args):
+    '''Returns a stand-in for the local_secrets module configuring the bridge
+       to use the fakes.'''
+    secrets = types.ModuleType('local_secrets')
+    secrets.SLACK_BOT_ID = SLACK_BOT_ID
+    secrets.ZULIP_BOT_NAME = 'bridge-bot'
+    secrets.ZULIP_BOT_EMAIL = ZULIP_BOT_EMAIL
+    secrets.ZULIP_API_KEY = 'loadtest'
+    secrets.ZULIP_URL = zulip_url
+    secrets.SLACK_TOKEN = 'xoxb-loadtest'
+    secrets.SLACK_ERR_CHANNEL = SLACK_ERR_CHANNEL
+    secrets.PUBLIC_TWO_WAY = channel_names
+    secrets.PUBLIC_TWO_WAY_STREAM = PUBLIC_STREAM
+    secrets.ZULIP_LOG_ENABLE = True
+    secrets.ZULIP_LOG_PUBLIC_STREAM = LOG_PUBLIC_STREAM
+    secrets.ZULIP_LOG_PRIVATE_STREAM = LOG_PRIVATE_STREAM
+    secrets.REDIS_HOSTNAME = redis_args.redis_host
+    secrets.REDIS_PORT = redis_args.redis_port
+    secrets.REDIS_PASSWORD = redis_args.redis_password
+    secrets.SLACK_EDIT_UPDATE_ZULIP_TTL = 60*60
+    secrets.REDIS_PREFIX = redis_args.redis_prefix
+    secrets.GROUPME_ENABLE = True
+    secrets.SSL_CERT_CHAIN_PATH = ''
+    secrets.SSL_CERT_KEY_PATH = ''
+    secrets.GROUPME_TWO_WAY = {
+        name: {'BOT_ID': 'bot-' + name, 'BOT_NAME': 'bridge'}
+        for name in channel_names
+    }
+    return secrets
+
+
+def load_bridge_module(secrets):
+    '''Imports the bridge (__init__.py) with secrets as its local_secrets.'''
+    sys.modules['local_secrets'] = secrets
+    spec = importlib.util.spec_from_file_location('zulip_slack_bridge', _BRIDGE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in MESSAGE_KINDS:
+            raise argparse.ArgumentTypeError('unknown message kind %r, expected one of %s' %
+                                             (kind, ', '.join(MESSAGE_KINDS)))
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+class Driver:
+    '''Generates operations and hands them to the stand-ins.'''
+
+    def __init__(self, recorder, fake_slack, fake_zulip, channels, users, groupme_url,
+                 seed=0):
+        self.recorder = recorder
+        self.fake_slack = fake_slack
+        self.fake_zulip = fake_zulip
+        # [(channel id, name, is_private)]
+        self.channels = channels
+        self.users = sorted(users)
+        # Where the bridge receives groupme callbacks, less the channel name.
+        self.groupme_url = groupme_url
+        self.random = random.Random(seed)
+        self.session = requests.Session()
+        self._count = 0
+        # Recent plain slack messages, for edits and deletes to refer to.
+        self._history = collections.deque(maxlen=1000)
+        # Likewise (id, token) of recent zulip messages.
+        self._zulip_history = collections.deque(maxlen=1000)
+
+    def _next(self, kind, deletes=None):
+        self._count += 1
+        token = _token(self._count)
+        self.recorder.sent(token, kind, deletes=deletes)
+        return token
+
+    def _ts(self):
+        return '%.6f' % (time.time() + self._count / 1e6)
+
+    def _text(self, token):
+        words = ['load', 'in', 'at', 'five', 'bring', 'the', 'gaff', 'tape', 'cables']
+        text = ' '.join(self.random.sample(words, 4)) + ' ' + token
+        if self.random.random() < 0.3:
+            text += ' cc <@%s>' % self.random.choice(self.users)
+        return text
+
+    def _slack_message(self, kind, channel=None, user=None):
+        channel_id, _, _ = channel or self.random.choice(self.channels)
+        message = {
+            'type': 'message',
+            'channel': channel_id,
+            'user': user or self.random.choice(self.users),
+            'text': self._text(self._next(kind)),
+            'ts': self._ts(),
+            'client_msg_id': 'loadtest-%d' % self._count,
+        }
+        return message
+
+    def plain(self, channel=None, user=None):
+        message = self._slack_message('plain', channel, user)
+        self._history.append(message)
+        self.fake_slack.push(message)
+
+    def edit(self):
+        if not self._history:
+            return self.plain()
+        original = self.random.choice(self._history)
+        edited = dict(original, text=self._text(self._next('edit')),
+                      edited={'user': original['user'], 'ts': self._ts()})
+        self.fake_slack.push({'type': 'message', 'subtype': 'message_changed',
+                              'hidden': True, 'channel': original['channel'],
+                              'message': edited, 'previous_message': original,
+                              'ts': self._ts()})
+
+    def edit_burst(self):
+        '''Several quick edits of one message, as slack sends while unfurling
+           links.  Only the last should be relayed.'''
+        if not self._history:
+            return self.plain()
+        original = self.random.choice(self._history)
+        for _ in range(self.random.randint(3, 5)):
+            edited = dict(original, text=self._text(self._next('edit_burst')),
+                          edited={'user': original['user'], 'ts': self._ts()})
+            self.fake_slack.push({'type': 'message', 'subtype': 'message_changed',
+                                  'hidden': True, 'channel': original['channel'],
+                                  'message': edited, 'previous_message': original,
+                                  'ts': self._ts()})
+
+    def delete(self):
+        if not self._history:
+            return self.plain()
+        original = self._history.pop()
+        token = _TOKEN_MATCH.search(original['text']).group(0)
+        # Tag the text with the delete's own token instead, for the stand-ins
+        # that are sent the text of the deleted message.
+        deleted = dict(original, text=original['text'].replace(
+            token, self._next('delete', deletes=token)))
+        self.fake_slack.push({'type': 'message', 'subtype': 'message_deleted',
+                              'hidden': True, 'channel': original['channel'],
+                              'previous_message': deleted,
+                              'deleted_ts': original['ts'], 'ts': self._ts()})
+
+    def bot(self):
+        channel_id, _, _ = self.random.choice(self.channels)
+        self.fake_slack.push({'type': 'message', 'subtype': 'bot_message',
+                              'bot_id': 'B00000001', 'channel': channel_id,
+                              'text': 'Alert ' + self._next('bot'),
+                              'attachments': slack_reformat_bench.BOT_ATTACHMENTS,
+                              'ts': self._ts()})
+
+    def file(self):
+        message = self._slack_message('file')
+        file_id = 'F%08d' % self._count
+        message['files'] = [{
+            'id': file_id,
+            'name': 'photo.jpg',
+            'title': 'photo',
+            'size': len(self.fake_slack.file_data),
+            'url_private': '%sfiles/%s/photo.jpg' % (self.fake_slack.url, file_id),
+        }]
+        self.fake_slack.push(message)
+
+    def zulip(self):
+        _, name, _ = self.random.choice([c for c in self.channels if not c[2]])
+        token = self._next('zulip')
+        self._zulip_history.append((self._count, token))
+        self.fake_zulip.push_message({
+            'id': self._count, 'type': 'stream',
+            'display_recipient': PUBLIC_STREAM, 'subject': name,
+            'sender_email': 'someone@zulip.example.com',
+            'sender_full_name': 'Someone', 'content': self._text(token),
+        })
+
+    def zulip_edit(self):
+        if not self._zulip_history:
+            return self.zulip()
+        message_id, _ = self.random.choice(self._zulip_history)
+        self.fake_zulip.push_event({
+            'type': 'update_message', 'message_id': message_id,
+            'edit_timestamp': self._ts(),
+            'content': self._text(self._next('zulip_edit')),
+        })
+
+    def zulip_delete(self):
+        if not self._zulip_history:
+            return self.zulip()
+        message_id, token = self._zulip_history.pop()
+        self._next('zulip_delete', deletes=token)
+        self.fake_zulip.push_event({'type': 'delete_message', 'message_id': message_id,
+                                    'message_type': 'stream'})
+
+    def groupme(self):
+        _, name, _ = self.random.choice([c for c in self.channels if not c[2]])
+        text = self._text(self._next('groupme'))
+        try:
+            self.session.post(self.groupme_url + name,
+                              json={'name': 'Someone', 'text': text, 'attachments': []},
+                              timeout=10)
+        except requests.RequestException as e:
+            _LOGGER.warning('could not post to the groupme listener: %s', e)
+
+    def warm_up(self):
+        '''Sends a message from every user and to every channel, so that the run
+           itself is not dominated by first-time lookups.'''
+        for i, user in enumerate(self.users):
+            self.plain(channel=self.channels[i % len(self.channels)], user=user)
+        for channel in self.channels:
+            self.plain(channel=channel)
+
+    def run(self, messages, rate, mix):
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        start = time.monotonic()
+        for i in range(messages):
+            getattr(self, self.random.choices(kinds, weights)[0])()
+            if rate:
+                delay = start + (i + 1) / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def format_report(results, error_posts):
+    lines = ['%-34s %6s %9s %8s %9s %9s %9s %9s' %
+             ('path', 'sent', 'delivered', 'per sec', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+    for path, r in results.items():
+        lines.append('%-34s %6d %9d %8.1f %9.1f %9.1f %9.1f %9.1f' %
+                     (path, r['sent'], r['delivered'], r['per_sec'], r['p50'] * 1000,
+                      r['p90'] * 1000, r['p99'] * 1000, r['max'] * 1000))
+    if error_posts:
+        lines.append('The bridge posted %d error reports to slack; rerun with '
+                     'LOGLEVEL=error to see them.' % error_posts)
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the bridge end to end.')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='number of operations to send')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='operations per second to send, or 0 for as fast as possible')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='relative weights of the message kinds (%s)' % DEFAULT_MIX)
+    parser.add_argument('--channels', type=int, default=4,
+                        help='number of two-way channels (plus one private channel)')
+    parser.add_argument('--users', type=int, default=50, help='number of slack users')
+    parser.add_argument('--file-size', type=int, default=64 * 1024,
+                        help='size in bytes of each file shared')
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false',
+                        help='include first-time user and channel lookups in the results')
+    parser.add_argument('--drain', type=float, default=5,
+                        help='seconds without deliveries after which the run is over')
+    parser.add_argument('--timeout', type=float, default=300,
+                        help='maximum seconds to wait for deliveries after sending')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='FILE', help='also save the results as json')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-password', default='')
+    parser.add_argument('--redis-prefix', default='zulip.slack.loadtest')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('LOGLEVEL', 'CRITICAL')
+
+    # Start from a clean slate in redis, so runs are comparable.
+    scratch = redis.Redis(host=args.redis_host, port=args.redis_port,
+                          password=args.redis_password)
+    for key in scratch.scan_iter(match=args.redis_prefix + ':*'):
+        scratch.delete(key)
+
+    recorder = LatencyRecorder()
+    channels = [('C%08d' % i, 'lt-%d' % i, False) for i in range(args.channels)]
+    channels.append(('G00000000', 'lt-private', True))
+    users = {'U%08d' % i: 'user%d' % i for i in range(args.users)}
+
+    fake_slack = FakeSlack(recorder, {c[0]: (c[1], c[2]) for c in channels}, users,
+                           args.file_size)
+    fake_zulip = FakeZulip(recorder)
+    fake_groupme = FakeGroupMe(recorder)
+    fake_slack.start()
+    fake_zulip.start()
+    fake_groupme.start()
+
+    two_way = [name for _, name, private in channels if not private]
+    bridge_module = load_bridge_module(make_local_secrets(fake_zulip.url, two_way, args))
+    bridge_module.SLACK_API_URL = fake_slack.url + 'api/'
+    bridge_module.GROUPME_API_URL = fake_groupme.url + '/v3/bots/post'
+    bridge_module.GROUPME_INGRESS_PORT = _free_port()
+
+    bridge = bridge_module.SlackBridge()
+    bridge_thread = threading.Thread(target=bridge.run, name='bridge')
+    bridge_thread.daemon = True
+    bridge_thread.start()
+    if not fake_slack.connected.wait(30):
+        print('The bridge did not connect to the slack RTM stand-in.', file=sys.stderr)
+        return 1
+
+    driver = Driver(recorder, fake_slack, fake_zulip, channels, users,
+                    'http://127.0.0.1:%d/groupme/' % bridge_module.GROUPME_INGRESS_PORT,
+                    seed=args.seed)
+    if args.warm_up:
+        driver.warm_up()
+        recorder.wait_idle(1, args.timeout)
+        recorder.reset()
+
+    driver.run(args.messages, args.rate, args.mix)
+    if not recorder.wait_idle(args.drain, args.timeout):
+        print('Deliveries were still arriving after %d seconds.' % args.timeout,
+              file=sys.stderr)
+
+    results = recorder.results()
+    print(format_report(results, fake_slack.error_posts))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
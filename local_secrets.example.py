@@ -17,6 +17,18 @@ SLACK_ERR_CHANNEL = 'U00000000'
 PUBLIC_TWO_WAY = ['social']
 PUBLIC_TWO_WAY_STREAM = 'abtech'  # Zulip stream for public two-way communications
 
+# Optionally, bridges between slack channels (by name or id), zulip topics (in
+# PUBLIC_TWO_WAY_STREAM) and groupme bots (keys of GROUPME_TWO_WAY), for when the
+# names differ or a channel is bridged to several places.  Each bridge joins two
+# or three of them; a message is relayed to everything it is bridged with.  If
+# BRIDGES is not set, each channel in PUBLIC_TWO_WAY is bridged to the topic of
+# the same name, and each channel in GROUPME_TWO_WAY to its bot.
+# BRIDGES = [
+#     {'slack': 'social', 'zulip': 'social', 'groupme': 'channel-name'},
+#     {'slack': 'announcements', 'zulip': 'general'},
+#     {'slack': 'social', 'zulip': 'everyone'},
+# ]
+
 # Configuration for zulip-side logging streams
 ZULIP_LOG_ENABLE = True
 ZULIP_LOG_PUBLIC_STREAM = 'slack'           # Public logging zulip stream
@@ -26,13 +38,19 @@ ZULIP_LOG_PRIVATE_STREAM = 'slack-private'  # Private logging zulip stream
 REDIS_HOSTNAME = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_PASSWORD = ''
+# How long after a slack message is sent that edits and deletes of it are still
+# applied on zulip.  Days are fine; the mappings are stored compactly.
 SLACK_EDIT_UPDATE_ZULIP_TTL = 60*60
 REDIS_PREFIX = 'zulip.slack'
 
 # Groupme configuration.  If not using Groupme, just set GROUPME_ENABLE to False.
 GROUPME_ENABLE = False
+# Leave the cert paths empty to serve plain http (e.g. behind a TLS proxy).
 SSL_CERT_CHAIN_PATH = ''
 SSL_CERT_KEY_PATH = ''
+# Bot callbacks are received on the port in the GROUPME_INGRESS_PORT environment
+# variable, at https://<host>:<port>/groupme/<channel-name> (or /groupme/<BOT_ID>).
+# BOT_PORT is optional; if set, callbacks to any path on that port also work.
 GROUPME_TWO_WAY = {
     'channel-name': {
         'BOT_ID': '123456789123456789',
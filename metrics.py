@@ -0,0 +1,198 @@
+# Module providing minimal in-process metrics (counters and histograms) and an
+# HTTP endpoint serving them in the Prometheus text exposition format.
+
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_LOGGER = logging.getLogger(__name__)
+
+# Default histogram buckets, in seconds.  Relaying spans everything from cache
+# hits (well under a millisecond) to large file transfers (tens of seconds).
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                       .replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s expects labels %s, got %s' %
+                             (self.name, self.labelnames, tuple(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _header(self):
+        return ['# HELP %s %s' % (self.name, self.documentation),
+                '# TYPE %s %s' % (self.name, self.metric_type)]
+
+
+class Counter(_Metric):
+    '''A monotonically increasing count, optionally split by labels.'''
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, key),
+                                          _format_value(value)))
+        return lines
+
+
+class CallbackMetric(_Metric):
+    '''A counter or gauge whose values are read from a callback when rendered.
+
+       The callback returns a dict of label value tuples to values.'''
+
+    def __init__(self, name, documentation, callback, labelnames=(), metric_type='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.metric_type = metric_type
+        self._callback = callback
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self._callback().items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(self.labelnames, key),
+                                      _format_value(value)))
+        return lines
+
+
+class Histogram(_Metric):
+    '''Distribution of observed values (typically durations in seconds).'''
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per-bucket counts (plus +Inf), sum
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        '''Context manager observing the time spent inside it.'''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def get_count(self, **labels):
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return sum(counts[0]) if counts else 0
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for key, (bucket_counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), bucket_counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        self.name,
+                        _format_labels(self.labelnames, key, [('le', _format_value(bound))]),
+                        cumulative))
+                labels = _format_labels(self.labelnames, key)
+                lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+                lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    '''A collection of metrics that can be rendered together.'''
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, callback, labelnames=(), metric_type='gauge'):
+        return self.register(CallbackMetric(name, documentation, callback,
+                                            labelnames, metric_type))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def make_metrics_handler(registry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are frequent; don't fill the logs with them.
+            _LOGGER.debug('metrics request: ' + format, *args)
+    return MetricsHandler
+
+
+def start_metrics_server(registry, port, host='127.0.0.1'):
+    '''Serves registry at http://host:port/metrics on a daemon thread.
+       Returns the server.'''
+    httpd = ThreadingHTTPServer((host, port), make_metrics_handler(registry))
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    _LOGGER.debug('serving metrics on %s:%d', host, port)
+    return httpd
@@ -0,0 +1,64 @@
+import unittest
+import urllib.request
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        registry = metrics.Registry()
+        counter = registry.counter('test_total', 'A test counter.', ['source'])
+        counter.inc(source='slack')
+        counter.inc(2, source='slack')
+        counter.inc(source='zulip')
+        self.assertEqual(counter.get(source='slack'), 3)
+        self.assertEqual(
+            registry.render(),
+            '# HELP test_total A test counter.\n'
+            '# TYPE test_total counter\n'
+            'test_total{source="slack"} 3\n'
+            'test_total{source="zulip"} 1\n')
+
+        with self.assertRaises(ValueError):
+            counter.inc(destination='slack')
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('test_seconds', 'A test histogram.', ['stage'],
+                                       buckets=(0.1, 1))
+        histogram.observe(0.05, stage='lookup')
+        histogram.observe(0.5, stage='lookup')
+        histogram.observe(5, stage='lookup')
+        with histogram.time(stage='send'):
+            pass
+        self.assertEqual(histogram.get_count(stage='lookup'), 3)
+        self.assertEqual(histogram.get_count(stage='send'), 1)
+        rendered = registry.render()
+        self.assertIn('test_seconds_bucket{stage="lookup",le="0.1"} 1\n', rendered)
+        self.assertIn('test_seconds_bucket{stage="lookup",le="1"} 2\n', rendered)
+        self.assertIn('test_seconds_bucket{stage="lookup",le="+Inf"} 3\n', rendered)
+        self.assertIn('test_seconds_sum{stage="lookup"} 5.55\n', rendered)
+        self.assertIn('test_seconds_count{stage="lookup"} 3\n', rendered)
+
+    def test_callback(self):
+        registry = metrics.Registry()
+        registry.callback('test_cache_total', 'Cache lookups.',
+                          lambda: {('users', 'hit'): 7}, ['cache', 'result'],
+                          metric_type='counter')
+        self.assertIn('test_cache_total{cache="users",result="hit"} 7\n', registry.render())
+
+    def test_server(self):
+        registry = metrics.Registry()
+        registry.counter('test_total', 'A test counter.').inc()
+        httpd = metrics.start_metrics_server(registry, 0)
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % httpd.server_address[1]
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.read().decode('utf-8'), registry.render())
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# Module for remembering which messages the messages we relay were sent as, so
+# that edits and deletes can be applied to them.
+
+import json
+import logging
+import math
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Merges ARGV[2] (a json object of destination -> id) into the json object in
+# field ARGV[1] of hash KEYS[1], and sets the hash to expire in ARGV[3] seconds.
+_MERGE_SCRIPT = '''
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+local ids = {}
+if current then ids = cjson.decode(current) end
+for destination, id in pairs(cjson.decode(ARGV[2])) do ids[destination] = id end
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(ids))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+'''
+
+
+class MessageIdStore:
+    '''Maps the ids of messages on one service to the ids of the messages they
+       were sent as in each destination (e.g. a zulip stream), for at least
+       retention seconds.  The ids in a destination may be anything json can
+       hold.
+
+       Rather than a key per message per destination, the mapping is kept in a
+       few hashes, each holding the messages sent in one window of time, with a
+       field per message whose value holds the ids for all destinations.
+       A whole hash expires once the newest message in it is past retention, so
+       the store holds at most retention plus one window of messages.  Looking
+       a message up checks every window, in one round trip.
+
+       set() queues its write on a pipeline, so that it can be made along with
+       others; get() is for use from threads other than the event loop.'''
+
+    def __init__(self, redis_client, key_prefix, retention, windows=24,
+                 clock=time.time):
+        self.redis = redis_client
+        self.key_prefix = key_prefix
+        self.retention = retention
+        self.window = max(1, math.ceil(retention / windows))
+        self._clock = clock
+
+    def _window_keys(self):
+        '''The keys of the windows that may hold unexpired mappings, newest first.'''
+        newest = int(self._clock() // self.window)
+        oldest = int((self._clock() - self.retention) // self.window)
+        return [self.key_prefix + str(window) for window in range(newest, oldest - 1, -1)]
+
+    def set(self, pipe, message_id, ids):
+        '''Queues a write on pipe recording that message_id was sent as ids, a dict
+           of destination -> id (adding to any other destinations already
+           recorded).'''
+        pipe.eval(_MERGE_SCRIPT, 1, self._window_keys()[0], message_id,
+                  json.dumps(ids), self.retention + self.window)
+
+    def get(self, message_id):
+        '''Returns a dict of destination -> id for message_id (empty if we do not
+           know of it).'''
+        pipe = self.redis.pipeline(transaction=False)
+        for key in self._window_keys():
+            pipe.hget(key, message_id)
+        ids = {}
+        # Later windows have the newer ids, so take those over older ones.
+        for value in reversed(pipe.execute()):
+            if value is not None:
+                try:
+                    ids.update(json.loads(value))
+                except ValueError:
+                    _LOGGER.warning('bad message id mapping for %s: %s', message_id, value)
+        return ids
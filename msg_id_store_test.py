@@ -0,0 +1,100 @@
+import json
+import unittest
+
+import msg_id_store
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000000
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRedis:
+    '''Just enough of a redis client for the store.  eval runs the store's merge
+       script (the only one it has) in python.'''
+
+    def __init__(self):
+        self.hashes = {}
+        self.ttls = {}
+        self.round_trips = 0
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def eval(self, script, numkeys, key, field, ids, ttl):
+        current = json.loads(self.hashes.get(key, {}).get(field, '{}'))
+        current.update(json.loads(ids))
+        self.hashes.setdefault(key, {})[field] = json.dumps(current)
+        self.ttls[key] = ttl
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args):
+            self.commands.append((getattr(self.client, name), args))
+        return queue
+
+    def execute(self):
+        self.client.round_trips += 1
+        return [command(*args) for command, args in self.commands]
+
+
+class TestMessageIdStore(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.clock = FakeClock()
+        self.store = msg_id_store.MessageIdStore(self.redis, 'test:msg.ids:', 24*60*60,
+                                                 windows=24, clock=self.clock)
+
+    def set(self, slack_id, ids):
+        pipe = self.redis.pipeline()
+        self.store.set(pipe, slack_id, ids)
+        pipe.execute()
+
+    def test_get_set(self):
+        self.assertEqual(self.store.get('abc'), {})
+        self.set('abc', {'slack': '1', 'slack-private': '2'})
+        self.redis.round_trips = 0
+        self.assertEqual(self.store.get('abc'), {'slack': '1', 'slack-private': '2'})
+        self.assertEqual(self.redis.round_trips, 1)
+
+    def test_merges_destinations(self):
+        self.set('abc', {'slack': '1'})
+        self.set('abc', {'slack-private': '2'})
+        self.assertEqual(self.store.get('abc'), {'slack': '1', 'slack-private': '2'})
+
+    def test_one_hash_per_window(self):
+        for i in range(100):
+            self.set('msg%d' % i, {'slack': str(i)})
+        self.assertEqual(len(self.redis.hashes), 1)
+        [ttl] = self.redis.ttls.values()
+        self.assertEqual(ttl, 25*60*60)
+
+    def test_newer_windows_win(self):
+        self.set('abc', {'slack': '1', 'slack-private': '2'})
+        self.clock.now += 2*60*60
+        self.set('abc', {'slack': '3'})
+        self.assertEqual(len(self.redis.hashes), 2)
+        self.assertEqual(self.store.get('abc'), {'slack': '3', 'slack-private': '2'})
+
+    def test_retention(self):
+        self.set('abc', {'slack': '1'})
+        self.clock.now += 24*60*60 - 1
+        self.assertEqual(self.store.get('abc'), {'slack': '1'})
+        # Redis will have expired the window by now, and it is not looked at.
+        self.clock.now += 2*60*60
+        self.assertEqual(self.store.get('abc'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# Module to run blocking outbound API calls (e.g. the zulip client) off of
+# the slack event loop, while keeping messages for the same destination in
+# order.
+
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import zlib
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _copy_future_result(source, dest):
+    if source.cancelled():
+        dest.cancel()
+    elif source.exception() is not None:
+        dest.set_exception(source.exception())
+    else:
+        dest.set_result(source.result())
+
+
+class KeyedDispatcher:
+    '''Runs blocking callables on a pool of workers without blocking the event loop.
+
+       Work is submitted with a key (e.g. a zulip stream/topic pair).  Each key is always
+       handled by the same worker, so operations for one key complete in the order they
+       were submitted, while operations for different keys proceed concurrently.
+
+       Each worker has a bounded queue; submitting to a full queue waits for space, which
+       applies backpressure to the producer instead of growing memory without bound.'''
+
+    def __init__(self, loop, workers=4, max_pending=1000, name='dispatcher'):
+        self._loop = loop
+        self._num_workers = workers
+        self._max_pending = max_pending
+        self._name = name
+        self._queues = []
+        self._tasks = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name)
+
+    async def start(self):
+        '''Create the worker queues and tasks.  Must be run on the dispatcher's loop.'''
+        for i in range(self._num_workers):
+            queue = asyncio.Queue(maxsize=self._max_pending)
+            self._queues.append(queue)
+            self._tasks.append(self._loop.create_task(self._worker(queue)))
+        _LOGGER.debug('started %s with %d workers', self._name, self._num_workers)
+
+    def _queue_for(self, key):
+        # crc32 rather than hash() so that the mapping is stable between runs.
+        return self._queues[zlib.crc32(repr(key).encode('utf-8')) % len(self._queues)]
+
+    async def submit(self, key, func, *args, **kwargs):
+        '''Queue func(*args, **kwargs) to be run for key.  Must be awaited on the dispatcher's
+           loop; returns once the work is queued, not once it is done.
+
+           func runs in a copy of the caller's context (e.g. for logging's
+           correlation id).
+
+           Returns an asyncio future resolving to the return value of func.'''
+        future = self._loop.create_future()
+        context = contextvars.copy_context()
+        await self._queue_for(key).put((future, context, func, args, kwargs))
+        return future
+
+    def submit_threadsafe(self, key, func, *args, **kwargs):
+        '''Like submit, but may be called from any thread.  Returns a
+           concurrent.futures.Future resolving to the return value of func.'''
+        result = concurrent.futures.Future()
+
+        async def enqueue():
+            try:
+                future = await self.submit(key, func, *args, **kwargs)
+            except Exception as e:
+                result.set_exception(e)
+                return
+            future.add_done_callback(lambda f: _copy_future_result(f, result))
+
+        asyncio.run_coroutine_threadsafe(enqueue(), self._loop)
+        return result
+
+    async def _worker(self, queue):
+        while True:
+            future, context, func, args, kwargs = await queue.get()
+            try:
+                if not future.cancelled():
+                    ret = await self._loop.run_in_executor(
+                        self._executor, lambda: context.run(func, *args, **kwargs))
+                    if not future.cancelled():
+                        future.set_result(ret)
+            except Exception as e:
+                _LOGGER.debug('%s: work item raised %s', self._name, repr(e))
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def join(self):
+        '''Wait until all currently queued work has completed.'''
+        for queue in self._queues:
+            await queue.join()
+
+    async def stop(self):
+        '''Cancel the workers, abandoning any queued work.'''
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._executor.shutdown(wait=False)
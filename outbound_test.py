@@ -0,0 +1,73 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import bridge_logging
+import outbound
+
+
+class TestKeyedDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.dispatcher = outbound.KeyedDispatcher(self.loop, workers=3,
+                                                   max_pending=10)
+        self.loop.run_until_complete(self.dispatcher.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.dispatcher.stop())
+        self.loop.close()
+
+    def test_per_key_ordering(self):
+        results = []
+
+        def record(key, i):
+            # Make early items slower so that reordering would show up.
+            time.sleep(0.001 * (5 - i))
+            results.append((key, i))
+            return i
+
+        async def run():
+            futures = []
+            for i in range(5):
+                for key in ('a', 'b'):
+                    futures.append(await self.dispatcher.submit(key, record, key, i))
+            return await asyncio.gather(*futures)
+
+        returned = self.loop.run_until_complete(run())
+        self.assertEqual(returned, [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+        for key in ('a', 'b'):
+            self.assertEqual([i for k, i in results if k == key], list(range(5)))
+
+    def test_exception_propagates(self):
+        def fail():
+            raise NameError
+
+        async def run():
+            return await (await self.dispatcher.submit('a', fail))
+
+        with self.assertRaises(NameError):
+            self.loop.run_until_complete(run())
+
+    def test_submit_threadsafe(self):
+        # Run the loop on its own thread, as the bridge does, and submit from this one.
+        thread = threading.Thread(target=self.loop.run_forever)
+        thread.start()
+        try:
+            future = self.dispatcher.submit_threadsafe('a', lambda: 'done')
+            self.assertEqual(future.result(timeout=1), 'done')
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join()
+
+    def test_context_follows_work(self):
+        async def run():
+            with bridge_logging.correlation('slack:C1:1'):
+                future = await self.dispatcher.submit('a', bridge_logging.correlation_id.get)
+            return await future
+
+        self.assertEqual(self.loop.run_until_complete(run()), 'slack:C1:1')
+
+
+if __name__ == '__main__':
+    unittest.main()
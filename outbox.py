@@ -0,0 +1,266 @@
+# Module for a durable outbox of messages waiting to be sent, kept in a redis
+# stream so that sends that fail, or are cut short by a restart, can be retried.
+
+import collections
+import json
+import logging
+import threading
+import uuid
+
+import redis
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Outbox:
+    '''Records each outbound send in a redis stream until it has succeeded.
+
+       A send is appended before it is handed to a sender, and finished once the
+       sender is done with it: on success the entry is deleted from the stream
+       and its idempotency key is remembered for done_ttl seconds, so the same
+       send is never made twice (e.g. if the message it came from is received
+       again).  A send that fails stays in the stream for pending() to return
+       again, up to max_attempts times.  After a restart, pending() returns
+       everything left over from the previous process.
+
+       If redis cannot be reached to record the outcome of a send, the outcome is
+       kept in memory (so the send is not made again meanwhile) and written by the
+       next call to pending().  So this is at least once only if the process dies
+       between a send succeeding and its outcome being written: it is sent again
+       on replay.
+
+       If redis cannot be reached to append sends, they are sent anyway, without
+       the outbox, unless send_unrecorded is off, in which case appending them
+       raises.
+
+       Entries are dicts with the keys id (the stream id), key (the idempotency
+       key), kind and payload (whatever was appended).  Sends are appended and
+       finished in batches, one round trip each, so that the sends relaying one
+       message cost two round trips between them.  Everything but
+       append_many_sync is for use on the event loop (with redis_async);
+       append_many_sync is for other threads (with redis_client).'''
+
+    def __init__(self, redis_client, redis_async, key_prefix, done_ttl=24*60*60,
+                 max_attempts=10, send_unrecorded=True):
+        self.redis = redis_client
+        self.redis_async = redis_async
+        self.stream_key = key_prefix + 'stream'
+        self.done_prefix = key_prefix + 'done:'
+        self.done_ttl = done_ttl
+        self.max_attempts = max_attempts
+        self.send_unrecorded = send_unrecorded
+        self._lock = threading.Lock()
+        # Idempotency keys of entries currently being sent by this process.
+        self._in_flight = set()
+        # Idempotency key -> failed attempts so far.
+        self._attempts = collections.Counter()
+        # Idempotency key -> (entry, sent) for sends that are over, but whose
+        # outcome has not been written to redis yet.
+        self._unrecorded = {}
+
+    def _claim(self, key):
+        with self._lock:
+            if key in self._in_flight or key in self._unrecorded:
+                return False
+            self._in_flight.add(key)
+            return True
+
+    def _release(self, key, failed=False):
+        '''Returns whether the entry should be given up on.'''
+        with self._lock:
+            self._in_flight.discard(key)
+            if not failed:
+                self._attempts.pop(key, None)
+                return False
+            self._attempts[key] += 1
+            if self._attempts[key] < self.max_attempts:
+                return False
+            del self._attempts[key]
+            return True
+
+    def _finished(self, entry, sent):
+        '''Releases an entry whose outcome is to be written, keeping the outcome
+           until _recorded is called for it.'''
+        with self._lock:
+            self._in_flight.discard(entry['key'])
+            self._attempts.pop(entry['key'], None)
+            self._unrecorded[entry['key']] = (entry, sent)
+
+    def _recorded(self, outcomes):
+        with self._lock:
+            for entry, sent in outcomes:
+                if self._unrecorded.get(entry['key'], (None,))[0] is entry:
+                    del self._unrecorded[entry['key']]
+
+    def _new_entry(self, kind, payload, key):
+        if key is None:
+            key = uuid.uuid4().hex
+        if not self._claim(key):
+            return None
+        return {'id': None, 'key': key, 'kind': kind, 'payload': payload}
+
+    def _new_entries(self, sends):
+        return [self._new_entry(kind, payload, key) for kind, payload, key in sends]
+
+    def _queue_append(self, pipe, entries):
+        for entry in entries:
+            if entry is not None:
+                pipe.exists(self.done_prefix + entry['key'])
+                pipe.xadd(self.stream_key, {'key': entry['key'], 'kind': entry['kind'],
+                                            'payload': json.dumps(entry['payload'])})
+
+    def _appended(self, entries, results):
+        '''Records the stream ids of the appended entries, and returns those that
+           had already been sent.'''
+        results = iter(results)
+        done = []
+        for entry in entries:
+            if entry is not None:
+                already_sent, entry['id'] = next(results), next(results)
+                if already_sent:
+                    _LOGGER.debug('outbox: %s was already sent', entry['key'])
+                    done.append(entry)
+        return done
+
+    def _drop_done(self, entries, done):
+        for entry in done:
+            self._release(entry['key'])
+        return [None if any(entry is d for d in done) else entry for entry in entries]
+
+    def _append_failed(self, entries, e):
+        count = sum(entry is not None for entry in entries)
+        if not self.send_unrecorded:
+            for entry in entries:
+                if entry is not None:
+                    self._release(entry['key'])
+            _LOGGER.error('could not add %d sends to the outbox, not sending them: %s',
+                          count, repr(e))
+            raise e
+        _LOGGER.error('could not add %d sends to the outbox, sending them without: %s',
+                      count, repr(e))
+
+    async def append_many(self, sends):
+        '''Records several sends, given as (kind, payload, key) tuples, in one
+           round trip.  key identifies the send (e.g. by the message it is relaying
+           and where to); if None, it is random.
+
+           Returns a list with, for each send, the entry to send and then pass to
+           finish_many, or None if a send with the same key has already been made
+           or is in progress.  Raises redis.RedisError if the sends could not be
+           recorded and send_unrecorded is off.'''
+        entries = self._new_entries(sends)
+        if not any(entries):
+            return entries
+        try:
+            pipe = self.redis_async.pipeline()
+            self._queue_append(pipe, entries)
+            done = self._appended(entries, await pipe.execute())
+            if done:
+                await self.redis_async.xdel(self.stream_key, *[entry['id'] for entry in done])
+                entries = self._drop_done(entries, done)
+        except redis.RedisError as e:
+            self._append_failed(entries, e)
+        return entries
+
+    def append_many_sync(self, sends):
+        '''As append_many, from any thread.'''
+        entries = self._new_entries(sends)
+        if not any(entries):
+            return entries
+        try:
+            pipe = self.redis.pipeline()
+            self._queue_append(pipe, entries)
+            done = self._appended(entries, pipe.execute())
+            if done:
+                self.redis.xdel(self.stream_key, *[entry['id'] for entry in done])
+                entries = self._drop_done(entries, done)
+        except redis.RedisError as e:
+            self._append_failed(entries, e)
+        return entries
+
+    async def append(self, kind, payload, key=None):
+        '''As append_many, for a single send.'''
+        return (await self.append_many([(kind, payload, key)]))[0]
+
+    def _queue_finish(self, pipe, entry, sent):
+        '''Returns whether there is an outcome to write for entry, having queued
+           the writes on pipe.'''
+        if not sent:
+            if not self._release(entry['key'], failed=True):
+                # Left in the stream to be retried.
+                return False
+            _LOGGER.error('Giving up on sending %s %s after %d attempts',
+                          entry['kind'], entry['key'], self.max_attempts)
+        self._finished(entry, sent)
+        self._queue_outcome(pipe, entry, sent)
+        return True
+
+    def _queue_outcome(self, pipe, entry, sent):
+        if sent:
+            pipe.set(self.done_prefix + entry['key'], 1, ex=self.done_ttl)
+        if entry['id'] is not None:
+            pipe.xdel(self.stream_key, entry['id'])
+
+    async def finish_many(self, outcomes, pipe=None):
+        '''Records the outcomes of sending entries, given as (entry, sent) pairs:
+           sent, or failed (to be retried), in one round trip.
+
+           pipe, if given, is a pipeline on redis_async with other writes to make
+           in the same round trip.'''
+        if pipe is None:
+            pipe = self.redis_async.pipeline()
+        finished = [(entry, sent) for entry, sent in outcomes
+                    if self._queue_finish(pipe, entry, sent)]
+        if len(pipe):
+            try:
+                await pipe.execute()
+            except redis.RedisError as e:
+                _LOGGER.error('could not update the outbox for %d sends, will try '
+                              'again: %s', len(finished), repr(e))
+                return
+        self._recorded(finished)
+
+    async def _record_unrecorded(self):
+        '''Writes the outcomes that finish_many could not.'''
+        with self._lock:
+            outcomes = list(self._unrecorded.values())
+        if not outcomes:
+            return
+        pipe = self.redis_async.pipeline()
+        for entry, sent in outcomes:
+            self._queue_outcome(pipe, entry, sent)
+        if len(pipe):
+            await pipe.execute()
+        self._recorded(outcomes)
+
+    async def finish(self, entry, sent):
+        '''As finish_many, for a single send.'''
+        await self.finish_many([(entry, sent)])
+
+    async def pending(self, batch=1000):
+        '''Returns (and claims) the entries in the outbox that are not being sent
+           by this process: failed sends, and those left over from a previous run.
+
+           First writes any outcomes that finish_many could not.'''
+        await self._record_unrecorded()
+        entries = []
+        start = '-'
+        while True:
+            rows = await self.redis_async.xrange(self.stream_key, min=start, count=batch)
+            for stream_id, fields in rows:
+                if not self._claim(fields['key']):
+                    continue
+                try:
+                    payload = json.loads(fields['payload'])
+                except ValueError:
+                    _LOGGER.error('dropping unreadable outbox entry %s', stream_id)
+                    await self.redis_async.xdel(self.stream_key, stream_id)
+                    self._release(fields['key'])
+                    continue
+                entries.append({'id': stream_id, 'key': fields['key'],
+                                'kind': fields['kind'], 'payload': payload})
+            if len(rows) < batch:
+                return entries
+            # The id after the last one we saw.  (Exclusive ranges need redis 6.2.)
+            ms, seq = rows[-1][0].split('-')
+            start = '%s-%d' % (ms, int(seq) + 1)
@@ -0,0 +1,233 @@
+import asyncio
+import unittest
+
+import redis
+
+import outbox
+
+
+class FakeServer:
+    def __init__(self):
+        self.strings = {}
+        self.ttls = {}
+        self.streams = {}
+        self.next_id = 1
+
+
+class FakeRedis:
+    '''Just enough of a redis client (sync, or async if is_async) for the outbox.'''
+
+    def __init__(self, server, is_async=False):
+        self.server = server
+        self.is_async = is_async
+        self.fail = False
+
+    def _result(self, value):
+        if self.fail:
+            raise redis.ConnectionError('redis is down')
+        if not self.is_async:
+            return value
+
+        async def result():
+            return value
+        return result()
+
+    def _exists(self, key):
+        return int(key in self.server.strings)
+
+    def _set(self, key, value, ex=None):
+        self.server.strings[key] = str(value)
+        self.server.ttls[key] = ex
+        return True
+
+    def _xadd(self, key, fields):
+        stream_id = '%d-0' % self.server.next_id
+        self.server.next_id += 1
+        self.server.streams.setdefault(key, {})[stream_id] = dict(fields)
+        return stream_id
+
+    def _xdel(self, key, *ids):
+        stream = self.server.streams.get(key, {})
+        return sum(stream.pop(stream_id, None) is not None for stream_id in ids)
+
+    def _xrange(self, key, min='-', count=None):
+        def parse(stream_id):
+            return tuple(int(part) for part in stream_id.split('-'))
+        rows = sorted(self.server.streams.get(key, {}).items(), key=lambda row: parse(row[0]))
+        if min != '-':
+            rows = [row for row in rows if parse(row[0]) >= parse(min)]
+        return rows[:count]
+
+    def exists(self, key):
+        return self._result(self._exists(key))
+
+    def set(self, key, value, ex=None):
+        return self._result(self._set(key, value, ex))
+
+    def xadd(self, key, fields):
+        return self._result(self._xadd(key, fields))
+
+    def xdel(self, key, *ids):
+        return self._result(self._xdel(key, *ids))
+
+    def xrange(self, key, min='-', count=None):
+        return self._result(self._xrange(key, min, count))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.client, '_' + name), args, kwargs))
+        return queue
+
+    def __len__(self):
+        return len(self.commands)
+
+    def execute(self):
+        if self.client.fail:
+            return self.client._result(None)
+        return self.client._result([command(*args, **kwargs)
+                                    for command, args, kwargs in self.commands])
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.redis = FakeRedis(self.server)
+        self.redis_async = FakeRedis(self.server, is_async=True)
+        self.outbox = outbox.Outbox(self.redis, self.redis_async, 'test:outbox:',
+                                    done_ttl=60, max_attempts=3)
+
+    def append_sync(self, kind, payload, key=None):
+        return self.outbox.append_many_sync([(kind, payload, key)])[0]
+
+    def stream(self):
+        return self.server.streams.get('test:outbox:stream', {})
+
+    def test_send_succeeds(self):
+        entry = self.append_sync('zulip', {'msg': 'hi'}, key='slack:C1:1')
+        self.assertEqual(entry['kind'], 'zulip')
+        self.assertEqual(entry['payload'], {'msg': 'hi'})
+        self.assertIn(entry['id'], self.stream())
+
+        asyncio.run(self.outbox.finish(entry, True))
+        self.assertEqual(self.stream(), {})
+        self.assertIn('test:outbox:done:slack:C1:1', self.server.strings)
+        self.assertEqual(self.server.ttls['test:outbox:done:slack:C1:1'], 60)
+
+    def test_async(self):
+        entry = asyncio.run(self.outbox.append('slack', {'text': 'hi'}))
+        self.assertIn(entry['id'], self.stream())
+        asyncio.run(self.outbox.finish(entry, True))
+        self.assertEqual(self.stream(), {})
+
+    def test_duplicates_are_not_sent(self):
+        entry = self.append_sync('zulip', {'msg': 'hi'}, key='k')
+        # Still being sent.
+        self.assertIsNone(self.append_sync('zulip', {'msg': 'hi'}, key='k'))
+        asyncio.run(self.outbox.finish(entry, True))
+        # Already sent.
+        self.assertIsNone(self.append_sync('zulip', {'msg': 'hi'}, key='k'))
+        self.assertIsNone(asyncio.run(self.outbox.append('zulip', {'msg': 'hi'}, key='k')))
+        self.assertEqual(self.stream(), {})
+
+    def test_failed_sends_are_pending(self):
+        entry = self.append_sync('groupme', {'text': 'hi'}, key='k')
+        sent = self.append_sync('groupme', {'text': 'ok'}, key='ok')
+        # Entries being sent are not pending.
+        self.assertEqual(asyncio.run(self.outbox.pending()), [])
+
+        asyncio.run(self.outbox.finish(entry, False))
+        asyncio.run(self.outbox.finish(sent, True))
+        self.assertEqual(asyncio.run(self.outbox.pending()), [entry])
+        # ... and are claimed by pending.
+        self.assertEqual(asyncio.run(self.outbox.pending()), [])
+
+    def test_gives_up(self):
+        entry = self.append_sync('groupme', {'text': 'hi'}, key='k')
+        for _ in range(2):
+            asyncio.run(self.outbox.finish(entry, False))
+            [entry] = asyncio.run(self.outbox.pending())
+        asyncio.run(self.outbox.finish(entry, False))
+        self.assertEqual(self.stream(), {})
+        self.assertEqual(asyncio.run(self.outbox.pending()), [])
+
+    def test_pending_after_restart(self):
+        for i in range(5):
+            self.append_sync('zulip', {'msg': str(i)}, key=str(i))
+        restarted = outbox.Outbox(self.redis, self.redis_async, 'test:outbox:')
+        entries = asyncio.run(restarted.pending(batch=2))
+        self.assertEqual([entry['payload']['msg'] for entry in entries],
+                         ['0', '1', '2', '3', '4'])
+
+    def test_unreadable_entries_are_dropped(self):
+        self.redis.xadd('test:outbox:stream', {'key': 'k', 'kind': 'zulip',
+                                               'payload': '{'})
+        self.assertEqual(asyncio.run(self.outbox.pending()), [])
+        self.assertEqual(self.stream(), {})
+
+    def test_batches(self):
+        entries = self.outbox.append_many_sync([('zulip', {'msg': 'hi'}, 'a'),
+                                                ('groupme', {'text': 'hi'}, 'b')])
+        self.assertEqual(len(self.stream()), 2)
+        # One is a duplicate of one in progress, one was already sent.
+        asyncio.run(self.outbox.finish_many([(entries[1], True)]))
+        again = asyncio.run(self.outbox.append_many([('zulip', {'msg': 'hi'}, 'a'),
+                                                     ('groupme', {'text': 'hi'}, 'b'),
+                                                     ('slack', {'text': 'hi'}, 'c')]))
+        self.assertEqual([entry and entry['key'] for entry in again], [None, None, 'c'])
+        self.assertEqual(set(self.stream()), {entries[0]['id'], again[2]['id']})
+
+        # Other writes can be made in the same round trip.
+        pipe = self.redis_async.pipeline()
+        pipe.set('other', 'value')
+        asyncio.run(self.outbox.finish_many([(entries[0], True), (again[2], False)], pipe))
+        self.assertEqual(self.server.strings['other'], 'value')
+        self.assertEqual(set(self.stream()), {again[2]['id']})
+
+    def test_finish_fails(self):
+        entry = self.append_sync('zulip', {'msg': 'hi'}, key='k')
+        failed = self.append_sync('zulip', {'msg': 'hi'}, key='failed')
+        self.redis_async.fail = True
+        asyncio.run(self.outbox.finish_many([(entry, True), (failed, False)]))
+
+        # The send is not made again while its outcome cannot be written...
+        self.assertIsNone(self.append_sync('zulip', {'msg': 'hi'}, key='k'))
+        with self.assertRaises(redis.ConnectionError):
+            asyncio.run(self.outbox.pending())
+
+        # ... nor once it has been.
+        self.redis_async.fail = False
+        self.assertEqual(asyncio.run(self.outbox.pending()), [failed])
+        self.assertIn('test:outbox:done:k', self.server.strings)
+        self.assertEqual(set(self.stream()), {failed['id']})
+        self.assertIsNone(asyncio.run(self.outbox.append('zulip', {'msg': 'hi'}, key='k')))
+
+    def test_redis_down(self):
+        self.redis.fail = True
+        entry = self.append_sync('zulip', {'msg': 'hi'})
+        # Sent anyway, just without the outbox.
+        self.assertIsNone(entry['id'])
+        asyncio.run(self.outbox.finish(entry, True))
+
+    def test_redis_down_not_sent(self):
+        recorded_only = outbox.Outbox(self.redis, self.redis_async, 'test:outbox:',
+                                      send_unrecorded=False)
+        self.redis.fail = True
+        with self.assertRaises(redis.ConnectionError):
+            recorded_only.append_many_sync([('zulip', {'msg': 'hi'}, 'k')])
+        # Not sent, so it can be tried again.
+        self.redis.fail = False
+        [entry] = recorded_only.append_many_sync([('zulip', {'msg': 'hi'}, 'k')])
+        self.assertIn(entry['id'], self.stream())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# Module for working out where to relay messages to, from the bridges
+# configured between slack channels, zulip topics and groupme bots.
+
+import collections
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+SIDES = ('slack', 'zulip', 'groupme')
+
+
+def legacy_bridges(public_two_way, groupme_two_way):
+    '''The bridges implied by the older settings: each channel in public_two_way
+       is bridged to the zulip topic of the same name, and each in
+       groupme_two_way (a dict of channel name -> bot conf) to its groupme bot.'''
+    bridges = []
+    for name in list(public_two_way) + [name for name in groupme_two_way
+                                        if name not in public_two_way]:
+        bridges.append({'slack': name,
+                        'zulip': name if name in public_two_way else None,
+                        'groupme': name if name in groupme_two_way else None})
+    return bridges
+
+
+class RoutingTable:
+    '''Where a message from a slack channel, zulip topic or groupme bot is to be
+       relayed, given bridges: a list of dicts, each joining (at least two of) a
+       slack channel (name or id), a zulip topic (in the two-way stream) and a
+       groupme bot (a key of groupme_bots).  A channel, topic or bot may be in
+       any number of bridges, and is relayed to everything it is bridged with.
+
+       Everything is worked out when the table is made, so routing a message is
+       a dict lookup.  Slack messages arrive with a channel id, so the ids (and
+       privacy) of slack channels are learned from the channel records the
+       bridge fetches anyway (see learn_slack_channel); a channel whose id has
+       not been learned yet can still be routed by name.'''
+
+    def __init__(self, bridges, groupme_bots=None):
+        groupme_bots = groupme_bots or {}
+        # (side, name) -> destination side -> names there, in config order
+        routes = collections.defaultdict(lambda: {side: {} for side in SIDES})
+        for bridge in bridges:
+            unknown = set(bridge) - set(SIDES)
+            if unknown:
+                raise ValueError('unknown side %s in bridge %s' % (sorted(unknown), bridge))
+            ends = [(side, bridge[side]) for side in SIDES if bridge.get(side)]
+            if len(ends) < 2:
+                raise ValueError('bridge %s does not join two sides' % bridge)
+            if bridge.get('groupme') and bridge['groupme'] not in groupme_bots:
+                raise ValueError('bridge %s is to unconfigured groupme bot %s' %
+                                 (bridge, bridge['groupme']))
+            for end in ends:
+                for side, name in ends:
+                    if side != end[0]:
+                        routes[end][side][name] = None
+        self._routes = {end: {side: tuple(names) for side, names in to.items()}
+                        for end, to in routes.items()}
+        self._none = {side: () for side in SIDES}
+        # slack channel id -> name, and name -> {'id', 'name', 'private'}
+        self._slack_names = {}
+        self._slack_channels = {}
+        _LOGGER.debug('routing %d bridges', len(bridges))
+
+    def routes(self, side, name):
+        '''A dict of destination side -> the names there to relay a message from
+           name (a slack channel id or name, zulip topic or groupme bot) on side
+           to.'''
+        routes = self._routes.get((side, name))
+        if routes is None and side == 'slack' and name in self._slack_names:
+            routes = self._routes.get((side, self._slack_names[name]))
+        return routes or self._none
+
+    def destinations(self, side, name, to_side):
+        '''The names on to_side to relay a message from name on side to.'''
+        return self.routes(side, name)[to_side]
+
+    def is_bridged(self, side, name):
+        return any(self.routes(side, name).values())
+
+    def learn_slack_channel(self, channel_id, channel):
+        '''Records the name and privacy of the slack channel channel_id, from its
+           record (as stored in redis, with 'name' and 'type').'''
+        if 'name' not in channel:
+            return
+        self._slack_names[channel_id] = channel['name']
+        info = {'id': channel_id, 'name': channel['name'],
+                'private': channel.get('type') == 'private-channel'}
+        self._slack_channels[channel['name']] = info
+        self._slack_channels[channel_id] = info
+
+    def slack_channel(self, channel):
+        '''A dict of the id, name and privacy ('private') of the slack channel
+           with the given name or id, or None if it has not been learned.'''
+        return self._slack_channels.get(channel)
@@ -0,0 +1,76 @@
+import unittest
+
+import routing
+
+GROUPME_BOTS = {'social-bot': {'BOT_ID': '1'}, 'crew-bot': {'BOT_ID': '2'}}
+
+
+class TestRoutingTable(unittest.TestCase):
+    def setUp(self):
+        self.routes = routing.RoutingTable([
+            {'slack': 'social', 'zulip': 'social', 'groupme': 'social-bot'},
+            {'slack': 'social', 'zulip': 'everyone'},
+            {'slack': 'announcements', 'zulip': 'everyone'},
+            {'slack': 'C00000CRW', 'groupme': 'crew-bot'},
+            {'zulip': 'crew', 'groupme': 'crew-bot'},
+        ], GROUPME_BOTS)
+
+    def test_many_to_many(self):
+        self.assertEqual(self.routes.routes('slack', 'social'),
+                         {'slack': (), 'zulip': ('social', 'everyone'),
+                          'groupme': ('social-bot',)})
+        self.assertEqual(self.routes.destinations('zulip', 'everyone', 'slack'),
+                         ('social', 'announcements'))
+        self.assertEqual(self.routes.destinations('zulip', 'social', 'groupme'),
+                         ('social-bot',))
+        self.assertEqual(self.routes.routes('groupme', 'crew-bot'),
+                         {'slack': ('C00000CRW',), 'zulip': ('crew',), 'groupme': ()})
+
+    def test_not_bridged(self):
+        self.assertFalse(self.routes.is_bridged('slack', 'random'))
+        self.assertFalse(self.routes.is_bridged('zulip', 'social-bot'))
+        self.assertEqual(self.routes.destinations('zulip', 'random', 'slack'), ())
+
+    def test_slack_channel_ids(self):
+        # Configured by name, but messages arrive with the channel id.
+        self.assertFalse(self.routes.is_bridged('slack', 'C00000SOC'))
+        self.assertIsNone(self.routes.slack_channel('social'))
+        self.routes.learn_slack_channel('C00000SOC', {'type': 'private-channel',
+                                                      'name': 'social'})
+        self.assertEqual(self.routes.destinations('slack', 'C00000SOC', 'zulip'),
+                         ('social', 'everyone'))
+        self.assertEqual(self.routes.slack_channel('social'),
+                         {'id': 'C00000SOC', 'name': 'social', 'private': True})
+        self.assertEqual(self.routes.slack_channel('C00000SOC'),
+                         self.routes.slack_channel('social'))
+
+        # Configured by id.
+        self.assertEqual(self.routes.destinations('slack', 'C00000CRW', 'groupme'),
+                         ('crew-bot',))
+
+        # Ims have no name to route by.
+        self.routes.learn_slack_channel('D00000001', {'type': 'im', 'user_id': 'U1'})
+        self.assertIsNone(self.routes.slack_channel('D00000001'))
+
+    def test_bad_bridges(self):
+        with self.assertRaises(ValueError):
+            routing.RoutingTable([{'slack': 'social'}])
+        with self.assertRaises(ValueError):
+            routing.RoutingTable([{'slack': 'social', 'groupme': 'nobody'}], GROUPME_BOTS)
+        with self.assertRaises(ValueError):
+            routing.RoutingTable([{'slack': 'social', 'zulip_topic': 'social'}])
+
+    def test_legacy_bridges(self):
+        bridges = routing.legacy_bridges(['social', 'crew'], {'crew': {}, 'lx': {}})
+        self.assertEqual(bridges, [
+            {'slack': 'social', 'zulip': 'social', 'groupme': None},
+            {'slack': 'crew', 'zulip': 'crew', 'groupme': 'crew'},
+            {'slack': 'lx', 'zulip': None, 'groupme': 'lx'},
+        ])
+        routes = routing.RoutingTable(bridges, {'crew': {}, 'lx': {}})
+        self.assertEqual(routes.destinations('groupme', 'lx', 'zulip'), ())
+        self.assertEqual(routes.destinations('zulip', 'crew', 'groupme'), ('crew',))
+
+
+if __name__ == '__main__':
+    unittest.main()
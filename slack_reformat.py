@@ -1,14 +1,12 @@
 # Module to consolidate logic around reformatting messages that originate on
 # slack before they are forwarded.
 
+import asyncio
 import datetime
 import logging
 import re
-import sys
-import requests
-import traceback
 
-from io import BytesIO
+import file_bridge
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -16,19 +14,47 @@ _LOGGER = logging.getLogger(__name__)
 _SLACK_USER_MATCH = re.compile("<@([A-Z0-9]+)>")
 _SLACK_NOTIF_MATCH = re.compile("<!([a-zA-Z0-9]+)>")
 _SLACK_CHANNEL_MATCH = re.compile("<#[a-zA-Z0-9]+\\|([a-zA-Z0-9]+)>")
-_SLACK_LINK_BARE_URL_MATCH = re.compile("<([a-zA-Z0-9]+:[^|>]+)(\\|\\1){0,1}>")
 _SLACK_LINK_MATCH = re.compile("<([a-zA-Z0-9]+:[^|>]+)(?:\\|([^>]+)){0,1}>")
 
+# All of the above as a single alternation, so that reformat_slack_text only needs to
+# walk the text once.
+_SLACK_MARKUP_MATCH = re.compile(
+    "<@(?P<user>[A-Z0-9]+)>"
+    "|<!(?P<notif>[a-zA-Z0-9]+)>"
+    "|<#[a-zA-Z0-9]+\\|(?P<channel>[a-zA-Z0-9]+)>"
+    "|<(?P<url>[a-zA-Z0-9]+:[^|>]+)(?:\\|(?P<displaytext>[^>]+)){0,1}>")
+
 async def reformat_slack_text(user_formatter, input_text):
     '''This helper method, given a SlackUserFormatter, will format the input_text
-       for transmission from Slack to other services.  Using it ensures that any dependencies
-       between the individual reformatters is obeyed. '''
-    input_text = await user_formatter.format_user(input_text)
-    input_text = await format_notifications(input_text)
-    input_text = await format_channels(input_text)
-    input_text = await format_markdown_links(input_text)
+       for transmission from Slack to other services.
+
+       This is equivalent to applying format_user, format_notifications, format_channels
+       and format_markdown_links in turn, but makes a single pass over the text.'''
+    matches = list(_SLACK_MARKUP_MATCH.finditer(input_text))
+    users = await user_formatter.resolve_users(
+        m.group('user') for m in matches if m.group('user') is not None)
+    return _render_slack_markup(input_text, matches, users)
+
+
+def _render_slack_markup(input_text, matches, users):
+    '''Reformats input_text, given its _SLACK_MARKUP_MATCH matches and a dict of
+       user id to display name (as returned by SlackUserFormatter.resolve_users).'''
+    pieces = []
+    last_end = 0
+    for m in matches:
+        pieces.append(input_text[last_end:m.start()])
+        if m.group('user') is not None:
+            pieces.append(_format_user(users.get(m.group('user')), m.group()))
+        elif m.group('notif') is not None:
+            pieces.append(_format_notification(m.group('notif')))
+        elif m.group('channel') is not None:
+            pieces.append(_format_channel(m.group('channel')))
+        else:
+            pieces.append(_format_markdown_link(m.group('url'), m.group('displaytext')))
+        last_end = m.end()
+    pieces.append(input_text[last_end:])
 
-    return input_text
+    return ''.join(pieces)
 
 
 async def _do_transform(input_text,
@@ -37,66 +63,117 @@ async def _do_transform(input_text,
        alternate markdown, and then getting them replaced.  Private to this module.
 
        Searches input_text for regex_search (compiled regex object)
-       Strips < > and prefix if specified.
-           Ex. "<@U###>" becomes U###, "<!here>" becomes "here"
        Passes the regex match object to (async) replace_func, which returns what to replace it with.
            Ex. for channels which match "<@C##|general>" replace_func would return '**#general**'
 
+       The result is built up in a list and joined once, so this is linear in the
+       length of the text regardless of the number of matches.
+
        Returns the result of the transform.'''
-    transform_shift = 0
+    pieces = []
+    last_end = 0
     for m in match_pattern.finditer(input_text):
-        match = m.group()
+        pieces.append(input_text[last_end:m.start()])
+        pieces.append(await replace_func(m))
+        last_end = m.end()
+    pieces.append(input_text[last_end:])
+    return ''.join(pieces)
+
+
+def _format_user(at_user, original_text):
+    if at_user:
+        return '**@%s**' % at_user
+    # in failure cases, just return the original text
+    return original_text
+
 
-        old_text = input_text
-        start = m.start() + transform_shift
+def _format_notification(notification):
+    return '**@%s**' % notification
 
-        input_text = old_text[:start]
-        input_text += await replace_func(m)
-        input_text += old_text[start + len(match):]
 
-        transform_shift = len(input_text) - len(old_text) + transform_shift
-    return input_text
+def _format_channel(channel_name):
+    return '**#%s**' % channel_name
+
+
+def _format_markdown_link(url, displaytext):
+    if displaytext is None or displaytext == url:
+        return url
+    return '[%s](%s)' % (displaytext, url)
 
 
 class SlackUserFormatter:
-    def __init__(self, user_lookup_function, log_on_error=True):
+    def __init__(self, user_lookup_function, log_on_error=True, max_concurrent_lookups=8):
         '''Constructor.  user_lookup_function should return a couroutine that resolves to
-            the display name of the passed in user identifier. It may throw an exception on failure.'''
+            the display name of the passed in user identifier. It may throw an exception on failure.
+
+            At most max_concurrent_lookups calls to user_lookup_function will be outstanding
+            at once.'''
         self._get_slack_user = user_lookup_function
         self._log_on_error = log_on_error
+        self._max_concurrent_lookups = max_concurrent_lookups
+        # Created lazily so that it belongs to the loop we are actually used on.
+        self._lookup_semaphore = None
+        # user id -> task for lookups that are currently outstanding, so that concurrent
+        # messages mentioning the same user share a single lookup.
+        self._in_flight = {}
+
+    async def _lookup_user(self, at_user_id):
+        '''Returns the display name for at_user_id, or None if it can't be found.'''
+        if self._lookup_semaphore is None:
+            self._lookup_semaphore = asyncio.Semaphore(self._max_concurrent_lookups)
+        try:
+            async with self._lookup_semaphore:
+                at_user = await self._get_slack_user(at_user_id)
+
+            if at_user:
+                return at_user
+            else:
+                _LOGGER.info("couldn't find get @ user %s:",
+                             at_user_id)
+        except:
+            if (self._log_on_error):
+                _LOGGER.warning("couldn't find get @ user %s", at_user_id,
+                                exc_info=True)
+        return None
+
+    def _lookup_user_shared(self, at_user_id):
+        task = self._in_flight.get(at_user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup_user(at_user_id))
+            self._in_flight[at_user_id] = task
+            task.add_done_callback(lambda t: self._in_flight.pop(at_user_id, None))
+        return task
+
+    async def resolve_users(self, user_ids):
+        '''Looks up the display names of all of the distinct user_ids concurrently.
+
+           Returns a dict of user id to display name, with None for users that could
+           not be found.'''
+        distinct_ids = list(dict.fromkeys(user_ids))
+        if not distinct_ids:
+            return {}
+        names = await asyncio.gather(*[self._lookup_user_shared(at_user_id)
+                                       for at_user_id in distinct_ids])
+        return dict(zip(distinct_ids, names))
+
+    async def format_user_id(self, at_user_id, original_text):
+        '''Returns the reformatted text for a single user reference, or original_text
+           if the user cannot be found.'''
+        return _format_user(await self._lookup_user_shared(at_user_id), original_text)
 
     async def format_user(self, input_text):
         '''Handles reformatting of slack markdown user references in a string of text. '''
+        matches = list(_SLACK_USER_MATCH.finditer(input_text))
+        users = await self.resolve_users(m.group(1) for m in matches)
 
-        async def user_reformat(m):
-            '''User reformat helper function for _do_transform. '''
-            match = m.group()
-            at_user_id = match[2:-1]
-
-            try:
-                at_user = await self._get_slack_user(at_user_id)
-
-                if at_user:
-                    return '**@%s**' % at_user
-                else:
-                    _LOGGER.info("couldn't find get @ user %s:",
-                                 at_user_id)
-            except:
-                e = sys.exc_info()
-                exc_type, exc_value, exc_traceback = e
-                trace = repr(traceback.format_exception(exc_type,
-                                                        exc_value,
-                                                        exc_traceback))
-                if (self._log_on_error):
-                    _LOGGER.warning("couldn't find get @ user %s: %s",
-                                    at_user_id, trace)
-
-            # in failure cases, just return the original text
-            return match
-
-        return await _do_transform(input_text,
-                                   _SLACK_USER_MATCH,
-                                   user_reformat)
+        pieces = []
+        last_end = 0
+        for m in matches:
+            pieces.append(input_text[last_end:m.start()])
+            pieces.append(_format_user(users[m.group(1)], m.group()))
+            last_end = m.end()
+        pieces.append(input_text[last_end:])
+        return ''.join(pieces)
 
 
 async def format_notifications(input_text):
@@ -104,7 +181,7 @@ async def format_notifications(input_text):
        any groups have already been filtered out, as they use a similar format
        but would need the ID to be looked up.'''
     async def notification_reformat(m):
-        return ('**@%s**' % m.group(1))
+        return _format_notification(m.group(1))
 
     return await _do_transform(input_text,
                                _SLACK_NOTIF_MATCH,
@@ -115,7 +192,7 @@ async def format_channels(input_text):
     '''Finds anything that looks like a slack channel in the text, and replaces
        it with a bolded version.  Returns the new text.'''
     async def channel_reformat(m):
-        return ('**#%s**' % m.group(1))
+        return _format_channel(m.group(1))
 
     return await _do_transform(input_text,
                                _SLACK_CHANNEL_MATCH,
@@ -137,17 +214,7 @@ async def format_markdown_links(input_text):
 
        Returns the new text.'''
     async def replace_markdown_link(m):
-        match = m.group()
-        bare_url_match = _SLACK_LINK_BARE_URL_MATCH.match(match)
-
-        if bare_url_match:
-            replacement = bare_url_match.group(1)
-        else:
-            replacement_url = m.group(1)
-            replacement_displaytext = m.group(2)
-            replacement = '[%s](%s)' % (replacement_displaytext, replacement_url)
-
-        return replacement
+        return _format_markdown_link(m.group(1), m.group(2))
 
     return await _do_transform(input_text,
                                _SLACK_LINK_MATCH,
@@ -155,12 +222,14 @@ async def format_markdown_links(input_text):
 
 
 def format_files_from_slack(files, needs_leading_newline,
-                            slack_bearer_token=None, zulip_client=None):
+                            slack_bearer_token=None, zulip_client=None, mirrored_uris=None):
     '''Given a list of files from the slack API, return both a markdown and plaintext
        string representation of those files.
 
-       Assuming a bearer token and zulip client are provided, the files are mirrored to zulip
-       and those links are included in the markdown result.
+       mirrored_uris is a dict of slack file id to zulip uri, as returned by
+       file_bridge.SlackFileBridge.mirror_files, and those links are included in the markdown
+       result.  Alternatively, assuming a bearer token and zulip client are provided, the files
+       are mirrored to zulip here, blocking until done.
 
        This method only uses the passed in message text to determine how to format its output
        caller must append as appropriate.'''
@@ -172,6 +241,12 @@ def format_files_from_slack(files, needs_leading_newline,
     output = { 'markdown': '',
                'plaintext': '' }
 
+    if mirrored_uris is None:
+        mirrored_uris = {}
+        if slack_bearer_token and zulip_client:
+            mirrored_uris = file_bridge.SlackFileBridge(
+                slack_bearer_token, zulip_client).mirror_files_sync(files)
+
     first_file = True
     for file in files:
         if not first_file or needs_leading_newline:
@@ -182,26 +257,8 @@ def format_files_from_slack(files, needs_leading_newline,
 
         if 'name' in file and file['name']:
             rendered_markdown_name = file['name']
-            if slack_bearer_token and zulip_client and 'url_private' in file and file['url_private']:
-                file_private_url = file['url_private']
-                r = requests.get(file_private_url,
-                                 headers={"Authorization": f"Bearer {slack_bearer_token}"})
-                if r.status_code == 200:
-                    if file_private_url != r.url:
-                        # we were redirected!
-                        _LOGGER.info(
-                            f'Apparent slack redirect from {file_private_url} to {r.url} when bridging file.  Skipping.')
-                    else:
-                        uploadable_file = BytesIO(r.content)
-                        uploadable_file.name = file['name']
-
-                        response = zulip_client.upload_file(uploadable_file)
-                        if 'uri' in response and response['uri']:
-                            rendered_markdown_name = f"[{file['name']}]({response['uri']})"
-                        else:
-                            _LOGGER.info('Got bad response when uploading to zulip: {}'.format(response))
-                else:
-                    _LOGGER.info(f"Got code {r.status_code} when fetching {file_private_url} from slack.")
+            if file.get('id') in mirrored_uris:
+                rendered_markdown_name = f"[{file['name']}]({mirrored_uris[file['id']]})"
 
             output['markdown'] += f"*(Bridged Message included file: {rendered_markdown_name}"
             output['plaintext'] += f"(Bridged Message included file: {file['name']}"
@@ -217,79 +274,92 @@ def format_files_from_slack(files, needs_leading_newline,
 async def format_attachments_from_slack(message_text, attachments, edit_or_delete, user_formatter):
     '''Translate a slack-style attachments list into text to be appended to a zulip message
        returning the result in both plaintext and markdown form.
-       
+
+       Both forms are built in a single walk over the attachments.  The slack text in them
+       (text, field values and footers) is reformatted as by reformat_slack_text, but the
+       users mentioned anywhere in the attachments are looked up together, once.
+
        This method only uses the passed in message text to determine how to format its output
        caller must append as appropriate.'''
-    output = { 'markdown': '',
-               'plaintext': '' }
+    markdown = []
+    plaintext = []
+    # Slack text still to be reformatted.  Its index in this list stands in for it in
+    # markdown and plaintext until the users mentioned are resolved.
+    slack_texts = []
+    mentioned_users = []
+
+    def slack_text(text):
+        slack_texts.append(text)
+        mentioned_users.extend(_SLACK_USER_MATCH.findall(text))
+        return len(slack_texts) - 1
 
     if len(attachments) > 0:
         if edit_or_delete or len(message_text) > 0:
-            output['markdown'] += '\n\n'
-            output['plaintext'] += '\n\n'
-        for attach_i in range(len(attachments)):
+            markdown.append('\n\n')
+            plaintext.append('\n\n')
+        for attach_i, attachment in enumerate(attachments):
             if attach_i > 0:
-                output['markdown'] += '\n\n'
-                output['plaintext'] += '\n\n'
-            attachment = attachments[attach_i]
+                markdown.append('\n\n')
+                plaintext.append('\n\n')
             if 'pretext' in attachment:
-                output['markdown'] += attachment['pretext'] + '\n'
-                output['plaintext'] += attachment['pretext'] + '\n'
+                markdown += (attachment['pretext'], '\n')
+                plaintext += (attachment['pretext'], '\n')
             if ('text' in attachment or
                     'title' in attachment or
                     'author_name' in attachment):
                 if (not edit_or_delete and not len(message_text) > 0
                     and 'pretext' not in attachment):
-                    output['markdown'] += '\n'
-                    output['plaintext'] += '\n'
-                output['markdown'] += '```quote\n'
-                # no need to extend output['plaintext'] in a similar way
+                    markdown.append('\n')
+                    plaintext.append('\n')
+                markdown.append('```quote\n')
+                # no need to extend plaintext in a similar way
                 if 'author_link' in attachment:
-                    output['markdown'] += f"[{attachment['author_name']}]({attachment['author_link']})\n"
-                    output['plaintext'] += f"{attachment['author_name']}: {attachment['author_link']}\n"
+                    markdown.append(f"[{attachment['author_name']}]({attachment['author_link']})\n")
+                    plaintext.append(f"{attachment['author_name']}: {attachment['author_link']}\n")
                 elif 'author_name' in attachment:
-                    output['markdown'] += f"{attachment['author_name']}\n"
-                    output['plaintext'] += f"{attachment['author_name']}\n"
+                    markdown.append(f"{attachment['author_name']}\n")
+                    plaintext.append(f"{attachment['author_name']}\n")
                 if 'title_link' in attachment:
-                    output['markdown'] += f"**[{attachment['title']}]({attachment['title_link']})**\n"
-                    output['plaintext'] += f"{attachment['title']}: {attachment['title_link']}\n"
+                    markdown.append(f"**[{attachment['title']}]({attachment['title_link']})**\n")
+                    plaintext.append(f"{attachment['title']}: {attachment['title_link']}\n")
                 elif 'title' in attachment:
-                    output['markdown'] += f"**{attachment['title']}**\n"
-                    output['plaintext'] += f"{attachment['title']}\n"
+                    markdown.append(f"**{attachment['title']}**\n")
+                    plaintext.append(f"{attachment['title']}\n")
                 if 'text' in attachment:
-                    text_formatted = \
-                        await reformat_slack_text(user_formatter, attachment['text'])
-                    output['markdown'] += f"{text_formatted}\n"
-                    output['plaintext'] += f"{text_formatted}\n"
+                    text_i = slack_text(attachment['text'])
+                    markdown += (text_i, '\n')
+                    plaintext += (text_i, '\n')
                 if 'image_url' in attachment:
-                    output['markdown'] += f"[Image]({attachment['image_url']})\n"
-                    output['plaintext'] += f"(Image: {attachment['image_url']})\n"
-                if 'fields' in attachment:
-                    for field in attachment['fields']:
-                        if 'title' in field:
-                            output['markdown'] += f"**{field['title']}**\n"
-                            output['plaintext'] += f"{field['title']}\n"
-                        if 'value' in field:
-                            field_value_formatted = \
-                                await reformat_slack_text(user_formatter, field['value'])
-                            output['markdown'] += f"{field_value_formatted}\n"
-                            output['plaintext'] += f"{field_value_formatted}\n"
+                    markdown.append(f"[Image]({attachment['image_url']})\n")
+                    plaintext.append(f"(Image: {attachment['image_url']})\n")
+                for field in attachment.get('fields', ()):
+                    if 'title' in field:
+                        markdown.append(f"**{field['title']}**\n")
+                        plaintext.append(f"{field['title']}\n")
+                    if 'value' in field:
+                        value_i = slack_text(field['value'])
+                        markdown += (value_i, '\n')
+                        plaintext += (value_i, '\n')
                 if 'footer' in attachment:
-                    footer_formatted = \
-                        await reformat_slack_text(user_formatter, attachment['footer'])
-                    output['markdown'] += f"*{footer_formatted}*"
-                    output['plaintext'] += f"{footer_formatted}"
+                    footer_i = slack_text(attachment['footer'])
+                    markdown += ('*', footer_i, '*')
+                    plaintext.append(footer_i)
                 if 'footer' in attachment and 'ts' in attachment:
-                    output['markdown'] += " | "
-                    output['plaintext'] += " | "
+                    markdown.append(" | ")
+                    plaintext.append(" | ")
                 if 'ts' in attachment:
                     out_time = datetime.datetime.fromtimestamp(attachment['ts']).strftime('%c')
-                    output['markdown'] += f"*{out_time}*"
-                    output['plaintext'] += f"{out_time}"
+                    markdown.append(f"*{out_time}*")
+                    plaintext.append(out_time)
                 if 'footer' in attachment or 'ts' in attachment:
-                    output['markdown'] += "\n"
-                    output['plaintext'] += "\n"
-                output['markdown'] += '```'
-                # no need to extend output['plaintext'] in a similar way
+                    markdown.append("\n")
+                    plaintext.append("\n")
+                markdown.append('```')
+                # no need to extend plaintext in a similar way
 
-    return output
+    users = await user_formatter.resolve_users(mentioned_users)
+    rendered = [_render_slack_markup(text, _SLACK_MARKUP_MATCH.finditer(text), users)
+                for text in slack_texts]
+
+    return { 'markdown': ''.join(p if isinstance(p, str) else rendered[p] for p in markdown),
+             'plaintext': ''.join(p if isinstance(p, str) else rendered[p] for p in plaintext) }
@@ -0,0 +1,235 @@
+# Offline benchmarks for the slack_reformat module.
+#
+# Runs the reformatters over a synthetic corpus using stub user lookups and
+# stub HTTP (so no slack, zulip or redis is needed), and reports operations per
+# second and memory allocated per operation.
+#
+#   python slack_reformat_bench.py                          # just report
+#   python slack_reformat_bench.py --save bench_baseline.json
+#   python slack_reformat_bench.py --compare bench_baseline.json
+#
+# With --compare, exits non-zero if any benchmark got slower (or allocates
+# more) than the baseline by more than --tolerance.
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+
+import file_bridge
+import slack_reformat
+
+_USERS = {'U%07d' % i: 'user%d' % i for i in range(50)}
+
+
+async def _stub_user_lookup(user_id):
+    # Yield to the loop like a real (cached) lookup would.
+    await asyncio.sleep(0)
+    return _USERS.get(user_id, False)
+
+
+def _mentions(count):
+    return ' '.join('<@U%07d> ping' % (i % 10) for i in range(count))
+
+
+def _links(count):
+    return ' '.join('<https://example.com/%d|link %d> and <https://example.org/%d>' % (i, i, i)
+                    for i in range(count))
+
+
+CORPUS = {
+    'short_chat': 'are we still on for load-in at 5? <@U0000001> has the keys',
+    'mention_heavy': '<!here> ' + _mentions(40) + ' <#C0000001|general>',
+    'link_heavy': 'Links for the show: ' + _links(30),
+}
+
+BOT_ATTACHMENTS = [{
+    'fallback': 'Alert',
+    'pretext': 'Monitoring alert for <!channel>',
+    'title': 'Disk usage high',
+    'title_link': 'https://monitoring.example.com/alerts/1',
+    'author_name': 'monitoring',
+    'author_link': 'https://monitoring.example.com/',
+    'text': 'Owner <@U0000001>, see <https://wiki.example.com/runbook|the runbook>',
+    'fields': [{
+        'title': 'Field %d' % i,
+        'value': 'value %d for <@U%07d> <https://example.com/%d|details>' % (i, i % 20, i),
+        'short': True,
+    } for i in range(30)],
+    'footer': '<https://monitoring.example.com|Monitoring>',
+    'ts': 1558647312,
+}, {
+    'title': 'Second alert',
+    'text': 'Also <@U0000002>',
+}]
+
+MULTI_FILE = [{
+    'id': 'F%07d' % i,
+    'name': 'photo%d.jpg' % i,
+    'title': 'Photo %d' % i,
+    'size': 64 * 1024,
+    'url_private': 'https://files.slack.com/files-pri/T0000000-F%07d/photo%d.jpg' % (i, i),
+} for i in range(5)]
+
+
+class _StubResponse:
+    def __init__(self, url=None, chunks=(), json_body=None):
+        self.status_code = 200
+        self.url = url
+        self._chunks = chunks
+        self._json_body = json_body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        return iter(self._chunks)
+
+    def json(self):
+        return self._json_body
+
+
+class _StubSession:
+    '''Stands in for requests.Session: serves 64KiB of data for every download and
+       accepts every upload.'''
+    _CHUNKS = [b'x' * file_bridge.DOWNLOAD_CHUNK_SIZE]
+
+    def get(self, url, **kwargs):
+        return _StubResponse(url=url, chunks=self._CHUNKS)
+
+    def post(self, url, data=None, **kwargs):
+        while data.read(file_bridge.DOWNLOAD_CHUNK_SIZE):
+            pass
+        return _StubResponse(json_body={'result': 'success', 'uri': '/user_uploads/1/ab/file'})
+
+
+class _StubZulipClient:
+    base_url = 'https://zulip.example.com/api/'
+    email = 'bot@example.com'
+    api_key = 'key'
+    tls_verification = True
+
+
+def _make_benchmarks():
+    user_formatter = slack_reformat.SlackUserFormatter(_stub_user_lookup)
+    bridge = file_bridge.SlackFileBridge('token', _StubZulipClient())
+    session = _StubSession()
+    bridge._session = lambda: session
+
+    benchmarks = {}
+    for name, text in CORPUS.items():
+        benchmarks['reformat_slack_text.' + name] = \
+            (lambda text=text: slack_reformat.reformat_slack_text(user_formatter, text))
+
+    benchmarks['format_attachments_from_slack.bot_attachments'] = \
+        lambda: slack_reformat.format_attachments_from_slack(
+            'message', BOT_ATTACHMENTS, False, user_formatter)
+
+    async def format_files():
+        # Forget previous mirrors so every run pays for the (stub) transfer.
+        bridge._local_cache.clear()
+        mirrored_uris = await bridge.mirror_files(MULTI_FILE)
+        return slack_reformat.format_files_from_slack(MULTI_FILE, True,
+                                                      mirrored_uris=mirrored_uris)
+    benchmarks['format_files_from_slack.multi_file'] = format_files
+
+    return benchmarks
+
+
+async def _run_iterations(make_coro, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await make_coro()
+    return time.perf_counter() - start
+
+
+def run_benchmark(loop, make_coro, iterations, repeats):
+    '''Returns a dict of results for one benchmark.'''
+    # Warm up (caches, lazily created executors, ...).
+    loop.run_until_complete(_run_iterations(make_coro, max(1, iterations // 10)))
+
+    best = min(loop.run_until_complete(_run_iterations(make_coro, iterations))
+               for _ in range(repeats))
+
+    alloc_iterations = max(1, iterations // 10)
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        loop.run_until_complete(_run_iterations(make_coro, alloc_iterations))
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'ops_per_sec': iterations / best,
+        'peak_bytes': peak - before,
+        'retained_bytes_per_op': max(0, after - before) / alloc_iterations,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''Returns a list of human readable regressions of results against baseline.'''
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.0f ops/sec, baseline %.0f' %
+                               (name, result['ops_per_sec'], base['ops_per_sec']))
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance) + 1024:
+            regressions.append('%s: peak %d bytes allocated, baseline %d' %
+                               (name, result['peak_bytes'], base['peak_bytes']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the slack_reformat module.')
+    parser.add_argument('--iterations', type=int, default=2000,
+                        help='operations per timed run')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='timed runs per benchmark; the fastest is reported')
+    parser.add_argument('--only', help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed fractional regression against the baseline')
+    args = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    results = {}
+    for name, make_coro in sorted(_make_benchmarks().items()):
+        if args.only and args.only not in name:
+            continue
+        iterations = args.iterations
+        if name.startswith('format_files_from_slack'):
+            # Each of these moves several (stub) files through a thread pool.
+            iterations = max(1, iterations // 10)
+        results[name] = run_benchmark(loop, make_coro, iterations, args.repeats)
+        print('%-50s %10.0f ops/sec %10d peak bytes %8.0f retained bytes/op' %
+              (name, results[name]['ops_per_sec'], results[name]['peak_bytes'],
+               results[name]['retained_bytes_per_op']))
+    loop.close()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,6 +25,21 @@ class TestSlackReformat(unittest.TestCase):
                     'User <@12345> Channel <#C123G567|channel> Notif <!here> Link <http://foo.com>')),
             'User **@Alice** Channel **#channel** Notif **@here** Link http://foo.com')
 
+        # The single pass reformatter must agree with applying each reformatter in turn.
+        async def sequential(text):
+            text = await _trivial_user_formatter.format_user(text)
+            text = await slack_reformat.format_notifications(text)
+            text = await slack_reformat.format_channels(text)
+            return await slack_reformat.format_markdown_links(text)
+
+        mixed_text = ('<!channel> <@12345> and <@Unknown> see <#C1|general> '
+                      '<http://foo.com|Foo> <http://bar.com|http://bar.com> <mailto:x@x.com> '
+                      '<unclosed <@12345')
+        for text in [mixed_text, mixed_text * 50, '', 'Plain Text']:
+            self.assertEqual(
+                do_await(slack_reformat.reformat_slack_text(_trivial_user_formatter, text)),
+                do_await(sequential(text)))
+
 
     def test_format_user(self):
         # Simple standin for the redis lookup.
@@ -77,6 +92,40 @@ class TestSlackReformat(unittest.TestCase):
         )
 
 
+    def test_format_user_lookups(self):
+        # Track lookups, and how many are outstanding at once.
+        lookups = []
+        outstanding = [0, 0]  # current, max
+
+        async def slow_user_lookup(id):
+            lookups.append(id)
+            outstanding[0] += 1
+            outstanding[1] = max(outstanding)
+            await asyncio.sleep(0.01)
+            outstanding[0] -= 1
+            return 'User' + id
+
+        user_formatter = slack_reformat.SlackUserFormatter(
+            slow_user_lookup, log_on_error=False, max_concurrent_lookups=3)
+
+        # Repeated mentions are only looked up once, and no more than 3 at a time.
+        text = ' '.join('<@%d>' % (i % 10) for i in range(40))
+        self.assertEqual(
+            do_await(user_formatter.format_user(text)),
+            ' '.join('**@User%d**' % (i % 10) for i in range(40)))
+        self.assertEqual(sorted(lookups), [str(i) for i in range(10)])
+        self.assertEqual(outstanding[1], 3)
+
+        # Concurrent messages share outstanding lookups of the same user.
+        lookups.clear()
+        async def concurrent_messages():
+            return await asyncio.gather(
+                slack_reformat.reformat_slack_text(user_formatter, 'Hi <@1>'),
+                slack_reformat.reformat_slack_text(user_formatter, 'Bye <@1>'))
+        self.assertEqual(do_await(concurrent_messages()), ['Hi **@User1**', 'Bye **@User1**'])
+        self.assertEqual(lookups, ['1'])
+
+
     def test_format_notifications(self):
         # No groups in text
         self.assertEqual(
@@ -252,6 +301,13 @@ class TestSlackReformat(unittest.TestCase):
         self.assertEqual(output['markdown'],
             '*(Bridged Message included file: filename.jpg)*\n*(Bridged Message included file: filename.jpg)*')
 
+        # Mirrored file gets linked in the markdown only.
+        output = slack_reformat.format_files_from_slack(
+            [test_file], False, mirrored_uris={'U0000000': '/user_uploads/1/ab/filename.jpg'})
+        self.assertEqual(output['plaintext'], '(Bridged Message included file: filename.jpg)')
+        self.assertEqual(output['markdown'],
+            '*(Bridged Message included file: [filename.jpg](/user_uploads/1/ab/filename.jpg))*')
+
         # If we have a title that matches the filename, it should not be displayed.
         test_file['title'] = test_filename
         output = slack_reformat.format_files_from_slack([test_file], True)
@@ -347,5 +403,55 @@ class TestSlackReformat(unittest.TestCase):
             '\n\nABTech/zulip_slack_integration\nStars\n1\nLanguage\nPython\n[ABTech/zulip_slack_integration](https://github.com/ABTech/zulip_slack_integration) | Thu May 23 17:35:12 2019\n'
         )
 
+
+    def test_format_attachments_user_lookups(self):
+        # Users mentioned anywhere in the attachments are looked up together, once each.
+        lookups = []
+        outstanding = [0, 0]  # current, max
+
+        async def slow_user_lookup(id):
+            lookups.append(id)
+            outstanding[0] += 1
+            outstanding[1] = max(outstanding)
+            await asyncio.sleep(0.01)
+            outstanding[0] -= 1
+            return 'User' + id
+
+        user_formatter = slack_reformat.SlackUserFormatter(
+            slow_user_lookup, log_on_error=False)
+
+        alert_attachments = [{
+            'title': 'Disk usage high',
+            'text': 'Owner <@1>',
+            'fields': [{'title': 'Field %d' % i, 'value': 'on call <@%d>' % (i % 3)}
+                       for i in range(6)],
+            'footer': 'Paged <@1> and <!here>',
+        }, {
+            'title': 'Second alert',
+            'text': 'Also <@3>',
+        }]
+        output = do_await(slack_reformat.format_attachments_from_slack(
+            '', alert_attachments, False, user_formatter))
+
+        markdown_fields = ''.join('**Field %d**\non call **@User%d**\n' % (i, i % 3)
+                                  for i in range(6))
+        plaintext_fields = ''.join('Field %d\non call **@User%d**\n' % (i, i % 3)
+                                   for i in range(6))
+        self.assertEqual(
+            output['markdown'],
+            '\n```quote\n**Disk usage high**\nOwner **@User1**\n' +
+            markdown_fields +
+            '*Paged **@User1** and **@here***\n```'
+            '\n\n\n```quote\n**Second alert**\nAlso **@User3**\n```'
+        )
+        self.assertEqual(
+            output['plaintext'],
+            '\nDisk usage high\nOwner **@User1**\n' + plaintext_fields +
+            'Paged **@User1** and **@here**\n'
+            '\n\n\nSecond alert\nAlso **@User3**\n'
+        )
+        self.assertEqual(sorted(lookups), ['0', '1', '2', '3'])
+        self.assertEqual(outstanding[1], 4)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+# Module providing a small in-process cache to sit in front of redis for
+# values that are read far more often than they change (users, channels, ...).
+
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    '''A bounded least-recently-used cache whose entries also expire after ttl seconds.
+
+       Safe to use from multiple threads.  Keeps hit and miss counters so that the
+       effectiveness of the cache can be observed.'''
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Returns the cached value for key, or default if it is missing or expired.'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self._clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        '''Returns a dict of the current size and hit/miss counters.'''
+        with self._lock:
+            return {'size': len(self._data),
+                    'hits': self.hits,
+                    'misses': self.misses}
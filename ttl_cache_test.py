@@ -0,0 +1,57 @@
+import unittest
+
+import ttl_cache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_get_set(self):
+        cache = ttl_cache.TTLCache(maxsize=10, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+        cache.set('a', 'Alice')
+        self.assertEqual(cache.get('a'), 'Alice')
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 2})
+
+    def test_expiry(self):
+        clock = FakeClock()
+        cache = ttl_cache.TTLCache(maxsize=10, ttl=60, clock=clock)
+        cache.set('a', 'Alice')
+        clock.now = 59
+        self.assertEqual(cache.get('a'), 'Alice')
+        clock.now = 60
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = ttl_cache.TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Touch 'a' so that 'b' is the least recently used.
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_invalidate(self):
+        cache = ttl_cache.TTLCache(maxsize=10, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.invalidate('a')
+        cache.invalidate('missing')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        cache.clear()
+        self.assertIsNone(cache.get('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# Module for receiving events from zulip over a narrowed event queue that
+# outlives reconnects and restarts of the bridge.
+
+import json
+import logging
+import threading
+import time
+
+import redis
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ZulipEventQueue:
+    '''Long-polls a zulip event queue for event_types, narrowed (on the server)
+       to narrow, and calls a callback with each event.
+
+       The queue id and the id of the last event handled are kept in redis, in
+       the hash at key, so that after a dropped connection or a restart the
+       same queue is picked back up, along with the events sent in the
+       meantime, rather than registering a new queue that starts from now.
+       Zulip drops queues that have not been polled for a while (ten minutes,
+       by default); then, or if event_types or narrow have changed, a new queue
+       is registered.
+
+       Zulip applies the narrow to message events only; other events (such as
+       update_message) are for any message the bot can see.
+
+       Errors are retried with exponential backoff, from retry_interval up to
+       max_retry_interval seconds.  run() blocks, so it belongs on a thread of
+       its own.'''
+
+    def __init__(self, client, redis_client, key, event_types, narrow,
+                 retry_interval=1, max_retry_interval=60, sleep=time.sleep):
+        self.client = client
+        self.redis = redis_client
+        self.key = key
+        self.event_types = list(event_types)
+        self.narrow = narrow
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._sleep = sleep
+        # Identifies what the queue was registered for.
+        self._params = json.dumps([self.event_types, self.narrow])
+        self._stopped = threading.Event()
+
+    def stop(self):
+        '''Makes run() return once it is done with the events it has.'''
+        self._stopped.set()
+
+    def _backoff(self, failures):
+        self._sleep(min(self.max_retry_interval,
+                        self.retry_interval * 2 ** (failures - 1)))
+
+    def _load(self):
+        '''Returns the queue id and last event id saved by a previous run, or
+           (None, None).'''
+        try:
+            saved = self.redis.hgetall(self.key)
+        except redis.RedisError as e:
+            _LOGGER.warning('could not read the saved zulip event queue: %s', repr(e))
+            return None, None
+        if saved.get('params') != self._params or 'queue_id' not in saved:
+            return None, None
+        _LOGGER.info('resuming zulip event queue %s after event %s',
+                     saved['queue_id'], saved['last_event_id'])
+        return saved['queue_id'], int(saved['last_event_id'])
+
+    def _save(self, queue_id, last_event_id):
+        try:
+            self.redis.hset(self.key, mapping={'queue_id': queue_id,
+                                               'last_event_id': last_event_id,
+                                               'params': self._params})
+        except redis.RedisError as e:
+            _LOGGER.warning('could not save the zulip event queue: %s', repr(e))
+
+    def _register(self):
+        failures = 0
+        while not self._stopped.is_set():
+            res = self.client.register(self.event_types, self.narrow)
+            if res['result'] == 'success':
+                _LOGGER.info('registered zulip event queue %s', res['queue_id'])
+                self._save(res['queue_id'], res['last_event_id'])
+                return res['queue_id'], res['last_event_id']
+            failures += 1
+            _LOGGER.warning('could not register a zulip event queue: %s',
+                            res.get('msg'))
+            self._backoff(failures)
+        return None, None
+
+    def run(self, callback):
+        '''Calls callback with each event (other than heartbeats), until stop()
+           is called.'''
+        queue_id, last_event_id = self._load()
+        failures = 0
+        while not self._stopped.is_set():
+            if queue_id is None:
+                queue_id, last_event_id = self._register()
+                continue
+
+            res = self.client.get_events(queue_id=queue_id,
+                                         last_event_id=last_event_id)
+            if res['result'] != 'success':
+                if (res.get('code') == 'BAD_EVENT_QUEUE_ID' or
+                        res.get('msg', '').startswith('Bad event queue id:')):
+                    _LOGGER.warning('zulip event queue %s has gone away; events '
+                                    'since event %s may be missed',
+                                    queue_id, last_event_id)
+                    queue_id = None
+                    continue
+                failures += 1
+                _LOGGER.warning('could not get zulip events (%s): %s',
+                                res['result'], res.get('msg'))
+                self._backoff(failures)
+                continue
+            failures = 0
+
+            for event in res['events']:
+                last_event_id = max(last_event_id, int(event['id']))
+                if event['type'] != 'heartbeat':
+                    callback(event)
+            if res['events']:
+                # Once per poll rather than per event: events that are handled
+                # again after a crash are deduplicated by the outbox.
+                self._save(queue_id, last_event_id)
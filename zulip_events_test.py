@@ -0,0 +1,122 @@
+import unittest
+
+import redis
+
+import zulip_events
+
+NARROW = [['stream', 'bridge']]
+EVENT_TYPES = ['message', 'update_message']
+
+
+class FakeRedis:
+    def __init__(self):
+        self.hashes = {}
+        self.fail = False
+
+    def hgetall(self, key):
+        if self.fail:
+            raise redis.ConnectionError('redis is down')
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, mapping):
+        if self.fail:
+            raise redis.ConnectionError('redis is down')
+        self.hashes.setdefault(key, {}).update(
+            {field: str(value) for field, value in mapping.items()})
+
+
+class FakeClient:
+    '''Answers get_events from a script of responses, stopping the queue once
+       the script runs out.'''
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.registered = []
+        self.polled = []
+        self.queue = None
+
+    def register(self, event_types, narrow):
+        self.registered.append((event_types, narrow))
+        return {'result': 'success', 'queue_id': 'q%d' % len(self.registered),
+                'last_event_id': 10}
+
+    def get_events(self, queue_id, last_event_id):
+        self.polled.append((queue_id, last_event_id))
+        response = self.responses.pop(0)
+        if not self.responses:
+            self.queue.stop()
+        return response
+
+
+def events(*ids):
+    return {'result': 'success',
+            'events': [{'id': i, 'type': 'message', 'message': {'id': i}} for i in ids]}
+
+
+class TestZulipEventQueue(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.sleeps = []
+        self.received = []
+
+    def run_queue(self, responses):
+        client = FakeClient(responses)
+        queue = zulip_events.ZulipEventQueue(client, self.redis, 'test:queue',
+                                             EVENT_TYPES, NARROW,
+                                             sleep=self.sleeps.append)
+        client.queue = queue
+        queue.run(self.received.append)
+        return client
+
+    def saved(self):
+        saved = self.redis.hashes['test:queue']
+        return saved['queue_id'], saved['last_event_id']
+
+    def test_events(self):
+        heartbeat = {'result': 'success', 'events': [{'id': 13, 'type': 'heartbeat'}]}
+        client = self.run_queue([events(11, 12), heartbeat, events()])
+        self.assertEqual(client.registered, [(EVENT_TYPES, NARROW)])
+        self.assertEqual(client.polled, [('q1', 10), ('q1', 12), ('q1', 13)])
+        self.assertEqual([event['id'] for event in self.received], [11, 12])
+        self.assertEqual(self.saved(), ('q1', '13'))
+
+    def test_resumes_after_restart(self):
+        self.run_queue([events(11)])
+        client = self.run_queue([events(12)])
+        # The same queue, from where the last run left off.
+        self.assertEqual(client.registered, [])
+        self.assertEqual(client.polled, [('q1', 11)])
+        self.assertEqual(self.saved(), ('q1', '12'))
+
+    def test_registration_changed(self):
+        self.run_queue([events(11)])
+        client = FakeClient([events()])
+        queue = zulip_events.ZulipEventQueue(client, self.redis, 'test:queue',
+                                             EVENT_TYPES, [['stream', 'other']])
+        client.queue = queue
+        queue.run(self.received.append)
+        self.assertEqual(client.registered, [(EVENT_TYPES, [['stream', 'other']])])
+
+    def test_queue_gone(self):
+        gone = {'result': 'error', 'code': 'BAD_EVENT_QUEUE_ID',
+                'msg': 'Bad event queue id: q1'}
+        client = self.run_queue([gone, events(11)])
+        self.assertEqual(len(client.registered), 2)
+        self.assertEqual(client.polled, [('q1', 10), ('q2', 10)])
+        self.assertEqual(self.sleeps, [])
+
+    def test_errors_back_off(self):
+        down = {'result': 'connection-error', 'msg': 'down'}
+        self.run_queue([down, down, down, events(11)])
+        self.assertEqual(self.sleeps, [1, 2, 4])
+        self.assertEqual(len(self.received), 1)
+
+    def test_redis_down(self):
+        self.redis.fail = True
+        client = self.run_queue([events(11)])
+        self.assertEqual(len(client.registered), 1)
+        self.assertEqual(len(self.received), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()